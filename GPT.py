@@ -1,13 +1,22 @@
 import os
+import math
+import time
+import codecs
+import asyncio
+import threading
+import bisect
+import tracemalloc
 import torch
-import tiktoken
 import numpy as np
 import urllib.request
 import torch.nn as nn
 import matplotlib.pyplot as plt
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
+from torch.utils.checkpoint import checkpoint
 from matplotlib.ticker import MaxNLocator
+from contextlib import nullcontext
+from tokenization import get_tokenizer, encode_batch
 
 
 class MultiHeadAttention(nn.Module):
@@ -29,7 +38,7 @@ class MultiHeadAttention(nn.Module):
 		)
 
 
-	def forward(self, x):
+	def forward(self, x, kv_cache=None, layer_idx=None, attn_mask=None):
 		b, num_tokens, _ = x.shape 	# Shape: (b, num_tokens, d_out)
 
 		keys = self.W_key(x)
@@ -46,15 +55,29 @@ class MultiHeadAttention(nn.Module):
 		queries = queries.transpose(1, 2)
 		values = values.transpose(1, 2)
 
+		# Incremental decoding: append the new keys/values to the cache and attend over all of them
+		start = 0
+		if kv_cache is not None:
+			start = kv_cache.lengths[layer_idx]
+			keys, values = kv_cache.update(layer_idx, keys, values)
+		num_keys = keys.shape[2]
+
 		# Attention scores 
 		attn_scores = queries @ keys.transpose(2, 3)
 
-		# Mask 
-		mask_bool = self.mask.bool()[:num_tokens, :num_tokens]
+		# Padding mask (b, num_keys), True for real tokens. Uses the lowest finite value instead of -inf
+		# so the rows of padding queries (no real key to attend) don't turn into NaN
+		# or (b, num_tokens, num_keys) per query (packed sequences, see document_mask)
+		if attn_mask is not None:
+			attn_scores.masked_fill_(~expand_attn_mask(attn_mask), torch.finfo(attn_scores.dtype).min)
+
+		# Mask (the queries are the rows start..start+num_tokens of the causal mask)
+		mask_bool = self.mask.bool()[start:start + num_tokens, :num_keys]
 		attn_scores.masked_fill_(mask_bool, -torch.inf)
 
 		# Attention weights
-		attn_weights = torch.softmax(attn_scores / keys.shape[-1]**0.5, dim=-1)
+		# Softmax in float32 also when running in bfloat16
+		attn_weights = torch.softmax(attn_scores.float() / keys.shape[-1]**0.5, dim=-1).to(values.dtype)
 		attn_weights = self.dropout(attn_weights)
 
 		# Context
@@ -65,6 +88,109 @@ class MultiHeadAttention(nn.Module):
 		context = self.out_proj(context)
 		return context
 
+	# Checkpoints of FusedMultiHeadAttention store the query/key/value projections in a single matrix
+	def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+		for name in ("weight", "bias"):
+			fused = state_dict.pop(f"{prefix}qkv.{name}", None)
+			if fused is not None:
+				q, k, v = fused.chunk(3, dim=0)
+				state_dict[f"{prefix}W_query.{name}"] = q
+				state_dict[f"{prefix}W_key.{name}"] = k
+				state_dict[f"{prefix}W_value.{name}"] = v
+		super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+
+
+# Attention mask to (b, 1, num_tokens or 1, num_keys), broadcast over the heads
+def expand_attn_mask(attn_mask):
+	if attn_mask.dim() == 2:
+		return attn_mask[:, None, None, :]
+	return attn_mask[:, None, :, :]
+
+
+
+"""
+  document_mask
+    Several documents packed in a row (GPTA.PackedInstructionDataset): the positions restart at 0 on
+    every document and a token only attends to the tokens of its own document (block diagonal).
+"""
+def document_mask(position_ids):
+	doc_ids = (position_ids == 0).cumsum(dim=1)
+	return doc_ids[:, :, None] == doc_ids[:, None, :]
+
+
+
+
+"""
+  FusedMultiHeadAttention
+    Same attention as MultiHeadAttention with a single matmul for the queries, keys and values
+    and torch's scaled_dot_product_attention, which doesn't keep the (b, heads, T, T) attention
+    weights around. Selected with cfg["attn_impl"] = "fused".
+"""
+class FusedMultiHeadAttention(nn.Module):
+	def __init__(self, d_in, d_out, context_length, dropout, num_heads, qkv_bias=False):
+		super().__init__() 
+		assert (d_out % num_heads == 0),  "Out dimension must be divisible by the number of heads"
+
+		self.d_out = d_out
+		self.num_heads = num_heads
+		self.head_dim = d_out // num_heads
+		self.qkv = nn.Linear(d_in, 3 * d_out, bias=qkv_bias)
+		self.out_proj = nn.Linear(d_out, d_out)
+		self.dropout = dropout
+		self.register_buffer(
+			"mask",
+			torch.triu(torch.ones(context_length, context_length, dtype=torch.bool), diagonal=1)
+		)
+
+
+	def forward(self, x, kv_cache=None, layer_idx=None, attn_mask=None):
+		b, num_tokens, _ = x.shape
+
+		# (b, num_tokens, 3 * d_out) -> 3 x (b, num_heads, num_tokens, head_dim)
+		qkv = self.qkv(x).view(b, num_tokens, 3, self.num_heads, self.head_dim)
+		queries, keys, values = qkv.permute(2, 0, 3, 1, 4).unbind(0)
+
+		start = 0
+		if kv_cache is not None:
+			start = kv_cache.lengths[layer_idx]
+			keys, values = kv_cache.update(layer_idx, keys, values)
+		num_keys = keys.shape[2]
+
+		dropout_p = self.dropout if self.training else 0.0
+		if attn_mask is None and num_keys == num_tokens:
+			context = nn.functional.scaled_dot_product_attention(
+				queries, keys, values, dropout_p=dropout_p, is_causal=True
+			)
+		else:
+			# The queries don't start on the first key (cache) or there is padding: explicit mask,
+			# with the lowest finite value so padding queries don't turn into NaN
+			mask_bool = self.mask[start:start + num_tokens, :num_keys]
+			if attn_mask is not None:
+				mask_bool = mask_bool | ~expand_attn_mask(attn_mask)
+			bias = torch.zeros(mask_bool.shape, dtype=queries.dtype, device=queries.device)
+			bias.masked_fill_(mask_bool, torch.finfo(queries.dtype).min)
+			context = nn.functional.scaled_dot_product_attention(
+				queries, keys, values, attn_mask=bias, dropout_p=dropout_p
+			)
+
+		# Combine all the heads 
+		context = context.transpose(1, 2).contiguous().view(b, num_tokens, self.d_out)
+		return self.out_proj(context)
+
+	# Checkpoints of MultiHeadAttention have separated query/key/value projections
+	def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+		for name in ("weight", "bias"):
+			parts = [state_dict.pop(f"{prefix}{w}.{name}", None) for w in ("W_query", "W_key", "W_value")]
+			if parts[0] is not None:
+				state_dict[f"{prefix}qkv.{name}"] = torch.cat(parts, dim=0)
+		# Their causal mask is float, it is combined with bool masks here (also bound as is by load_state_dict(assign=True))
+		mask = state_dict.get(f"{prefix}mask")
+		if mask is not None and mask.dtype != torch.bool:
+			state_dict[f"{prefix}mask"] = mask.bool()
+		super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 
 
@@ -72,7 +198,8 @@ class TransformerBlock(nn.Module):
 	def __init__(self, cfg):
 		super().__init__()
 		# Components of the transformer block 
-		self.att = MultiHeadAttention(
+		attention = FusedMultiHeadAttention if cfg.get("attn_impl") == "fused" else MultiHeadAttention
+		self.att = attention(
 			d_in=cfg["emb_dim"],
 			d_out=cfg["emb_dim"],
 			context_length=cfg["context_length"],
@@ -87,10 +214,10 @@ class TransformerBlock(nn.Module):
 		self.drop_shortcut = nn.Dropout(cfg["drop_rate"])
 
 	# Data flow inside the transformer block 
-	def forward(self, x):
+	def forward(self, x, kv_cache=None, layer_idx=None, attn_mask=None):
 		shortcut = x
 		x = self.norm1(x)
-		x = self.att(x)
+		x = self.att(x, kv_cache=kv_cache, layer_idx=layer_idx, attn_mask=attn_mask)
 		x = self.drop_shortcut(x)
 		x = x + shortcut 
 
@@ -139,11 +266,13 @@ class LayerNorm(nn.Module):
 		self.scale = nn.Parameter(torch.ones(emb_dim))
 		self.shift = nn.Parameter(torch.ones(emb_dim))
 
+	# Statistics in float32 also when the activations are in bfloat16
 	def forward(self, x):
-		mean = x.mean(dim=-1, keepdim=True)
-		var = x.var(dim=-1, keepdim=True, unbiased=False)
-		norm_x = (x - mean) / torch.sqrt(var + self.eps)
-		return self.scale * norm_x + self.shift
+		x_float = x.float()
+		mean = x_float.mean(dim=-1, keepdim=True)
+		var = x_float.var(dim=-1, keepdim=True, unbiased=False)
+		norm_x = (x_float - mean) / torch.sqrt(var + self.eps)
+		return (self.scale * norm_x + self.shift).to(x.dtype)
 
 
 
@@ -166,20 +295,51 @@ class GPTModel(nn.Module):
     self.out_head = nn.Linear(
       cfg["emb_dim"], cfg["vocab_size"], bias=False
     )
+    # Recompute the activations of each transformer block on the backward pass instead of keeping them
+    self.activation_checkpointing = cfg.get("activation_checkpointing", False)
 
-  def forward(self, in_idx):
+  # output_positions: only compute the output of some positions, "last" (b, 1, ...) or the indices of
+  #   every row, (b,) -> (b, 1, ...) or (b, k) -> (b, k, ...). Default all the positions.
+  # return_hidden: return the hidden states after final_norm instead of the logits (skips out_head)
+  def forward(self, in_idx, kv_cache=None, pos_offset=None, attn_mask=None, position_ids=None, output_positions=None, return_hidden=False):
     batch_size, seq_len = in_idx.shape
+    # With a cache the new tokens continue after the cached ones
+    if pos_offset is None:
+      pos_offset = len(kv_cache) if kv_cache is not None else 0
     # Process the embeddings 
     tok_embeds = self.tok_emb(in_idx)     # Work embedding 
     # The positional, if the seq_len is smaller than the context_length, we use the seq_len.. 
-    pos_embeds = self.pos_emb(torch.arange(seq_len, device=in_idx.device))
+    positions = torch.arange(seq_len, device=in_idx.device)
+    if position_ids is not None:
+      # Packed rows (b, seq_len): the positions restart on every document, which only attends to itself
+      positions = position_ids
+      if attn_mask is None:
+        attn_mask = document_mask(position_ids)
+    elif torch.is_tensor(pos_offset):
+      # One offset per row (left padded batches), padding tokens are clamped to position 0
+      positions = (pos_offset.unsqueeze(1) + positions).clamp(min=0)
+    else:
+      positions = positions + pos_offset
+    pos_embeds = self.pos_emb(positions)
     x = tok_embeds + pos_embeds
     # Regularization
     x = self.drop_emb(x)
     # Transformer blocks 
-    x = self.trf_blocks(x)
+    for layer_idx, block in enumerate(self.trf_blocks):
+      if self.activation_checkpointing and self.training and kv_cache is None:
+        x = checkpoint(block, x, None, layer_idx, attn_mask, use_reentrant=False)
+      else:
+        x = block(x, kv_cache=kv_cache, layer_idx=layer_idx, attn_mask=attn_mask)
+    # Only the positions that are used go through final_norm and out_head
+    if isinstance(output_positions, str) and output_positions == "last":
+      x = x[:, -1:, :]
+    elif output_positions is not None:
+      indices = output_positions if output_positions.dim() == 2 else output_positions.unsqueeze(1)
+      x = x.gather(1, indices.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
     # MLP
     x = self.final_norm(x)
+    if return_hidden:
+      return x
     # Logits for the next token prediction
     logits = self.out_head(x)
     return logits
@@ -188,6 +348,120 @@ class GPTModel(nn.Module):
 
 
 
+# Model configuration of the GPT-2 sizes
+GPT_CONFIG_124M = {
+    "vocab_size": 50257,    # Vocabulary size
+    "context_length": 1024, # context 
+    "emb_dim": 768,         # Embedding dimension
+    "n_heads": 12,          # Number of attention heads
+    "n_layers": 12,         # Number of layers
+    "drop_rate": 0.1,       # Dropout rate
+    "qkv_bias": False       # Query-key-value bias
+}
+
+model_configs = {
+    "gpt2-small (124M)": {"emb_dim": 768, "n_layers": 12, "n_heads": 12},
+    "gpt2-medium (355M)": {"emb_dim": 1024, "n_layers": 24, "n_heads": 16},
+    "gpt2-large (774M)": {"emb_dim": 1280, "n_layers": 36, "n_heads": 20},
+    "gpt2-xl (1558M)": {"emb_dim": 1600, "n_layers": 48, "n_heads": 25},
+}
+
+
+
+def get_model_config(model_name="gpt2-small (124M)", **overrides):
+	config = GPT_CONFIG_124M.copy()
+	config.update(model_configs[model_name])
+	config.update(overrides)
+	return config
+
+
+
+
+"""
+  KVCache
+    Keys and values of every transformer block for the tokens already processed,
+    so that the next forward pass only has to run over the new tokens.
+    The buffers are allocated on the first update with room for max_length tokens.
+"""
+class KVCache:
+	def __init__(self, n_layers, max_length):
+		self.max_length = max_length
+		self.keys = [None] * n_layers
+		self.values = [None] * n_layers
+		self.lengths = [0] * n_layers
+
+	# Number of cached tokens
+	def __len__(self):
+		return self.lengths[0]
+
+	def update(self, layer_idx, keys, values):
+		b, num_heads, num_tokens, head_dim = keys.shape
+		start = self.lengths[layer_idx]
+		end = start + num_tokens
+		if end > self.max_length:
+			raise ValueError(f"KV cache overflow: {end} tokens, max_length is {self.max_length}")
+		if self.keys[layer_idx] is None:
+			shape = (b, num_heads, self.max_length, head_dim)
+			self.keys[layer_idx] = keys.new_empty(shape)
+			self.values[layer_idx] = values.new_empty(shape)
+		self.keys[layer_idx][:, :, start:end] = keys
+		self.values[layer_idx][:, :, start:end] = values
+		self.lengths[layer_idx] = end
+		return self.keys[layer_idx][:, :, :end], self.values[layer_idx][:, :, :end]
+
+	def reset(self):
+		self.lengths = [0] * len(self.lengths)
+
+	# Start from precomputed keys/values, one (b, num_heads, num_tokens, head_dim) tensor per layer (see prefix_cache.py)
+	def load(self, keys, values):
+		self.reset()
+		for layer_idx, (layer_keys, layer_values) in enumerate(zip(keys, values)):
+			self.update(layer_idx, layer_keys, layer_values)
+
+	# Keep only the given batch rows (used to drop finished sequences)
+	def select(self, rows):
+		for i in range(len(self.keys)):
+			if self.keys[i] is not None:
+				self.keys[i] = self.keys[i][rows]
+				self.values[i] = self.values[i][rows]
+
+	# Add the rows of another cache, both are right aligned so every row ends on the last cached token
+	def append(self, other):
+		length = max(len(self), len(other))
+		for i in range(len(self.keys)):
+			self.keys[i] = torch.cat((
+				self._right_align(self.keys[i], len(self), length),
+				self._right_align(other.keys[i], len(other), length)
+			))
+			self.values[i] = torch.cat((
+				self._right_align(self.values[i], len(self), length),
+				self._right_align(other.values[i], len(other), length)
+			))
+		self.lengths = [length] * len(self.lengths)
+
+	# Drop the first num_tokens cached tokens (e.g. columns that are padding for every row)
+	def trim(self, num_tokens):
+		for i in range(len(self.keys)):
+			end = self.lengths[i]
+			if self.keys[i] is not None:
+				self.keys[i][:, :, :end - num_tokens] = self.keys[i][:, :, num_tokens:end].clone()
+				self.values[i][:, :, :end - num_tokens] = self.values[i][:, :, num_tokens:end].clone()
+			self.lengths[i] = end - num_tokens
+
+	# Keep only the first length cached tokens (e.g. the rejected tokens of speculative decoding)
+	def truncate(self, length):
+		self.lengths = [min(cached, length) for cached in self.lengths]
+
+	def _right_align(self, buffer, length, new_length):
+		if length == new_length:
+			return buffer
+		aligned = torch.zeros_like(buffer)
+		aligned[:, :, new_length - length:new_length] = buffer[:, :, :length]
+		return aligned
+
+
+
+
 class GPTDataset(Dataset):
 	def __init__(self, txt, tokenizer, max_length, stride):
 		self.input_ids = []
@@ -212,6 +486,44 @@ class GPTDataset(Dataset):
 
 
 
+"""
+  GPTShardDataset
+    Same windows as GPTDataset, read from the uint16 token shards written by tokenize_corpus.py.
+    The shards are memory mapped (opened lazily, so DataLoader workers share the page cache
+    instead of pickling the tokens) and every window is sliced on __getitem__.
+    Windows don't cross shard boundaries.
+"""
+class GPTShardDataset(Dataset):
+	def __init__(self, shards, max_length, stride):
+		if isinstance(shards, (str, os.PathLike)):
+			shards = sorted(os.path.join(shards, name) for name in os.listdir(shards) if name.endswith(".bin"))
+		self.shard_paths = list(shards)
+		self.max_length = max_length
+		self.stride = stride
+		self.shards = None
+		# First window index of each shard
+		self.offsets = [0]
+		for path in self.shard_paths:
+			num_tokens = os.path.getsize(path) // np.dtype(np.uint16).itemsize
+			num_windows = max(0, -(-(num_tokens - max_length) // stride))
+			self.offsets.append(self.offsets[-1] + num_windows)
+
+	def __len__(self):
+		return self.offsets[-1]
+
+	def __getitem__(self, idx):
+		if self.shards is None:
+			self.shards = [np.memmap(path, dtype=np.uint16, mode="r") for path in self.shard_paths]
+		if idx < 0:
+			idx += len(self)
+		shard = bisect.bisect_right(self.offsets, idx) - 1
+		start = (idx - self.offsets[shard]) * self.stride
+		window = torch.from_numpy(self.shards[shard][start: start + self.max_length + 1].astype(np.int64))
+		return window[:-1], window[1:]
+
+
+
+
 """
 Downloads the data sample 'the-veredict', use as a small training dataset 
 """
@@ -244,11 +556,15 @@ def train_test_split(text_data, train_ratio=0.9):
 
 
 
-def create_data_loader(txt, batch_size=6, max_length=256, stride=256, shuffle=True, drop_last=True, num_workers=0):
-	# Tokenizer use on GPT2
-  tokenizer = tiktoken.get_encoding("gpt2")
-	# From text to dataloader
-  dataset = GPTDataset(txt, tokenizer, max_length, stride)
+def create_data_loader(txt, batch_size=6, max_length=256, stride=256, shuffle=True, drop_last=True, num_workers=0, token_shards=None):
+  if token_shards is not None:
+    # Pre-tokenized corpus (tokenize_corpus.py), txt is not used
+    dataset = GPTShardDataset(token_shards, max_length, stride)
+  else:
+    # Tokenizer use on GPT2
+    tokenizer = create_tokenizer()
+    # From text to dataloader
+    dataset = GPTDataset(txt, tokenizer, max_length, stride)
   dataloader = DataLoader(
     dataset,
     batch_size=batch_size,
@@ -261,43 +577,230 @@ def create_data_loader(txt, batch_size=6, max_length=256, stride=256, shuffle=Tr
 
 
 
+# Shared by the whole process, with a cache of the encoded strings (tokenization.py)
 def create_tokenizer():
-  return tiktoken.get_encoding("gpt2")
+  return get_tokenizer("gpt2")
+
+
 
 
 
+def sample_next_token(logits, temperature=0.0, top_k=None):
+	# Only take into account the top K words on the next word selection
+	if top_k is not None:
+		top_logits, _ = torch.topk(logits, top_k)
+		min_val = top_logits[:, -1:]
+		logits = logits.masked_fill(logits < min_val, float('-inf'))
+	# Modify the final distribution with the temp
+	if temperature > 0.0:
+		logits = logits / temperature
+		probs = torch.softmax(logits, dim=-1)
+		idx_next = torch.multinomial(probs, num_samples=1)
+	else: 
+		idx_next = torch.argmax(logits, dim=-1, keepdim=True)
+	return idx_next
 
 
-def text_generation(model, idx, num_token_generation, context_size, temperature=0.0, top_k=None, eos_id=None):
+
+"""
+  generate_token_ids
+    Yields the next token ids (b, 1) one step at a time. With use_cache=True only the newest token
+    is processed on each step, reusing the keys/values of the previous ones. Once the cache holds
+    context_size tokens the window slides, so the cache is rebuilt from the last context_size tokens
+    (same result as without cache). With a prefix_cache (prefix_cache.PrefixCache, one sequence) the
+    prompt prefill starts from the keys/values of its longest prefix seen before. A sampler
+    (sampling.Sampler, per-row top_p, penalties, seeds) replaces temperature/top_k.
+"""
+def generate_token_ids(model, idx, num_token_generation, context_size, temperature=0.0, top_k=None, use_cache=False, precision=None, prefix_cache=None, sampler=None):
+	kv_cache = KVCache(len(model.trf_blocks), context_size) if use_cache or prefix_cache is not None else None
+	if prefix_cache is not None and idx.shape[0] != 1:
+		raise ValueError("prefix_cache only works with one sequence")
 	for _ in range(num_token_generation):
-		idx_cond = idx[:, -context_size:]
-		with torch.no_grad():
+		with torch.no_grad(), autocast_context(idx.device, precision):
 			# Generate the next tokens
-			logits = model(idx_cond)
-		logits = logits[:, -1, :]
-		# Only take into account the top K words on the next word selection
-		if top_k is not None:
-			top_logits, _ = torch.topk(logits, top_k)
-			min_val = top_logits[:, -1]
-			logits = torch.where(
-				logits < min_val,
-				torch.tensor(float('-inf')).to(logits.device),
-				logits
-			)
-		# Modify the final distribution with the temp
-		if temperature > 0.0:
-			logits = logits / temperature
-			probs = torch.softmax(logits, dim=-1)
-			idx_next = torch.multinomial(probs, num_samples=1)
-		else: 
-			idx_next = torch.argmax(logits, dim=-1, keepdim=True)
-		if idx_next == eos_id:
+			if kv_cache is None:
+				logits = model(idx[:, -context_size:], output_positions="last")
+			elif len(kv_cache) == 0 and prefix_cache is not None:
+				# Prefill from the keys/values of the longest cached prefix (prefix_cache.PrefixCache)
+				token_ids = idx[0, -context_size:].tolist()
+				num_cached = prefix_cache.load(token_ids[:-1], kv_cache)
+				logits = model(idx[:, idx.shape[1] - len(token_ids) + num_cached:], kv_cache=kv_cache, output_positions="last")
+				prefix_cache.insert(token_ids, kv_cache)
+			elif len(kv_cache) == 0 or len(kv_cache) >= context_size:
+				# Prefill, or sliding-window fallback once the cache is full
+				kv_cache.reset()
+				logits = model(idx[:, -context_size:], kv_cache=kv_cache, output_positions="last")
+			else:
+				logits = model(idx[:, -1:], kv_cache=kv_cache)
+		if sampler is None:
+			idx_next = sample_next_token(logits[:, -1, :].float(), temperature, top_k)
+		else:
+			idx_next = sampler(logits[:, -1, :])
+		idx = torch.cat((idx, idx_next), dim=1)
+		yield idx_next
+
+
+
+def text_generation(model, idx, num_token_generation, context_size, temperature=0.0, top_k=None, eos_id=None, use_cache=False, precision=None, prefix_cache=None, sampler=None):
+	for idx_next in generate_token_ids(model, idx, num_token_generation, context_size, temperature, top_k, use_cache, precision, prefix_cache, sampler):
+		# Batches only stop once every sequence produced the eos token, see batch_text_generation
+		if eos_id is not None and (idx_next == eos_id).all():
 			break
 		idx = torch.cat((idx, idx_next), dim=1)
 	return idx
 
 
 
+"""
+  IncrementalDetokenizer
+    Turns the generated token ids into text as they arrive. A character split over several BPE tokens
+    (multi-byte UTF-8) is only released once complete, and the text that could be the beginning of a
+    stop string is held back until it's known. stopped is True once a stop string was produced (it
+    is not part of the text).
+"""
+class IncrementalDetokenizer:
+	def __init__(self, tokenizer, stop_strings=None):
+		self.tokenizer = tokenizer
+		self.stop_strings = [stop for stop in (stop_strings or []) if stop]
+		self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+		self.pending = ""
+		self.stopped = False
+
+	# New text released by this token
+	def push(self, token_id):
+		if self.stopped:
+			return ""
+		if hasattr(self.tokenizer, "decode_single_token_bytes"):
+			token_bytes = self.tokenizer.decode_single_token_bytes(token_id)
+		else:
+			token_bytes = self.tokenizer.decode([token_id]).encode("utf-8")
+		self.pending += self.decoder.decode(token_bytes)
+		return self._release(final=False)
+
+	# The rest of the text once the generation ended
+	def flush(self):
+		if self.stopped:
+			return ""
+		self.pending += self.decoder.decode(b"", final=True)
+		return self._release(final=True)
+
+	def _release(self, final):
+		stops = [self.pending.find(stop) for stop in self.stop_strings]
+		stops = [index for index in stops if index != -1]
+		if stops:
+			text, self.pending, self.stopped = self.pending[:min(stops)], "", True
+			return text
+		keep = 0
+		if not final:
+			# Longest end of the text that is the beginning of a stop string
+			for stop in self.stop_strings:
+				for length in range(min(len(stop) - 1, len(self.pending)), keep, -1):
+					if self.pending.endswith(stop[:length]):
+						keep = length
+						break
+		text, self.pending = self.pending[:len(self.pending) - keep], self.pending[len(self.pending) - keep:]
+		return text
+
+
+
+"""
+  stream_text_generation
+    text_generation for one sequence (idx of shape (1, num_tokens)) that yields the text as it is
+    generated. Stops on eos_id, on any of stop_strings (not included in the text) or once
+    cancel_event (threading.Event) is set. Closing the generator also stops the generation.
+"""
+def stream_text_generation(model, idx, num_token_generation, context_size, tokenizer, temperature=0.0, top_k=None, eos_id=None,
+		stop_strings=None, use_cache=True, precision=None, cancel_event=None, prefix_cache=None, sampler=None):
+	detokenizer = IncrementalDetokenizer(tokenizer, stop_strings)
+	for idx_next in generate_token_ids(model, idx, num_token_generation, context_size, temperature, top_k, use_cache, precision, prefix_cache, sampler):
+		if cancel_event is not None and cancel_event.is_set():
+			return
+		token_id = idx_next.item()
+		if token_id == eos_id:
+			break
+		text = detokenizer.push(token_id)
+		if text:
+			yield text
+		if detokenizer.stopped:
+			return
+	text = detokenizer.flush()
+	if text:
+		yield text
+
+
+
+# Async iterator over stream_text_generation, every step runs on a worker thread. Stops the
+# generation when the consumer stops iterating (e.g. the client disconnected).
+async def astream_text_generation(model, idx, num_token_generation, context_size, tokenizer, **kwargs):
+	loop = asyncio.get_running_loop()
+	cancel_event = threading.Event()
+	generator = stream_text_generation(model, idx, num_token_generation, context_size, tokenizer, cancel_event=cancel_event, **kwargs)
+	end = object()
+	try:
+		while (text := await loop.run_in_executor(None, next, generator, end)) is not end:
+			yield text
+	finally:
+		cancel_event.set()
+		if not generator.gi_running:
+			generator.close()
+
+
+
+"""
+  batch_text_generation
+    Generate the continuation of several prompts at once. The prompts are left padded and
+    the padding is masked out in the attention, each sequence stops on its own eos_id and
+    finished sequences are removed from the batch. Returns one decoded text per prompt.
+"""
+def batch_text_generation(model, prompts, tokenizer, num_token_generation, context_size, temperature=0.0, top_k=None, eos_id=None, pad_token_id=50256, use_cache=True, precision=None):
+	device = next(model.parameters()).device
+	# Left padding, so the next token of every sequence is on the last column
+	idx, mask = encode_batch(prompts, tokenizer, pad_token_id, padding_side="left", device=device)
+
+	outputs = [None] * len(prompts)
+	rows = list(range(len(prompts)))		# Prompt of each row still in the batch
+	kv_cache = KVCache(len(model.trf_blocks), context_size) if use_cache else None
+	for _ in range(num_token_generation):
+		with torch.no_grad(), autocast_context(device, precision):
+			if kv_cache is None or len(kv_cache) == 0 or len(kv_cache) >= context_size:
+				idx_cond, mask_cond = idx[:, -context_size:], mask[:, -context_size:]
+				# Real tokens start at position 0 after the padding
+				pos_offset = mask_cond.sum(dim=1) - mask_cond.shape[1]
+				if kv_cache is not None:
+					kv_cache.reset()
+				logits = model(idx_cond, kv_cache=kv_cache, pos_offset=pos_offset, attn_mask=mask_cond, output_positions="last")
+			else:
+				mask_cond = mask[:, -(len(kv_cache) + 1):]
+				pos_offset = mask_cond[:, :-1].sum(dim=1)
+				logits = model(idx[:, -1:], kv_cache=kv_cache, pos_offset=pos_offset, attn_mask=mask_cond)
+		idx_next = sample_next_token(logits[:, -1, :].float(), temperature, top_k)
+		idx = torch.cat((idx, idx_next), dim=1)
+		mask = torch.cat((mask, torch.ones_like(idx_next, dtype=torch.bool)), dim=1)
+
+		if eos_id is None:
+			continue
+		finished = idx_next.squeeze(1) == eos_id
+		if finished.any():
+			# The eos token is not part of the output, same as text_generation
+			for i in finished.nonzero().flatten().tolist():
+				outputs[rows[i]] = idx[i, :-1][mask[i, :-1]]
+			keep = ~finished
+			if not keep.any():
+				break
+			idx, mask = idx[keep], mask[keep]
+			rows = [row for row, k in zip(rows, keep.tolist()) if k]
+			if kv_cache is not None:
+				kv_cache.select(keep)
+
+	# Sequences that reached num_token_generation
+	for i, row in enumerate(rows):
+		if outputs[row] is None:
+			outputs[row] = idx[i][mask[i]]
+
+	return tokenizer.decode_batch([token_ids.tolist() for token_ids in outputs])
+
+
+
 #  ===== Text Manipulation =====
 def text_to_token_ids(text, tokenizer):
     encoded = tokenizer.encode(text, allowed_special={'<|endoftext|>'})
@@ -314,13 +817,24 @@ def token_ids_to_text(token_ids, tokenizer):
 
 # ================================================== Training ==================================================
 def calc_loss_batch(input_batch, target_batch, model, device):
-	input_batch, target_batch = input_batch.to(device), target_batch.to(device)
-	logits = model(input_batch)
-	loss = torch.nn.functional.cross_entropy(logits.flatten(0, 1), target_batch.flatten())
+	target_batch = target_batch.to(device)
+	if isinstance(input_batch, dict):
+		# Packed rows (GPTA.PackedInstructionDataset), several examples per row
+		logits = model(input_batch["input_ids"].to(device), position_ids=input_batch["position_ids"].to(device))
+	else:
+		logits = model(input_batch.to(device))
+	loss = torch.nn.functional.cross_entropy(logits.flatten(0, 1).float(), target_batch.flatten())
 	return loss
 
 
 
+def batch_num_tokens(input_batch):
+	if isinstance(input_batch, dict):
+		input_batch = input_batch["input_ids"]
+	return input_batch.numel()
+
+
+
 def calc_loss_loader(data_loader, model, device, num_batches=None):
 	total_loss = 0.
 	if(len(data_loader) == 0):
@@ -339,9 +853,9 @@ def calc_loss_loader(data_loader, model, device, num_batches=None):
 
 
 
-def evaluate_model(model, train_loader, val_loader, device, eval_iter):
+def evaluate_model(model, train_loader, val_loader, device, eval_iter, precision=None):
 	model.eval()
-	with torch.no_grad():
+	with torch.no_grad(), autocast_context(device, precision):
 		train_loss = calc_loss_loader(train_loader, model, device, num_batches=eval_iter)
 		val_loss = calc_loss_loader(val_loader, model, device, num_batches=eval_iter)
 	model.train()
@@ -349,9 +863,9 @@ def evaluate_model(model, train_loader, val_loader, device, eval_iter):
 
 
 
-def generate_and_print_sample(model, tokenizer, device, start_context):
+def generate_and_print_sample(model, tokenizer, device, start_context, precision=None):
 	model.eval()
-	context_size = model.pos_emb.weight.shape[0]
+	context_size = model.pos_emb.num_embeddings
 	encoded = text_to_token_ids(start_context, tokenizer).to(device)
 	with torch.no_grad():
 		token_ids = text_generation(
@@ -360,7 +874,9 @@ def generate_and_print_sample(model, tokenizer, device, start_context):
 				num_token_generation=40, 
 				context_size=context_size,
 				top_k=40,
-				temperature=1
+				temperature=1,
+				use_cache=True,
+				precision=precision
 		)
 	decoded_text = token_ids_to_text(token_ids, tokenizer)
 	print("Text Generation Sample")
@@ -369,35 +885,245 @@ def generate_and_print_sample(model, tokenizer, device, start_context):
 
 
 
-def train_model_simple(model, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter, start_context, tokenizer):
-	train_losses, val_losses, track_tokens_seen = [], [], []
-	tokens_seen, global_step = 0, -1
+"""
+  TrainingSession(model, optimizer, progress, scheduler, checkpoint_dir, checkpoint_freq, keep_last, profiler, write_checkpoints)
+    What the training loops share. progress holds the counters and histories of the loop (with
+    global_step), it is restored from the latest checkpoint of checkpoint_dir and saved with every
+    checkpoint (checkpoint.TrainingCheckpointer). batches goes over what is left of the epoch and,
+    with a profiler (instrumentation.Profiler), times the wait for every batch. span and count do
+    nothing without one. write_checkpoints=False resumes and tracks the position without saving
+    (the processes other than rank 0 of distributed.train_model_distributed).
+"""
+class TrainingSession:
+	def __init__(self, model, optimizer, progress, scheduler=None, checkpoint_dir=None, checkpoint_freq=100, keep_last=3, profiler=None,
+			write_checkpoints=True):
+		self.model = model
+		self.optimizer = optimizer
+		self.scheduler = scheduler
+		self.progress = progress
+		self.checkpoint_freq = checkpoint_freq
+		self.profiler = profiler
+		self.write_checkpoints = write_checkpoints
+		self.checkpointer = None
+		if checkpoint_dir is not None:
+			from checkpoint import TrainingCheckpointer
+			self.checkpointer = TrainingCheckpointer(checkpoint_dir, keep_last)
+			saved = self.checkpointer.resume(model, optimizer, scheduler)
+			if saved is not None:
+				progress.update(saved)
+
+	def span(self, name):
+		return self.profiler.span(name) if self.profiler is not None else nullcontext()
+
+	def epochs(self, num_epochs):
+		return range(self.checkpointer.epoch if self.checkpointer else 0, num_epochs)
+
+	def batches(self, data_loader, epoch):
+		batches = self.checkpointer.batches(data_loader, epoch) if self.checkpointer else enumerate(data_loader)
+		if self.profiler is not None:
+			batches = self.profiler.iterate(batches, "train/dataloader_wait")
+		return batches
+
+	def count(self, name, value=1):
+		if self.profiler is not None:
+			self.profiler.count(name, value)
+
+	# After every optimizer step: checkpoint every checkpoint_freq steps
+	def step_done(self):
+		if self.checkpointer is not None and self.progress["global_step"] % self.checkpoint_freq == 0:
+			self.save()
+
+	def save(self, epoch=None):
+		if self.write_checkpoints:
+			self.checkpointer.save(self.model, self.optimizer, self.scheduler, epoch=epoch, **self.progress)
+
+	# End of the training: saved as the start of num_epochs, a run started again has nothing left to do
+	def close(self, num_epochs):
+		if self.checkpointer is not None:
+			self.save(epoch=num_epochs)
+			self.checkpointer.close()
 
-	# Main training loop
-	for epoch in range(num_epochs):
-		for input_batch, target_batch in train_loader:
-			optimizer.zero_grad() # Reset loss gradients from previous batch iteration
-			loss = calc_loss_batch(input_batch, target_batch, model, device)
-			loss.backward() # Calculate loss gradients
-			optimizer.step() # Update model weights using loss gradients
-			tokens_seen += input_batch.numel()
-			global_step += 1
 
-			if global_step % eval_freq == 0:
-				train_loss, val_loss = evaluate_model(model, train_loader, val_loader, device, eval_iter)
+
+"""
+  train_model_simple
+    precision="bf16" runs the forward passes under bfloat16 autocast (see autocast_context).
+    checkpoint_dir saves a checkpoint every checkpoint_freq steps and at the end (keeps the last
+    keep_last), a run started again with the same checkpoint_dir resumes from the latest one
+    (see TrainingSession). profiler (instrumentation.Profiler) times the wait for
+    the batches, the forward/backward, the optimizer step and the evaluation.
+"""
+def train_model_simple(model, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter, start_context, tokenizer, precision=None,
+		checkpoint_dir=None, checkpoint_freq=100, keep_last=3, profiler=None):
+	# Checkpoints, resume and profiling (TrainingSession)
+	session = TrainingSession(model, optimizer,
+		{"train_losses": [], "val_losses": [], "track_tokens_seen": [], "tokens_seen": 0, "global_step": -1},
+		checkpoint_dir=checkpoint_dir, checkpoint_freq=checkpoint_freq, keep_last=keep_last, profiler=profiler)
+	progress, span = session.progress, session.span
+	train_losses, val_losses, track_tokens_seen = progress["train_losses"], progress["val_losses"], progress["track_tokens_seen"]
+
+	# Main training loop
+	for epoch in session.epochs(num_epochs):
+		for batch_idx, (input_batch, target_batch) in session.batches(train_loader, epoch):
+			with span("train/compute"):
+				optimizer.zero_grad() # Reset loss gradients from previous batch iteration
+				with autocast_context(device, precision):
+					loss = calc_loss_batch(input_batch, target_batch, model, device)
+				loss.backward() # Calculate loss gradients
+			with span("train/optimizer_step"):
+				optimizer.step() # Update model weights using loss gradients
+			progress["tokens_seen"] += batch_num_tokens(input_batch)
+			progress["global_step"] += 1
+			session.count("train_tokens", batch_num_tokens(input_batch))
+
+			if progress["global_step"] % eval_freq == 0:
+				with span("train/evaluate"):
+					train_loss, val_loss = evaluate_model(model, train_loader, val_loader, device, eval_iter, precision)
 				train_losses.append(train_loss)
 				val_losses.append(val_loss)
-				track_tokens_seen.append(tokens_seen)
-				print(f"Ep {epoch+1} (Step {global_step:06d}): "
+				track_tokens_seen.append(progress["tokens_seen"])
+				print(f"Ep {epoch+1} (Step {progress['global_step']:06d}): "
               f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}")
+
+			session.step_done()
 		
 		# Generate a sample text for each epoch
-		generate_and_print_sample(model, tokenizer, device, start_context)
-		
+		generate_and_print_sample(model, tokenizer, device, start_context, precision)
+
+	session.close(num_epochs)
 	return train_losses, val_losses, track_tokens_seen
 
 
 
+"""
+  warmup_cosine_schedule
+    Linear warmup to the learning rate of the optimizer, then cosine decay down to min_lr_ratio * lr.
+"""
+def warmup_cosine_schedule(optimizer, warmup_steps, total_steps, min_lr_ratio=0.1):
+	def lr_factor(step):
+		if step < warmup_steps:
+			return (step + 1) / warmup_steps
+		progress = min(1.0, (step - warmup_steps) / max(1, total_steps - warmup_steps))
+		return min_lr_ratio + (1 - min_lr_ratio) * 0.5 * (1 + math.cos(math.pi * progress))
+	return torch.optim.lr_scheduler.LambdaLR(optimizer, lr_factor)
+
+
+
+"""
+  train_model
+    train_model_simple with the options needed for the larger configurations:
+      grad_accum_steps         optimizer step every grad_accum_steps batches (effective batch size)
+      activation_checkpointing recompute the trf_blocks activations on the backward pass (None keeps cfg["activation_checkpointing"])
+      compile                  torch.compile the model for the training steps
+      max_grad_norm            gradient clipping
+      warmup_steps/min_lr_ratio warmup + cosine learning rate schedule (see warmup_cosine_schedule)
+      checkpoint_dir           resumable checkpoints, as in train_model_simple (also saves the schedule)
+      profiler                 instrumentation.Profiler, as in train_model_simple
+    Also returns the step time, tokens/sec and learning rate of every optimizer step.
+"""
+def train_model(model, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter, start_context, tokenizer,
+		grad_accum_steps=1, activation_checkpointing=None, compile=False, max_grad_norm=1.0, warmup_steps=0, min_lr_ratio=0.1, precision=None,
+		checkpoint_dir=None, checkpoint_freq=100, keep_last=3, profiler=None):
+	if activation_checkpointing is not None:
+		model.activation_checkpointing = activation_checkpointing
+	train_forward = torch.compile(model) if compile else model
+	num_batches = len(train_loader)
+	steps_per_epoch = math.ceil(num_batches / grad_accum_steps)
+	scheduler = warmup_cosine_schedule(optimizer, warmup_steps, num_epochs * steps_per_epoch, min_lr_ratio)
+
+	# Checkpoints (also of the schedule), resume and profiling, as in train_model_simple
+	session = TrainingSession(model, optimizer,
+		{"train_losses": [], "val_losses": [], "track_tokens_seen": [], "tokens_seen": 0, "global_step": -1,
+		 "metrics": {"step_time": [], "tokens_per_sec": [], "lr": []}},
+		scheduler, checkpoint_dir, checkpoint_freq, keep_last, profiler)
+	progress, span = session.progress, session.span
+	train_losses, val_losses, track_tokens_seen = progress["train_losses"], progress["val_losses"], progress["track_tokens_seen"]
+	metrics = progress["metrics"]
+
+	# Main training loop
+	for epoch in session.epochs(num_epochs):
+		optimizer.zero_grad()
+		step_start, step_tokens = time.perf_counter(), 0
+		for batch_idx, (input_batch, target_batch) in session.batches(train_loader, epoch):
+			# The last accumulation of the epoch can have fewer batches
+			group_start = batch_idx - batch_idx % grad_accum_steps
+			group_size = min(grad_accum_steps, num_batches - group_start)
+			with span("train/compute"):
+				with autocast_context(device, precision):
+					loss = calc_loss_batch(input_batch, target_batch, train_forward, device) / group_size
+				loss.backward()
+			step_tokens += batch_num_tokens(input_batch)
+			session.count("train_tokens", batch_num_tokens(input_batch))
+			if batch_idx + 1 < group_start + group_size:
+				continue
+
+			with span("train/optimizer_step"):
+				if max_grad_norm is not None:
+					torch.nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm)
+				metrics["lr"].append(optimizer.param_groups[0]["lr"])
+				optimizer.step()
+				scheduler.step()
+				optimizer.zero_grad()
+			progress["tokens_seen"] += step_tokens
+			progress["global_step"] += 1
+
+			step_time = time.perf_counter() - step_start
+			metrics["step_time"].append(step_time)
+			metrics["tokens_per_sec"].append(step_tokens / step_time)
+
+			if progress["global_step"] % eval_freq == 0:
+				with span("train/evaluate"):
+					train_loss, val_loss = evaluate_model(model, train_loader, val_loader, device, eval_iter, precision)
+				train_losses.append(train_loss)
+				val_losses.append(val_loss)
+				track_tokens_seen.append(progress["tokens_seen"])
+				print(f"Ep {epoch+1} (Step {progress['global_step']:06d}): "
+              f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}, "
+              f"Lr {metrics['lr'][-1]:.2e}, {step_time*1000:.0f} ms/step, {metrics['tokens_per_sec'][-1]:.0f} tokens/sec")
+
+			session.step_done()
+			step_start, step_tokens = time.perf_counter(), 0
+
+		# Generate a sample text for each epoch
+		generate_and_print_sample(model, tokenizer, device, start_context, precision)
+
+	session.close(num_epochs)
+	return train_losses, val_losses, track_tokens_seen, metrics
+
+
+
+
+
+"""
+  autocast_context
+    precision="bf16" runs the matmuls in bfloat16 with torch.autocast (LayerNorm and the
+    attention softmax stay in float32). None or "fp32" keeps everything in float32.
+"""
+def autocast_context(device, precision=None):
+	if precision not in (None, "fp32", "bf16"):
+		raise ValueError(f"Unknown precision {precision}, use 'fp32' or 'bf16'")
+	if precision != "bf16":
+		# Not torch.autocast(enabled=False): it raises for devices without autocast (mps before torch 2.5)
+		return nullcontext()
+	return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+
+
+"""
+  save_model
+    Save the state_dict, with dtype=torch.bfloat16 (or float16) the floating point tensors are
+    stored in half precision. load_state_dict casts them back to the dtype of the model.
+"""
+def save_model(model, file_path, dtype=None):
+	state_dict = model.state_dict()
+	if dtype is not None:
+		state_dict = {
+			name: tensor.to(dtype) if tensor.is_floating_point() else tensor
+			for name, tensor in state_dict.items()
+		}
+	torch.save(state_dict, file_path)
+
+
 
 
 def get_device():
@@ -416,75 +1142,98 @@ def get_device():
 """
   Load weights of a already pre-trained model into the current architecture 
   of this GPT library 
+    The weights are copied in place into the existing parameters (no new Parameter objects, so
+    optimizers and hooks keep working) straight from the numpy arrays: the transposes and the
+    q/k/v split are views, nothing is allocated on the way. Returns the load time, rss_delta_mb the
+    change of the resident memory of the process over the load (the parameters and params already
+    exist, so it should stay near 0) and numpy_peak_mb the peak of the numpy/Python allocations made
+    during the load (tracemalloc, which doesn't see the allocations of torch).
 """
-def load_weights_into_gpt(gpt, params):          
-    gpt.pos_emb.weight = assign(gpt.pos_emb.weight, params['wpe'])
-    gpt.tok_emb.weight = assign(gpt.tok_emb.weight, params['wte'])
-
-    for b in range(len(params["blocks"])):   
-        q_w, k_w, v_w = np.split(                           
-            (params["blocks"][b]["attn"]["c_attn"])["w"], 3, axis=-1)
-        gpt.trf_blocks[b].att.W_query.weight = assign(
-            gpt.trf_blocks[b].att.W_query.weight, q_w.T)
-        gpt.trf_blocks[b].att.W_key.weight = assign(
-            gpt.trf_blocks[b].att.W_key.weight, k_w.T)
-        gpt.trf_blocks[b].att.W_value.weight = assign(
-            gpt.trf_blocks[b].att.W_value.weight, v_w.T)
-
-        q_b, k_b, v_b = np.split(
-            (params["blocks"][b]["attn"]["c_attn"])["b"], 3, axis=-1)
-        gpt.trf_blocks[b].att.W_query.bias = assign(
-            gpt.trf_blocks[b].att.W_query.bias, q_b)
-        gpt.trf_blocks[b].att.W_key.bias = assign(
-            gpt.trf_blocks[b].att.W_key.bias, k_b)
-        gpt.trf_blocks[b].att.W_value.bias = assign(
-            gpt.trf_blocks[b].att.W_value.bias, v_b)
-
-        gpt.trf_blocks[b].att.out_proj.weight = assign(
-            gpt.trf_blocks[b].att.out_proj.weight, 
-            params["blocks"][b]["attn"]["c_proj"]["w"].T)
-        gpt.trf_blocks[b].att.out_proj.bias = assign(
-            gpt.trf_blocks[b].att.out_proj.bias, 
-            params["blocks"][b]["attn"]["c_proj"]["b"])
-
-        gpt.trf_blocks[b].ff.layers[0].weight = assign(
-            gpt.trf_blocks[b].ff.layers[0].weight, 
-            params["blocks"][b]["mlp"]["c_fc"]["w"].T)
-        gpt.trf_blocks[b].ff.layers[0].bias = assign(
-            gpt.trf_blocks[b].ff.layers[0].bias, 
-            params["blocks"][b]["mlp"]["c_fc"]["b"])
-        gpt.trf_blocks[b].ff.layers[2].weight = assign(
-            gpt.trf_blocks[b].ff.layers[2].weight, 
-            params["blocks"][b]["mlp"]["c_proj"]["w"].T)
-        gpt.trf_blocks[b].ff.layers[2].bias = assign(
-            gpt.trf_blocks[b].ff.layers[2].bias, 
-            params["blocks"][b]["mlp"]["c_proj"]["b"])
-
-        gpt.trf_blocks[b].norm1.scale = assign(
-            gpt.trf_blocks[b].norm1.scale, 
-            params["blocks"][b]["ln_1"]["g"])
-        gpt.trf_blocks[b].norm1.shift = assign(
-            gpt.trf_blocks[b].norm1.shift, 
-            params["blocks"][b]["ln_1"]["b"])
-        gpt.trf_blocks[b].norm2.scale = assign(
-            gpt.trf_blocks[b].norm2.scale, 
-            params["blocks"][b]["ln_2"]["g"])
-        gpt.trf_blocks[b].norm2.shift = assign(
-            gpt.trf_blocks[b].norm2.shift, 
-            params["blocks"][b]["ln_2"]["b"])
-
-    gpt.final_norm.scale = assign(gpt.final_norm.scale, params["g"])
-    gpt.final_norm.shift = assign(gpt.final_norm.shift, params["b"])
-    gpt.out_head.weight = assign(gpt.out_head.weight, params["wte"])
-
-
-
-def assign(left, right):
+def load_weights_into_gpt(gpt, params, verbose=False):
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    traced_before = tracemalloc.get_traced_memory()[0]
+    rss_before = resident_memory_mb()
+    start = time.perf_counter()
+    with torch.no_grad():
+        assign_(gpt.pos_emb.weight, params['wpe'])
+        assign_(gpt.tok_emb.weight, params['wte'])
+
+        for b in range(len(params["blocks"])):   
+            block, block_params = gpt.trf_blocks[b], params["blocks"][b]
+            c_attn = block_params["attn"]["c_attn"]
+            if isinstance(block.att, FusedMultiHeadAttention):
+                # c_attn already has the query/key/value weights side by side
+                assign_(block.att.qkv.weight, c_attn["w"], transpose=True)
+                assign_(block.att.qkv.bias, c_attn["b"])
+            else:
+                q_w, k_w, v_w = np.split(c_attn["w"], 3, axis=-1)
+                assign_(block.att.W_query.weight, q_w, transpose=True)
+                assign_(block.att.W_key.weight, k_w, transpose=True)
+                assign_(block.att.W_value.weight, v_w, transpose=True)
+                q_b, k_b, v_b = np.split(c_attn["b"], 3, axis=-1)
+                assign_(block.att.W_query.bias, q_b)
+                assign_(block.att.W_key.bias, k_b)
+                assign_(block.att.W_value.bias, v_b)
+
+            assign_(block.att.out_proj.weight, block_params["attn"]["c_proj"]["w"], transpose=True)
+            assign_(block.att.out_proj.bias, block_params["attn"]["c_proj"]["b"])
+
+            assign_(block.ff.layers[0].weight, block_params["mlp"]["c_fc"]["w"], transpose=True)
+            assign_(block.ff.layers[0].bias, block_params["mlp"]["c_fc"]["b"])
+            assign_(block.ff.layers[2].weight, block_params["mlp"]["c_proj"]["w"], transpose=True)
+            assign_(block.ff.layers[2].bias, block_params["mlp"]["c_proj"]["b"])
+
+            assign_(block.norm1.scale, block_params["ln_1"]["g"])
+            assign_(block.norm1.shift, block_params["ln_1"]["b"])
+            assign_(block.norm2.scale, block_params["ln_2"]["g"])
+            assign_(block.norm2.shift, block_params["ln_2"]["b"])
+
+        assign_(gpt.final_norm.scale, params["g"])
+        assign_(gpt.final_norm.shift, params["b"])
+        assign_(gpt.out_head.weight, params["wte"])
+
+    load_time = time.perf_counter() - start
+    stats = {
+        "load_time_s": load_time,
+        "rss_delta_mb": resident_memory_mb() - rss_before,
+        "numpy_peak_mb": (tracemalloc.get_traced_memory()[1] - traced_before) / 2**20
+    }
+    if not tracing:
+        tracemalloc.stop()
+    if verbose:
+        print(f"Weights loaded in {stats['load_time_s']:.2f}s, resident memory {stats['rss_delta_mb']:+.1f} MB, "
+              f"numpy allocations peak {stats['numpy_peak_mb']:.1f} MB")
+    return stats
+
+
+
+# Copy a numpy array into an existing parameter (in place, must be called under torch.no_grad)
+def assign_(left, right, transpose=False):
+    right = torch.from_numpy(np.asarray(right))
+    if transpose:
+        right = right.T
     if left.shape != right.shape:
         raise ValueError(f"Shape mismatch. Left: {left.shape}, "
-                          "Right: {right.shape}"
+                          f"Right: {right.shape}"
         )
-    return torch.nn.Parameter(torch.tensor(right))
+    left.copy_(right)
+
+
+
+# Current resident memory of the process in MB (not the peak: ru_maxrss never goes down, a load after
+# anything bigger would show nothing). /proc on Linux, psutil elsewhere if it is installed.
+def resident_memory_mb():
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    try:
+        import psutil
+    except ImportError:
+        return float("nan")
+    return psutil.Process().memory_info().rss / 2**20
 
 
 
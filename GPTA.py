@@ -2,7 +2,10 @@ import os
 import json
 import torch
 import urllib
-from torch.utils.data import Dataset
+import bisect
+import itertools
+from functools import partial
+from torch.utils.data import Dataset, DataLoader, Sampler
 
 
 # Download the dataset
@@ -60,40 +63,142 @@ class InstructionDataset(Dataset):
 
 
 
+# Pad the batch to its longest item. Every item gets an <|endoftext|> token, the padding after it is
+# ignored in the loss (ignore_index). Built for the whole batch at once.
 def input_preparation_txt( batch, device="mps", pad_token_id=50256, ignore_index=-100, allowed_max_length=None):
-    batch_max_length = max(len(item)+1 for item in batch)
-
-    # Pad and prepare inputs and targets
-    inputs_lst, targets_lst = [], []
-
-    for item in batch:
-        new_item = item.copy()
-        # Add an <|endoftext|> token
-        new_item += [pad_token_id]
-        # Pad sequences to max_length
-        padded = (
-            new_item + [pad_token_id] *
-            (batch_max_length - len(new_item))
-        )
-        inputs = torch.tensor(padded[:-1])  # Truncate the last token for inputs
-        targets = torch.tensor(padded[1:])  # Shift +1 to the right for targets
-
-        # Add the ignore_index token
-        mask = targets == pad_token_id
-        indices = torch.nonzero(mask).squeeze()
-        if indices.numel() > 1:
-            targets[indices[1:]] = ignore_index
-
-        # truncate to maximum sequence length
-        if allowed_max_length is not None:
-            inputs = inputs[:allowed_max_length]
-            targets = targets[:allowed_max_length]
-
-        inputs_lst.append(inputs)
-        targets_lst.append(targets)
-
-    # Convert list of inputs and targets to tensors and transfer to target device
-    inputs_tensor = torch.stack(inputs_lst).to(device)
-    targets_tensor = torch.stack(targets_lst).to(device)
-
-    return inputs_tensor, targets_tensor
\ No newline at end of file
+    lengths = torch.tensor([len(item) for item in batch])
+    batch_max_length = int(lengths.max()) + 1
+
+    # Pad and prepare inputs and targets: the tokens of every row, then pad_token_id (the first one is the <|endoftext|>)
+    padded = torch.full((len(batch), batch_max_length), pad_token_id, dtype=torch.long)
+    padded[torch.arange(batch_max_length) < lengths[:, None]] = torch.tensor(list(itertools.chain.from_iterable(batch)), dtype=torch.long)
+    inputs = padded[:, :-1]  # Truncate the last token for inputs
+    targets = padded[:, 1:].clone()  # Shift +1 to the right for targets
+
+    # Add the ignore_index token, all the pad tokens but the first one of every row
+    mask = targets == pad_token_id
+    targets[mask & (mask.cumsum(dim=1) > 1)] = ignore_index
+
+    # truncate to maximum sequence length
+    if allowed_max_length is not None:
+        inputs = inputs[:, :allowed_max_length]
+        targets = targets[:, :allowed_max_length]
+
+    return inputs.to(device), targets.to(device)
+
+
+
+
+# Batches of items with similar lengths, limited by max_tokens (padded tokens of the batch) instead of
+# a fixed number of items. Sorted by length with a random order between the items of the same length,
+# and the batches in random order (the number of batches is the same every epoch).
+class LengthBucketBatchSampler(Sampler):
+  def __init__(self, lengths, max_tokens, max_batch_size=None, shuffle=True, generator=None):
+    self.lengths = torch.as_tensor(lengths)
+    self.max_tokens = max_tokens
+    self.max_batch_size = max_batch_size
+    self.shuffle = shuffle
+    self.generator = generator
+    self.batches = self.make_batches(torch.argsort(self.lengths, stable=True))
+
+  def make_batches(self, order):
+    lengths = self.lengths.tolist()
+    batches, batch = [], []
+    for index in order.tolist():
+      # Sorted by length, the new item is the longest of the batch
+      if batch and (lengths[index] * (len(batch) + 1) > self.max_tokens or len(batch) == self.max_batch_size):
+        batches.append(batch)
+        batch = []
+      batch.append(index)
+    if batch:
+      batches.append(batch)
+    return batches
+
+  def __iter__(self):
+    if not self.shuffle:
+      yield from self.batches
+      return
+    noise = torch.rand(len(self.lengths), generator=self.generator)
+    batches = self.make_batches(torch.argsort(self.lengths + noise))
+    for index in torch.randperm(len(batches), generator=self.generator).tolist():
+      yield batches[index]
+
+  def __len__(self):
+    return len(self.batches)
+
+
+
+# Tokens in the batches, without and with the padding
+def padding_stats(batches, lengths):
+  tokens = sum(lengths[index] for batch in batches for index in batch)
+  padded_tokens = sum(max(lengths[index] for index in batch) * len(batch) for batch in batches)
+  return tokens, padded_tokens
+
+
+
+
+def create_instruction_data_loader(dataset, max_tokens=4096, max_batch_size=None, shuffle=True, device="cpu",
+                                   pad_token_id=50256, ignore_index=-100, allowed_max_length=None, num_workers=0):
+  # Length of an item in the batch (inputs): its tokens, truncated to allowed_max_length
+  lengths = [len(item) if allowed_max_length is None else min(len(item), allowed_max_length) for item in dataset.encoded_texts]
+  collate_fn = partial(input_preparation_txt, device=device, pad_token_id=pad_token_id,
+                       ignore_index=ignore_index, allowed_max_length=allowed_max_length)
+  return DataLoader(
+      dataset,
+      batch_sampler=LengthBucketBatchSampler(lengths, max_tokens, max_batch_size, shuffle),
+      collate_fn=collate_fn,
+      num_workers=num_workers
+  )
+
+
+
+
+# Several examples packed in every row of max_length tokens instead of one padded example per row.
+# Every example has the inputs/targets of input_preparation_txt (targets shifted by one, ending with
+# <|endoftext|>) and positions restarting at 0, so GPT.GPTModel only attends inside the example
+# (GPT.document_mask). The rows are filled best fit decreasing once, the DataLoader shuffles them.
+# Items are ({"input_ids", "position_ids"}, targets), GPT.calc_loss_batch handles the dict.
+class PackedInstructionDataset(Dataset):
+  def __init__(self, dataset, max_length=1024, pad_token_id=50256, ignore_index=-100):
+    self.max_length = max_length
+    self.pad_token_id = pad_token_id
+    self.ignore_index = ignore_index
+    self.examples = dataset.encoded_texts
+
+    self.rows, free = [], []    # free: sorted (space left, row)
+    order = sorted(range(len(self.examples)), key=lambda index: -len(self.examples[index]))
+    for index in order:
+      length = min(len(self.examples[index]), max_length)
+      position = bisect.bisect_left(free, (length, -1))
+      if position == len(free):
+        self.rows.append([index])
+        space, row = max_length - length, len(self.rows) - 1
+      else:
+        space, row = free.pop(position)
+        self.rows[row].append(index)
+        space -= length
+      if space > 0:
+        bisect.insort(free, (space, row))
+
+  def __getitem__(self, index):
+    input_ids = torch.full((self.max_length,), self.pad_token_id, dtype=torch.long)
+    targets = torch.full((self.max_length,), self.ignore_index, dtype=torch.long)
+    position_ids = torch.zeros(self.max_length, dtype=torch.long)
+    start = 0
+    for example in self.rows[index]:
+      tokens = self.examples[example] + [self.pad_token_id]   # Add an <|endoftext|> token
+      length = min(len(tokens) - 1, self.max_length)
+      input_ids[start:start + length] = torch.tensor(tokens[:length])
+      targets[start:start + length] = torch.tensor(tokens[1:length + 1])
+      position_ids[start:start + length] = torch.arange(length)
+      start += length
+    # The padding at the end of the row: ignored targets, every token is its own document (position 0)
+    return {"input_ids": input_ids, "position_ids": position_ids}, targets
+
+  def __len__(self):
+    return len(self.rows)
+
+  # Fraction of the row tokens that are examples (not padding)
+  def efficiency(self):
+    tokens = sum(min(len(example), self.max_length) for example in self.examples)
+    return tokens / (len(self.rows) * self.max_length)
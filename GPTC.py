@@ -1,10 +1,18 @@
 import os
+import time
+import queue
 import torch
+import GPT
+import hashlib
+import threading
 import zipfile
+import itertools
+import numpy as np
 import pandas as pd
 import urllib.request
 from pathlib import Path
-from torch.utils.data import Dataset
+from functools import partial
+from torch.utils.data import Dataset, DataLoader
 
 
 
@@ -48,62 +56,113 @@ def random_split(df, train_frac, validation_frac):
 
 
 
+# Messages tokenized once into a single int32 array (offsets[i]:offsets[i+1] are the tokens of message i)
+# and the labels in a numpy array. The items aren't padded, collate_spam_batch pads every batch to its
+# longest message. With cache_dir the arrays are saved and reused for the same csv file and tokenizer.
 class SpamDataset(Dataset):
-    def __init__(self, csv_file, tokenizer, max_length=None, pad_token_id=50256):
-        self.data = pd.read_csv(csv_file)
-
-        # Pre-tokenize texts
-        self.encoded_texts = [
-            tokenizer.encode(text) for text in self.data["Text"]
-        ]
+    def __init__(self, csv_file, tokenizer, max_length=None, pad_token_id=50256, cache_dir=None):
+        self.pad_token_id = pad_token_id
+
+        cache_path = None
+        if cache_dir is not None:
+            with open(csv_file, "rb") as file:
+                key = hashlib.sha256(file.read() + getattr(tokenizer, "name", type(tokenizer).__name__).encode()).hexdigest()
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_path = os.path.join(cache_dir, f"spam_{key[:16]}.npz")
+
+        if cache_path is not None and os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                self.tokens, self.offsets, self.labels = cached["tokens"], cached["offsets"], cached["labels"]
+        else:
+            data = pd.read_csv(csv_file)
+            # Pre-tokenize texts
+            texts = data["Text"].tolist()
+            if hasattr(tokenizer, "encode_batch"):
+                encoded_texts = tokenizer.encode_batch(texts)
+            else:
+                encoded_texts = [tokenizer.encode(text) for text in texts]
+            lengths = np.array([len(encoded_text) for encoded_text in encoded_texts], dtype=np.int64)
+            self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+            self.tokens = np.fromiter(itertools.chain.from_iterable(encoded_texts), dtype=np.int32, count=int(self.offsets[-1]))
+            self.labels = data["Label"].to_numpy(dtype=np.int64)
+            if cache_path is not None:
+                np.savez(cache_path, tokens=self.tokens, offsets=self.offsets, labels=self.labels)
 
         if max_length is None:
             self.max_length = self._longest_encoded_length()
         else:
+            # Sequences longer than max_length are truncated
             self.max_length = max_length
-            # Truncate sequences if they are longer than max_length
-            self.encoded_texts = [
-                encoded_text[:self.max_length]
-                for encoded_text in self.encoded_texts
-            ]
-
-        # Pad sequences to the longest sequence
-        self.encoded_texts = [
-            encoded_text + [pad_token_id] * (self.max_length - len(encoded_text))
-            for encoded_text in self.encoded_texts
-        ]
 
     def __getitem__(self, index):
-        encoded = self.encoded_texts[index]
-        label = self.data.iloc[index]["Label"]
-        return (
-            torch.tensor(encoded, dtype=torch.long),
-            torch.tensor(label, dtype=torch.long)
-        )
+        start = self.offsets[index]
+        end = min(self.offsets[index + 1], start + self.max_length)
+        return self.tokens[start:end], self.labels[index]
 
     def __len__(self):
-        return len(self.data)
+        return len(self.labels)
 
     def _longest_encoded_length(self):
-        max_length = 0
-        for encoded_text in self.encoded_texts:
-            encoded_length = len(encoded_text)
-            if encoded_length > max_length:
-                max_length = encoded_length
-        return max_length
+        return int(np.diff(self.offsets).max(initial=0))
+
+
+
+# Pad the messages to the longest of the batch (on the right). The inputs are {"input_ids", "last_positions"},
+# last_positions the index of the last token of every message: the one classified (last_token_logits),
+# whatever the pad token is and even if a message contains it.
+def collate_spam_batch(batch, pad_token_id=50256):
+    lengths = np.array([len(tokens) for tokens, _ in batch], dtype=np.int64)
+    inputs = np.full((len(batch), lengths.max()), pad_token_id, dtype=np.int64)
+    for row, (tokens, _) in enumerate(batch):
+        inputs[row, :len(tokens)] = tokens
+    labels = np.array([label for _, label in batch], dtype=np.int64)
+    last_positions = np.maximum(lengths - 1, 0)
+    return {"input_ids": torch.from_numpy(inputs), "last_positions": torch.from_numpy(last_positions)}, torch.from_numpy(labels)
+
+
+
+def to_device(input_batch, device):
+    if isinstance(input_batch, dict):
+        return {name: tensor.to(device) for name, tensor in input_batch.items()}
+    return input_batch.to(device)
+
+
+
+def create_spam_data_loader(dataset, batch_size=8, shuffle=False, drop_last=False, num_workers=0):
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        drop_last=drop_last,
+        num_workers=num_workers,
+        collate_fn=partial(collate_spam_batch, pad_token_id=dataset.pad_token_id)
+    )
+
+
+
+# Logits of the last token that isn't padding of every row, the one containing all the information/attention of the text.
+# Only that position goes through final_norm and out_head. The positions come with the batches of collate_spam_batch,
+# for a plain tensor of token ids they are found by searching for pad_token_id.
+def last_token_logits(model, input_batch, pad_token_id=50256):
+    if isinstance(input_batch, dict):
+        input_batch, last = input_batch["input_ids"], input_batch["last_positions"]
+    else:
+        positions = torch.arange(input_batch.shape[1], device=input_batch.device)
+        last = torch.where(input_batch != pad_token_id, positions, 0).amax(dim=1)
+    return model(input_batch, output_positions=last)[:, 0, :]
 
 
 
 
-def calc_loss_batch(input_batch, target_batch, model, device):
-    input_batch, target_batch = input_batch.to(device), target_batch.to(device)
-    logits = model(input_batch)[:, -1, :]  # Logits of last output token, the one containing all the information/attention of the text
-    loss = torch.nn.functional.cross_entropy(logits, target_batch)
+def calc_loss_batch(input_batch, target_batch, model, device, pad_token_id=50256):
+    input_batch, target_batch = to_device(input_batch, device), target_batch.to(device)
+    logits = last_token_logits(model, input_batch, pad_token_id)  # Logits of last token of the text
+    loss = torch.nn.functional.cross_entropy(logits.float(), target_batch)
     return loss
 
 
 
-def calc_accuracy_loader(data_loader, model, device, num_batches=None):
+def calc_accuracy_loader(data_loader, model, device, num_batches=None, precision=None, pad_token_id=50256):
     model.eval()
     correct_predictions, num_examples = 0, 0
 
@@ -113,10 +172,10 @@ def calc_accuracy_loader(data_loader, model, device, num_batches=None):
         num_batches = min(num_batches, len(data_loader))
     for i, (input_batch, target_batch) in enumerate(data_loader):
         if i < num_batches:
-            input_batch, target_batch = input_batch.to(device), target_batch.to(device)
+            input_batch, target_batch = to_device(input_batch, device), target_batch.to(device)
 
-            with torch.no_grad():
-                logits = model(input_batch)[:, -1, :]  # Logits of last output token
+            with torch.no_grad(), GPT.autocast_context(device, precision):
+                logits = last_token_logits(model, input_batch, pad_token_id)  # Logits of last token of the text
             predicted_labels = torch.argmax(logits, dim=-1)
 
             num_examples += predicted_labels.shape[0]
@@ -129,9 +188,9 @@ def calc_accuracy_loader(data_loader, model, device, num_batches=None):
 
 
 
-def evaluate_model(model, train_loader, val_loader, device, eval_iter):
+def evaluate_model(model, train_loader, val_loader, device, eval_iter, precision=None):
 	model.eval()
-	with torch.no_grad():
+	with torch.no_grad(), GPT.autocast_context(device, precision):
 		train_loss = calc_loss_loader(train_loader, model, device, num_batches=eval_iter)
 		val_loss = calc_loss_loader(val_loader, model, device, num_batches=eval_iter)
 	model.train()
@@ -158,41 +217,54 @@ def calc_loss_loader(data_loader, model, device, num_batches=None):
     return total_loss / num_batches
 
 
-def train_classifier_simple(model, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter):
-    # Initialize lists to track losses and examples seen
-    train_losses, val_losses, train_accs, val_accs = [], [], [], []
-    examples_seen, global_step = 0, -1
+def train_classifier_simple(model, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter, precision=None,
+                            checkpoint_dir=None, checkpoint_freq=100, keep_last=3, profiler=None):
+    # Losses, accuracies and examples seen, checkpointed and resumed as in GPT.train_model_simple
+    session = GPT.TrainingSession(model, optimizer,
+                                  {"train_losses": [], "val_losses": [], "train_accs": [], "val_accs": [], "examples_seen": 0, "global_step": -1},
+                                  checkpoint_dir=checkpoint_dir, checkpoint_freq=checkpoint_freq, keep_last=keep_last, profiler=profiler)
+    progress, span = session.progress, session.span
+    train_losses, val_losses = progress["train_losses"], progress["val_losses"]
+    train_accs, val_accs = progress["train_accs"], progress["val_accs"]
 
     # Main training loop
-    for epoch in range(num_epochs):
+    for epoch in session.epochs(num_epochs):
         model.train()  # Set model to training mode
 
-        for input_batch, target_batch in train_loader:
-            optimizer.zero_grad() # Reset loss gradients from previous batch iteration
-            loss = calc_loss_batch(input_batch, target_batch, model, device)
-            loss.backward() # Calculate loss gradients
-            optimizer.step() # Update model weights using loss gradients
-            examples_seen += input_batch.shape[0] # New: track examples instead of tokens
-            global_step += 1
+        for batch_idx, (input_batch, target_batch) in session.batches(train_loader, epoch):
+            with span("train/compute"):
+                optimizer.zero_grad() # Reset loss gradients from previous batch iteration
+                with GPT.autocast_context(device, precision):  # precision="bf16" for bfloat16 autocast
+                    loss = calc_loss_batch(input_batch, target_batch, model, device)
+                loss.backward() # Calculate loss gradients
+            with span("train/optimizer_step"):
+                optimizer.step() # Update model weights using loss gradients
+            progress["examples_seen"] += len(target_batch) # New: track examples instead of tokens
+            progress["global_step"] += 1
+            session.count("train_examples", len(target_batch))
 
             # Optional evaluation step
-            if global_step % eval_freq == 0:
-                train_loss, val_loss = evaluate_model(
-                    model, train_loader, val_loader, device, eval_iter)
+            if progress["global_step"] % eval_freq == 0:
+                with span("train/evaluate"):
+                    train_loss, val_loss = evaluate_model(
+                        model, train_loader, val_loader, device, eval_iter, precision)
                 train_losses.append(train_loss)
                 val_losses.append(val_loss)
-                print(f"Ep {epoch+1} (Step {global_step:06d}): "
+                print(f"Ep {epoch+1} (Step {progress['global_step']:06d}): "
                       f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}")
 
+            session.step_done()
+
         # Calculate accuracy after each epoch
-        train_accuracy = calc_accuracy_loader(train_loader, model, device, num_batches=eval_iter)
-        val_accuracy = calc_accuracy_loader(val_loader, model, device, num_batches=eval_iter)
+        train_accuracy = calc_accuracy_loader(train_loader, model, device, num_batches=eval_iter, precision=precision)
+        val_accuracy = calc_accuracy_loader(val_loader, model, device, num_batches=eval_iter, precision=precision)
         print(f"Training accuracy: {train_accuracy*100:.2f}% | ", end="")
         print(f"Validation accuracy: {val_accuracy*100:.2f}%")
         train_accs.append(train_accuracy)
         val_accs.append(val_accuracy)
 
-    return train_losses, val_losses, train_accs, val_accs, examples_seen
+    session.close(num_epochs)
+    return train_losses, val_losses, train_accs, val_accs, progress["examples_seen"]
 
 
 
@@ -201,17 +273,104 @@ def classify_review(text, model, tokenizer, device, max_length=None, pad_token_i
     model.eval()
     # Prepare inputs to the model
     input_ids = tokenizer.encode(text)
-    supported_context_length = model.pos_emb.weight.shape[0]
-
-    # Truncate sequences if they too long
-    input_ids = input_ids[:min(max_length, supported_context_length)]
+    supported_context_length = model.pos_emb.num_embeddings
 
-    # Pad sequences to the longest sequence
-    input_ids += [pad_token_id] * (max_length - len(input_ids))
+    # Truncate sequences if they too long (no padding needed, the last token is the one classified)
+    input_ids = input_ids[:min(max_length or supported_context_length, supported_context_length)] or [pad_token_id]
     input_tensor = torch.tensor(input_ids, device=device).unsqueeze(0) # add batch dimension
 
     # Model inference
     with torch.no_grad():
-        logits = model(input_tensor)[:, -1, :]  # Logits of the last output token
+        logits = model(input_tensor, output_positions="last")[:, -1, :]  # Logits of the last output token
     predicted_label = torch.argmax(logits, dim=-1).item()
-    return "spam" if predicted_label == 1 else "not spam"
\ No newline at end of file
+    return "spam" if predicted_label == 1 else "not spam"
+
+
+
+# Classify many texts at once: tokenized with a single batch encode, sorted by length and run in batches
+# of similar lengths, each padded only to its own longest text. Returns the labels and the probabilities
+# (len(texts), num_classes) in the order of texts.
+@torch.inference_mode()
+def classify_texts(texts, model, tokenizer, device, max_length=None, batch_size=32, pad_token_id=50256, labels=("not spam", "spam")):
+    model.eval()
+    supported_context_length = model.pos_emb.num_embeddings
+    max_length = min(max_length or supported_context_length, supported_context_length)
+    if hasattr(tokenizer, "encode_batch"):
+        encoded_texts = tokenizer.encode_batch(list(texts))
+    else:
+        encoded_texts = [tokenizer.encode(text) for text in texts]
+    encoded_texts = [encoded_text[:max_length] or [pad_token_id] for encoded_text in encoded_texts]
+
+    probabilities = torch.empty(len(encoded_texts), len(labels))
+    order = sorted(range(len(encoded_texts)), key=lambda index: len(encoded_texts[index]))
+    for start in range(0, len(order), batch_size):
+        group = order[start:start + batch_size]
+        input_batch, _ = collate_spam_batch([(encoded_texts[index], 0) for index in group], pad_token_id)
+        logits = last_token_logits(model, to_device(input_batch, device), pad_token_id)
+        probabilities[group] = torch.softmax(logits.float(), dim=-1).cpu()
+    return [labels[index] for index in probabilities.argmax(dim=-1).tolist()], probabilities
+
+
+
+# Classify a stream of texts (any iterator), yields (text, label, probabilities) in order. The texts are
+# read on a thread into a queue of queue_size, a batch is classified when it has batch_size texts or
+# after max_wait seconds from its first one (latency bound when the stream is slow).
+def classify_stream(texts, model, tokenizer, device, max_length=None, batch_size=32, max_wait=0.05, queue_size=1024,
+                    pad_token_id=50256, labels=("not spam", "spam")):
+    pending = queue.Queue(maxsize=queue_size)
+    end = object()
+    errors = []
+
+    def read_texts():
+        try:
+            for text in texts:
+                pending.put(text)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            pending.put(end)
+
+    threading.Thread(target=read_texts, daemon=True).start()
+    finished = False
+    while not finished:
+        batch = [pending.get()]
+        if batch[0] is end:
+            break
+        deadline = time.perf_counter() + max_wait
+        while len(batch) < batch_size:
+            try:
+                text = pending.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if text is end:
+                finished = True
+                break
+            batch.append(text)
+        batch_labels, probabilities = classify_texts(batch, model, tokenizer, device, max_length, batch_size, pad_token_id, labels)
+        yield from zip(batch, batch_labels, probabilities)
+    if errors:
+        raise errors[0]
+
+
+
+# Messages/sec and latency per batch (p50, p99 in seconds) of classify_texts for each batch size, to pick
+# the largest batch within a latency budget. The texts are grouped by length like classify_texts does.
+def classification_throughput(texts, model, tokenizer, device, batch_sizes=(1, 8, 32, 128), max_length=None):
+    texts = sorted(texts, key=len)
+    results = {}
+    for batch_size in batch_sizes:
+        classify_texts(texts[:batch_size], model, tokenizer, device, max_length, batch_size)  # Warm up
+        latencies = []
+        start = time.perf_counter()
+        for begin in range(0, len(texts), batch_size):
+            batch_start = time.perf_counter()
+            classify_texts(texts[begin:begin + batch_size], model, tokenizer, device, max_length, batch_size)
+            latencies.append(time.perf_counter() - batch_start)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        results[batch_size] = {
+            "messages_per_sec": len(texts) / elapsed,
+            "p50_latency": latencies[len(latencies) // 2],
+            "p99_latency": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        }
+    return results
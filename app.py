@@ -0,0 +1,419 @@
+import json
+import asyncio
+import argparse
+from collections import deque
+from contextlib import nullcontext
+
+import torch
+
+import GPT
+import GPTA
+import prefix_cache as prefix
+from sampling import Sampler, SamplingParams
+from instrumentation import Profiler
+from checkpoint import load_model as load_checkpoint
+
+
+"""
+  Inference server for the chat UI.
+    The model is loaded once and a single scheduler loop runs the decoding. On every step the
+    requests that arrived in the meantime are prefilled and joined to the running batch
+    (continuous batching), and finished ones leave it, instead of serving one request after another.
+    With a prefix cache (prefix_cache.py) every new request only prefills the tokens after its longest
+    prefix seen before (prompt template, chat history). With --profile the model and the scheduler are
+    instrumented (instrumentation.py), GET /metrics gives Prometheus text and GET /trace a Chrome trace.
+    The tokens are streamed back to the client with Server-Sent Events.
+
+  python app.py --checkpoint assistant.pth --model "gpt2-small (124M)"
+"""
+
+
+class GenerationRequest:
+    def __init__(self, token_ids, max_new_tokens=100, sampling=None):
+        self.token_ids = token_ids
+        self.max_new_tokens = max_new_tokens
+        self.sampling = sampling or SamplingParams()     # Per request, sampled together with the batch (sampling.py)
+        self.num_generated = 0
+        self.cancelled = False
+        self.queue = asyncio.Queue()   # Generated token ids, None once the request finished
+
+
+
+
+class ContinuousBatchingScheduler:
+    def __init__(self, model, context_length, max_batch_size=8, eos_id=50256, pad_token_id=50256, prefix_cache=None, profiler=None):
+        self.model = model
+        self.context_length = context_length
+        self.max_batch_size = max_batch_size
+        self.eos_id = eos_id
+        self.pad_token_id = pad_token_id
+        self.prefix_cache = prefix_cache
+        self.profiler = profiler
+        self.device = next(model.parameters()).device
+
+        self.waiting = deque()
+        self.wakeup = asyncio.Event()
+
+        # Running batch: one row per request
+        self.running = []
+        self.kv_cache = None
+        self.mask = None            # (rows, cached tokens), True for the real tokens of each row
+        self.sampler = None         # sampling.Sampler with the parameters of each row
+        self.next_tokens = None     # (rows, 1), sampled on the last step but not in the cache yet
+
+    def submit(self, request):
+        if not request.token_ids:
+            raise ValueError("The prompt is empty")
+        # Keep room for at least one generated token
+        request.token_ids = request.token_ids[-(self.context_length - 1):]
+        if self.profiler is not None:
+            self.profiler.count("requests")
+            self.profiler.count("prompt_tokens", len(request.token_ids))
+        self.waiting.append(request)
+        self.wakeup.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.running and not self.waiting:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            # Admit the new requests into the running batch
+            new_requests = []
+            while self.waiting and len(self.running) + len(new_requests) < self.max_batch_size:
+                request = self.waiting.popleft()
+                if not request.cancelled:
+                    new_requests.append(request)
+
+            # The forward pass runs on a worker thread so the server keeps accepting connections
+            try:
+                sampled = await loop.run_in_executor(None, self.step, new_requests)
+            except Exception as e:
+                # Only the requests of this step are ended, the loop keeps serving the next ones
+                print(f"Generation step failed: {e!r}")
+                self.fail(self.running + [request for request in new_requests if request not in self.running])
+                continue
+            self.dispatch(sampled)
+
+    def fail(self, requests):
+        for request in requests:
+            request.queue.put_nowait(None)
+        if self.profiler is not None:
+            self.profiler.count("failed_requests", len(requests))
+        # The batch may be half updated, it starts again from the next requests
+        self.running = []
+        self.kv_cache, self.mask, self.next_tokens, self.sampler = None, None, None, None
+
+    def step(self, new_requests):
+        span = self.profiler.span if self.profiler is not None else (lambda name: nullcontext())
+        logits = []
+        with torch.no_grad():
+            # Decode one token for the rows already in the batch
+            if self.running:
+                self.mask = torch.cat((self.mask, torch.ones_like(self.next_tokens, dtype=torch.bool)), dim=1)
+                with span("server/decode"):
+                    logits.append(self.model(
+                        self.next_tokens,
+                        kv_cache=self.kv_cache,
+                        pos_offset=self.mask[:, :-1].sum(dim=1),
+                        attn_mask=self.mask
+                    )[:, -1, :])
+
+            # Prefill the new requests (left padded) and join them to the batch
+            if new_requests:
+                with span("server/prefill"):
+                    kv_cache, mask, new_logits = self.prefill(new_requests)
+                logits.append(new_logits)
+                sampler = Sampler([request.sampling for request in new_requests], new_logits.shape[-1], self.device,
+                                  prompts=[request.token_ids for request in new_requests])
+                if self.running:
+                    pad = len(self.kv_cache) - len(kv_cache)
+                    self.kv_cache.append(kv_cache)
+                    self.mask = torch.cat((self._pad_left(self.mask, -pad), self._pad_left(mask, pad)))
+                    self.sampler.append(sampler)
+                else:
+                    self.kv_cache, self.mask, self.sampler = kv_cache, mask, sampler
+                self.running += new_requests
+
+        # One sampling pass for all the rows, each with its own parameters
+        with span("server/sampling"):
+            self.next_tokens = self.sampler(torch.cat(logits).float())
+        return self.next_tokens.squeeze(1).tolist()
+
+    def prefill(self, requests):
+        if self.prefix_cache is not None:
+            return self.prefill_cached(requests)
+        max_len = max(len(request.token_ids) for request in requests)
+        idx = torch.full((len(requests), max_len), self.pad_token_id, dtype=torch.long, device=self.device)
+        mask = torch.zeros((len(requests), max_len), dtype=torch.bool, device=self.device)
+        for i, request in enumerate(requests):
+            idx[i, max_len - len(request.token_ids):] = torch.tensor(request.token_ids, dtype=torch.long)
+            mask[i, max_len - len(request.token_ids):] = True
+
+        kv_cache = GPT.KVCache(len(self.model.trf_blocks), self.context_length)
+        logits = self.model(idx, kv_cache=kv_cache, pos_offset=mask.sum(dim=1) - max_len, attn_mask=mask, output_positions="last")
+        return kv_cache, mask, logits[:, -1, :]
+
+    def prefill_cached(self, requests):
+        # One request at a time from its cached prefix, then joined like the batches of step
+        kv_cache, mask, logits = None, None, []
+        for request in requests:
+            request_cache, request_logits = prefix.prefill(self.model, request.token_ids, self.prefix_cache, self.context_length)
+            request_mask = torch.ones((1, len(request.token_ids)), dtype=torch.bool, device=self.device)
+            logits.append(request_logits)
+            if kv_cache is None:
+                kv_cache, mask = request_cache, request_mask
+                continue
+            pad = len(kv_cache) - len(request_cache)
+            kv_cache.append(request_cache)
+            mask = torch.cat((self._pad_left(mask, -pad), self._pad_left(request_mask, pad)))
+        return kv_cache, mask, torch.cat(logits)
+
+    def dispatch(self, sampled):
+        keep = []
+        lengths = self.mask.sum(dim=1).tolist()
+        for request, token_id, length in zip(self.running, sampled, lengths):
+            finished = request.cancelled or token_id == self.eos_id
+            if not finished:
+                request.num_generated += 1
+                if self.profiler is not None:
+                    self.profiler.count("generated_tokens")
+                request.queue.put_nowait(token_id)
+                # Stop at max_new_tokens or once the token can't be fed back into the context
+                finished = request.num_generated >= request.max_new_tokens or length + 1 > self.context_length
+            if finished:
+                request.queue.put_nowait(None)
+            keep.append(not finished)
+
+        if all(keep):
+            return
+        keep = torch.tensor(keep, device=self.device)
+        self.running = [request for request, k in zip(self.running, keep.tolist()) if k]
+        if not self.running:
+            self.kv_cache, self.mask, self.next_tokens, self.sampler = None, None, None, None
+            return
+        self.kv_cache.select(keep)
+        self.sampler.select(keep)
+        self.mask, self.next_tokens = self.mask[keep], self.next_tokens[keep]
+
+        # Remove the columns that are padding for every remaining row
+        num_padding = int((~self.mask.any(dim=0)).int().cumprod(dim=0).sum())
+        if num_padding > 0:
+            self.kv_cache.trim(num_padding)
+            self.mask = self.mask[:, num_padding:]
+
+    def _pad_left(self, mask, num_tokens):
+        if num_tokens <= 0:
+            return mask
+        padding = torch.zeros((mask.shape[0], num_tokens), dtype=torch.bool, device=mask.device)
+        return torch.cat((padding, mask), dim=1)
+
+
+
+
+class InferenceServer:
+    def __init__(self, scheduler, tokenizer):
+        self.scheduler = scheduler
+        self.tokenizer = tokenizer
+
+    def build_prompt(self, body):
+        # Instruction prompts use the same format as the fine-tuning data
+        if "instruction" in body:
+            entry = {"instruction": body["instruction"], "input": body.get("input", "")}
+            return GPTA.format_input(entry) + "\n\n### Response:\n"
+        if not body["prompt"].strip():
+            raise ValueError("The prompt is empty")
+        return body["prompt"]
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode("latin-1").split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "OPTIONS":
+                await self.send_response(writer, 204, b"")
+            elif method == "GET" and path == "/health":
+                health = {"status": "ok", "running": len(self.scheduler.running)}
+                if self.scheduler.prefix_cache is not None:
+                    health["prefix_cache"] = self.scheduler.prefix_cache.stats()
+                if hasattr(self.tokenizer, "stats"):
+                    health["tokenizer_cache"] = self.tokenizer.stats()
+                await self.send_json(writer, 200, health)
+            elif method == "GET" and path in ("/metrics", "/trace") and self.scheduler.profiler is not None:
+                profiler = self.scheduler.profiler
+                if path == "/metrics":
+                    await self.send_response(writer, 200, profiler.prometheus().encode(), "text/plain; version=0.0.4")
+                else:
+                    await self.send_json(writer, 200, profiler.export_chrome_trace())
+            elif method == "POST" and path == "/generate":
+                await self.generate(json.loads(body or b"{}"), writer)
+            else:
+                await self.send_json(writer, 404, {"error": f"{method} {path} not found"})
+        except (ValueError, KeyError) as e:
+            await self.send_json(writer, 400, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def stop_strings(self, body):
+        # The model continues with a new instruction after its response
+        if "stop" in body:
+            return [body["stop"]] if isinstance(body["stop"], str) else list(body["stop"])
+        return ["### Instruction:"] if "instruction" in body else []
+
+    def sampling_params(self, body):
+        return SamplingParams(
+            temperature=float(body.get("temperature", 0.0)),
+            top_k=int(body["top_k"]) if body.get("top_k") else None,
+            top_p=float(body["top_p"]) if body.get("top_p") is not None else None,
+            repetition_penalty=float(body.get("repetition_penalty", 1.0)),
+            frequency_penalty=float(body.get("frequency_penalty", 0.0)),
+            presence_penalty=float(body.get("presence_penalty", 0.0)),
+            seed=int(body["seed"]) if body.get("seed") is not None else None
+        )
+
+    async def texts(self, request, detokenizer):
+        # Text of the generated tokens as soon as it is complete (multi-byte characters, stop strings),
+        # with the number of tokens it covers. The first token is always sent right away (time to first token).
+        num_tokens, first = 0, True
+        while (token_id := await request.queue.get()) is not None:
+            num_tokens += 1
+            text = detokenizer.push(token_id)
+            if text or detokenizer.stopped or first:
+                yield text, token_id, num_tokens
+                num_tokens, first = 0, False
+            if detokenizer.stopped:
+                request.cancelled = True    # Frees its row in the batch
+                return
+        text = detokenizer.flush()
+        if text or num_tokens:
+            yield text, None, num_tokens
+
+    async def generate(self, body, writer):
+        request = GenerationRequest(
+            self.tokenizer.encode(self.build_prompt(body), allowed_special={"<|endoftext|>"}),
+            max_new_tokens=int(body.get("max_new_tokens", 100)),
+            sampling=self.sampling_params(body)
+        )
+        detokenizer = GPT.IncrementalDetokenizer(self.tokenizer, self.stop_strings(body))
+        self.scheduler.submit(request)
+
+        if not body.get("stream", True):
+            chunks = [(text, num_tokens) async for text, _, num_tokens in self.texts(request, detokenizer)]
+            await self.send_json(writer, 200, {"text": "".join(text for text, _ in chunks),
+                                               "num_tokens": sum(num_tokens for _, num_tokens in chunks)})
+            return
+
+        await self.send_headers(writer, 200, "text/event-stream", extra="Cache-Control: no-cache\r\n")
+        try:
+            async for text, token_id, num_tokens in self.texts(request, detokenizer):
+                # num_tokens: generated tokens in this event, held back text can cover several
+                event = {"token": text, "token_id": token_id, "num_tokens": num_tokens}
+                writer.write(f"data: {json.dumps(event)}\n\n".encode())
+                await writer.drain()
+            writer.write(b"data: [DONE]\n\n")
+            await writer.drain()
+        except ConnectionError:
+            # Client disconnected, free its row in the batch
+            request.cancelled = True
+
+    async def send_headers(self, writer, status, content_type, content_length=None, extra=""):
+        reasons = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found"}
+        head = (
+            f"HTTP/1.1 {status} {reasons[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            "Access-Control-Allow-Headers: Content-Type\r\n"
+            "Access-Control-Allow-Methods: GET, POST, OPTIONS\r\n"
+            "Connection: close\r\n"
+            f"{extra}"
+        )
+        if content_length is not None:
+            head += f"Content-Length: {content_length}\r\n"
+        writer.write((head + "\r\n").encode())
+        await writer.drain()
+
+    async def send_response(self, writer, status, payload, content_type="application/json"):
+        await self.send_headers(writer, status, content_type, content_length=len(payload))
+        writer.write(payload)
+        await writer.drain()
+
+    async def send_json(self, writer, status, data):
+        await self.send_response(writer, status, json.dumps(data).encode())
+
+
+
+
+def load_model(model_name, checkpoint=None, device=None, dtype=None):
+    if checkpoint is not None and checkpoint.endswith(".safetensors"):
+        # Memory mapped, near instant startup (checkpoint.py)
+        model, config = load_checkpoint(checkpoint)
+        model.to(device=device or GPT.get_device(), dtype=dtype)
+        return model, config
+
+    config = GPT.get_model_config(model_name, qkv_bias=True)
+    model = GPT.GPTModel(config)
+    if checkpoint is not None:
+        model.load_state_dict(torch.load(checkpoint, map_location="cpu", weights_only=True))
+    else:
+        print("No checkpoint given, serving a randomly initialized model")
+    model.eval()
+    # bfloat16 weights halve the memory, LayerNorm and softmax still run in float32
+    model.to(device=device or GPT.get_device(), dtype=dtype)
+    return model, config
+
+
+
+
+async def serve(args):
+    model, config = load_model(
+        args.model, args.checkpoint,
+        torch.device(args.device) if args.device else None,
+        getattr(torch, args.dtype)
+    )
+    prefix_cache = prefix.PrefixCache(int(args.prefix_cache_mb * 2**20)) if args.prefix_cache_mb > 0 else None
+    scheduler = ContinuousBatchingScheduler(model, config["context_length"], max_batch_size=args.max_batch_size,
+                                            prefix_cache=prefix_cache)
+    server = InferenceServer(scheduler, GPT.create_tokenizer())
+    if args.profile:
+        # Opt-in: forward hooks on the model, counters and timings of the scheduler
+        scheduler.profiler = Profiler(max_events=args.max_trace_events).attach(model)
+        scheduler.profiler.add_collector(lambda: {f"tokenizer_cache_{k}": v for k, v in server.tokenizer.stats().items()})
+        if prefix_cache is not None:
+            scheduler.profiler.add_collector(lambda: {f"prefix_cache_{k}": v for k, v in prefix_cache.stats().items()})
+
+    scheduler_task = asyncio.create_task(scheduler.run())
+    http_server = await asyncio.start_server(server.handle_connection, args.host, args.port)
+    print(f"Serving {args.model} on http://{args.host}:{args.port}")
+    async with http_server:
+        await asyncio.gather(http_server.serve_forever(), scheduler_task)
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GPT inference server with continuous batching")
+    parser.add_argument("--checkpoint", default=None, help="state_dict saved with torch.save, or a .safetensors file from checkpoint.py")
+    parser.add_argument("--model", default="gpt2-small (124M)", choices=list(GPT.model_configs))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--prefix-cache-mb", type=float, default=256, help="Memory for the keys/values of the cached prompt prefixes, 0 disables it")
+    parser.add_argument("--profile", action="store_true", help="Per-module timings and counters on GET /metrics (Prometheus) and GET /trace (Chrome trace)")
+    parser.add_argument("--max-trace-events", type=int, default=100_000)
+    asyncio.run(serve(parser.parse_args()))
@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+import torch
+import numpy as np
+
+import GPT
+import GPTA
+import GPTC
+
+
+"""
+  Benchmark suite (CPU by default): forward pass of the GPT-2 configs over sequence lengths and batch
+  sizes, generation tokens/sec and time to first token, one training step, dataset construction,
+  instruction collation and load_weights_into_gpt. Every benchmark is run a few times after a warmup
+  and the median is kept. The results are saved as JSON with the environment they ran on, and compare
+  flags the benchmarks that got slower than a saved baseline (exit code 1).
+
+  python benchmark.py run --output baseline.json
+  python benchmark.py run --quick --output results.json
+  python benchmark.py compare baseline.json results.json --threshold 0.1
+"""
+
+
+def measure(fn, repeat=5, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"median_s": statistics.median(times), "min_s": min(times), "max_s": max(times), "repeat": repeat}
+
+
+
+def environment(device):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "device": str(device)
+    }
+
+
+
+def build_model(model_name, device, seed=123):
+    torch.manual_seed(seed)
+    model = GPT.GPTModel(GPT.get_model_config(model_name, drop_rate=0.0, qkv_bias=True))
+    return model.to(device).eval()
+
+
+
+def random_tokens(batch_size, seq_len, vocab_size=50257, device="cpu", seed=123):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(0, vocab_size, (batch_size, seq_len), generator=generator).to(device)
+
+
+
+def sample_text(num_words, seed=123):
+    words = ["every", "effort", "moves", "you", "the", "model", "is", "trained", "on", "text", "and",
+             "predicts", "next", "token", "with", "attention", "over", "context", "of", "a", "sentence."]
+    rng = random.Random(seed)
+    return " ".join(rng.choice(words) for _ in range(num_words))
+
+
+
+
+def bench_forward(results, device, model_names, seq_lens, batch_sizes, repeat):
+    for model_name in model_names:
+        model = build_model(model_name, device)
+        for batch_size in batch_sizes:
+            for seq_len in seq_lens:
+                idx = random_tokens(batch_size, seq_len, device=device)
+                with torch.inference_mode():
+                    result = measure(lambda: model(idx), repeat)
+                result["tokens_per_s"] = batch_size * seq_len / result["median_s"]
+                results[f"forward/{model_name}/b{batch_size}/t{seq_len}"] = result
+        del model
+
+
+
+def bench_generation(results, device, model_name, prompt_len, num_tokens, repeat):
+    model = build_model(model_name, device)
+    context_size = model.pos_emb.num_embeddings
+    idx = random_tokens(1, prompt_len, device=device)
+
+    # Time to first token: the prefill and one sampling step
+    result = measure(lambda: next(GPT.generate_token_ids(model, idx, 1, context_size, use_cache=True)), repeat)
+    results[f"generation/{model_name}/ttft/p{prompt_len}"] = result
+
+    for use_cache in (True, False):
+        result = measure(lambda: GPT.text_generation(model, idx, num_tokens, context_size, use_cache=use_cache), repeat)
+        result["tokens_per_s"] = num_tokens / result["median_s"]
+        results[f"generation/{model_name}/{'kv_cache' if use_cache else 'no_cache'}/p{prompt_len}/n{num_tokens}"] = result
+
+
+
+def bench_train_step(results, device, model_name, batch_size, seq_len, repeat):
+    model = build_model(model_name, device).train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=4e-4, weight_decay=0.1)
+    input_batch = random_tokens(batch_size, seq_len, device=device)
+    target_batch = random_tokens(batch_size, seq_len, device=device, seed=124)
+
+    # Same step as GPT.train_model_simple
+    def step():
+        optimizer.zero_grad()
+        loss = GPT.calc_loss_batch(input_batch, target_batch, model, device)
+        loss.backward()
+        optimizer.step()
+
+    result = measure(step, repeat)
+    result["tokens_per_s"] = batch_size * seq_len / result["median_s"]
+    results[f"train_step/{model_name}/b{batch_size}/t{seq_len}"] = result
+
+
+
+def bench_data(results, repeat):
+    tokenizer = GPT.create_tokenizer()
+    clear_cache = getattr(tokenizer, "clear_cache", lambda: None)
+
+    # GPTDataset on ~100k words, chunks of 256 tokens
+    text = sample_text(100_000)
+    result = measure(lambda: GPT.GPTDataset(text, tokenizer, 256, 256), repeat)
+    results["data/gpt_dataset/100k_words"] = result
+
+    # SpamDataset on a csv with 5000 messages, the tokenizer cache is cleared so every run encodes them
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = os.path.join(tmp_dir, "spam.csv")
+        rng = random.Random(123)
+        with open(csv_file, "w", encoding="utf-8") as file:
+            file.write("Label,Text\n")
+            for i in range(5000):
+                file.write(f"{i % 2},\"{sample_text(rng.randint(5, 60), seed=i)}\"\n")
+
+        def spam_dataset():
+            clear_cache()
+            GPTC.SpamDataset(csv_file, tokenizer)
+
+        results["data/spam_dataset/5000_messages"] = measure(spam_dataset, repeat)
+
+    # Instruction batch of 8 items of 50 to 400 tokens
+    rng = random.Random(123)
+    batch = [[rng.randrange(50257) for _ in range(rng.randint(50, 400))] for _ in range(8)]
+    result = measure(lambda: GPTA.input_preparation_txt(batch, device="cpu"), repeat * 20)
+    results["data/input_preparation_txt/b8"] = result
+
+
+
+def gpt2_params(model):
+    # Random weights in the layout of the OpenAI checkpoints (gpt_download.download_and_load_gpt2)
+    rng = np.random.default_rng(123)
+    emb_dim, vocab_size = model.tok_emb.embedding_dim, model.tok_emb.num_embeddings
+    context_length = model.pos_emb.num_embeddings
+
+    def weights(*shape):
+        return rng.standard_normal(shape, dtype=np.float32)
+
+    def block():
+        return {
+            "attn": {"c_attn": {"w": weights(emb_dim, 3 * emb_dim), "b": weights(3 * emb_dim)},
+                     "c_proj": {"w": weights(emb_dim, emb_dim), "b": weights(emb_dim)}},
+            "mlp": {"c_fc": {"w": weights(emb_dim, 4 * emb_dim), "b": weights(4 * emb_dim)},
+                    "c_proj": {"w": weights(4 * emb_dim, emb_dim), "b": weights(emb_dim)}},
+            "ln_1": {"g": weights(emb_dim), "b": weights(emb_dim)},
+            "ln_2": {"g": weights(emb_dim), "b": weights(emb_dim)}
+        }
+
+    return {
+        "wte": weights(vocab_size, emb_dim), "wpe": weights(context_length, emb_dim),
+        "blocks": [block() for _ in range(len(model.trf_blocks))],
+        "g": weights(emb_dim), "b": weights(emb_dim)
+    }
+
+
+
+def bench_load_weights(results, model_name, repeat):
+    model = build_model(model_name, "cpu")
+    params = gpt2_params(model)
+    results[f"load_weights/{model_name}"] = measure(lambda: GPT.load_weights_into_gpt(model, params), repeat)
+
+
+
+
+"""
+  run_benchmarks
+    groups: any of "forward", "generation", "train", "data", "load_weights". quick runs the smallest
+    model and sizes only. Returns {"environment": ..., "results": {name: {"median_s", ...}}}.
+"""
+def run_benchmarks(groups=("forward", "generation", "train", "data", "load_weights"), quick=False, device="cpu",
+                   model_names=None, repeat=None):
+    device = torch.device(device)
+    torch.manual_seed(123)
+    model_names = model_names or (["gpt2-small (124M)"] if quick else ["gpt2-small (124M)", "gpt2-medium (355M)"])
+    repeat = repeat or (3 if quick else 5)
+    results = {}
+
+    if "forward" in groups:
+        seq_lens = [128] if quick else [128, 512, 1024]
+        batch_sizes = [1] if quick else [1, 4]
+        bench_forward(results, device, model_names, seq_lens, batch_sizes, repeat)
+    if "generation" in groups:
+        bench_generation(results, device, model_names[0], prompt_len=32 if quick else 128,
+                         num_tokens=16 if quick else 64, repeat=repeat)
+    if "train" in groups:
+        bench_train_step(results, device, model_names[0], batch_size=2 if quick else 4, seq_len=128 if quick else 256,
+                         repeat=repeat)
+    if "data" in groups:
+        bench_data(results, repeat)
+    if "load_weights" in groups:
+        bench_load_weights(results, model_names[0], repeat)
+    return {"environment": environment(device), "results": results}
+
+
+
+
+"""
+  compare
+    Median time of every benchmark in both files, a benchmark regresses when it is more than threshold
+    (0.1 = 10%) slower than in the baseline. Returns the names of the regressions.
+"""
+def compare(baseline, current, threshold=0.1):
+    for key in ("torch", "cpu_count", "torch_threads", "device"):
+        if baseline["environment"].get(key) != current["environment"].get(key):
+            print(f"Warning: different {key} ({baseline['environment'].get(key)} -> {current['environment'].get(key)})")
+
+    regressions = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            print(f"{name:<60} new {result['median_s'] * 1000:10.2f} ms")
+            continue
+        before, after = baseline["results"][name]["median_s"], result["median_s"]
+        change = after / before - 1
+        status = "REGRESSION" if change > threshold else "faster" if change < -threshold else ""
+        if status == "REGRESSION":
+            regressions.append(name)
+        print(f"{name:<60} {before * 1000:10.2f} ms -> {after * 1000:10.2f} ms {change * 100:+7.1f}% {status}")
+    for name in baseline["results"].keys() - current["results"].keys():
+        print(f"{name:<60} missing")
+    return regressions
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the model, generation, training and data pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--output", default="benchmark.json")
+    run_parser.add_argument("--quick", action="store_true", help="Smallest model and sizes only")
+    run_parser.add_argument("--only", nargs="+", default=["forward", "generation", "train", "data", "load_weights"],
+                            choices=["forward", "generation", "train", "data", "load_weights"])
+    run_parser.add_argument("--models", nargs="+", default=None, choices=list(GPT.model_configs))
+    run_parser.add_argument("--repeat", type=int, default=None)
+    run_parser.add_argument("--device", default="cpu")
+    run_parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads, fixed for comparable runs")
+
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown flagged as a regression (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        if args.threads is not None:
+            torch.set_num_threads(args.threads)
+        report = run_benchmarks(args.only, args.quick, args.device, args.models, args.repeat)
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        for name, result in report["results"].items():
+            extra = f" | {result['tokens_per_s']:.0f} tokens/s" if "tokens_per_s" in result else ""
+            print(f"{name:<60} {result['median_s'] * 1000:10.2f} ms{extra}")
+        print(f"Saved to {args.output}")
+    else:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        with open(args.current) as file:
+            current = json.load(file)
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold * 100:.0f}%")
+            sys.exit(1)
@@ -0,0 +1,296 @@
+import os
+import glob
+import json
+import time
+import random
+import struct
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import GPT
+
+
+"""
+  Fast checkpoint format for GPTModel, laid out like safetensors: 8 bytes with the header size,
+  a JSON header {name: {dtype, shape, data_offsets}} and the raw tensor bytes.
+    Loading memory maps the file and the parameters are views on it (no copy, the pages are read
+    on first use), bound to a model created on the meta device so nothing is allocated twice.
+
+  python checkpoint.py --gpt2 124M --models-dir gpt2 --output gpt2-124M.safetensors
+  python checkpoint.py --state-dict classifier.pth --model "gpt2-small (124M)" --output classifier.safetensors
+"""
+
+
+DTYPES = {
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+DTYPES_BY_NAME = {name: dtype for dtype, name in DTYPES.items()}
+
+
+
+
+def save_safetensors(state_dict, file_path, metadata=None):
+    tensors = {name: tensor.detach().cpu().contiguous() for name, tensor in state_dict.items()}
+    # Largest elements first, so every tensor starts aligned to its element size
+    names = sorted(tensors, key=lambda name: -tensors[name].element_size())
+
+    header, offset = {}, 0
+    for name in names:
+        tensor = tensors[name]
+        num_bytes = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": DTYPES[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + num_bytes]}
+        offset += num_bytes
+    if metadata:
+        header["__metadata__"] = {key: str(value) for key, value in metadata.items()}
+
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header += b" " * (-len(header) % 8)     # The data starts 8 byte aligned
+    with open(file_path, "wb") as file:
+        file.write(struct.pack("<Q", len(header)))
+        file.write(header)
+        for name in names:
+            file.write(tensors[name].reshape(-1).view(torch.uint8).numpy().data)
+
+
+
+"""
+  load_safetensors
+    Returns ({name: tensor}, metadata). The tensors are copy-on-write views of the memory mapped
+    file: writing to them (e.g. training) doesn't modify the file.
+"""
+def load_safetensors(file_path):
+    with open(file_path, "rb") as file:
+        header_size = struct.unpack("<Q", file.read(8))[0]
+        header = json.loads(file.read(header_size))
+    data = torch.from_file(file_path, shared=False, size=os.path.getsize(file_path), dtype=torch.uint8)
+    data = data[8 + header_size:]
+
+    metadata = header.pop("__metadata__", {})
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        dtype = DTYPES_BY_NAME[info["dtype"]]
+        raw = data[begin:end]
+        if begin % torch.empty(0, dtype=dtype).element_size() != 0:
+            raw = raw.clone()   # Not aligned (written by another tool), can't be viewed in place
+        tensors[name] = raw.view(dtype).view(info["shape"])
+    return tensors, metadata
+
+
+
+
+def save_model(model, file_path, config):
+    save_safetensors(model.state_dict(), file_path, {"config": json.dumps(config)})
+
+
+
+"""
+  load_model
+    Create the GPTModel on the meta device and bind the memory mapped tensors as its parameters.
+    A classifier head (GPTC) is detected from the shape of out_head.
+"""
+def load_model(file_path, config=None, device=None):
+    tensors, metadata = load_safetensors(file_path)
+    if config is None:
+        config = json.loads(metadata["config"])
+
+    with torch.device("meta"):
+        model = GPT.GPTModel(config)
+        num_outputs = tensors["out_head.weight"].shape[0]
+        if num_outputs != config["vocab_size"]:
+            model.out_head = nn.Linear(config["emb_dim"], num_outputs)
+    model.load_state_dict(tensors, assign=True)
+    model.eval()
+    if device is not None:
+        model.to(device)
+    return model, config
+
+
+
+
+"""
+  Resumable training checkpoints (GPT.train_model_simple, GPT.train_model, GPTC.train_classifier_simple
+  through GPT.TrainingSession).
+    A checkpoint has the model, optimizer and scheduler states, the RNG states, the position in the
+    training data (epoch and batches done) and the loss histories, so a resumed run continues
+    exactly like the uninterrupted one. The states are copied to CPU memory on the training
+    thread and written to disk on a background thread, only the last keep_last are kept.
+"""
+
+
+def rng_state():
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": list(np.random.get_state()),
+        "python": random.getstate()
+    }
+    state["numpy"][1] = torch.from_numpy(state["numpy"][1].astype(np.int64))
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    numpy_state = list(state["numpy"])
+    numpy_state[1] = numpy_state[1].numpy().astype(np.uint32)
+    np.random.set_state(tuple(numpy_state))
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+
+def snapshot(obj):
+    # Copy of a (nested) state, so training can go on while it is written
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+
+
+class TrainingCheckpointer:
+    def __init__(self, checkpoint_dir, keep_last=3, prefix="checkpoint"):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.prefix = prefix
+        self.epoch = 0          # Current epoch
+        self.position = 0       # Batches done in the current epoch
+        self.epoch_rng = None   # RNG state when the epoch started (shuffling of the data loader)
+        self.resume_state = None
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.checkpoint_dir, f"{self.prefix}_*.pt")))
+
+    def resume(self, model, optimizer, scheduler=None):
+        # Restores the latest checkpoint, returns its progress (histories, counters) or None
+        checkpoints = self.checkpoints()
+        if not checkpoints:
+            return None
+        state = torch.load(checkpoints[-1], map_location="cpu", weights_only=True)
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        if scheduler is not None and state["scheduler"] is not None:
+            scheduler.load_state_dict(state["scheduler"])
+        self.epoch, self.position = state["epoch"], state["position"]
+        self.resume_state = state
+        print(f"Resuming from {checkpoints[-1]} (epoch {self.epoch+1}, batch {self.position})")
+        return state["progress"]
+
+    def batches(self, data_loader, epoch):
+        # Same as enumerate(data_loader), tracking the position. When resuming inside this epoch the
+        # data loader is replayed with the RNG state of the start of the epoch (same shuffling) and
+        # the batches already done are skipped.
+        state, self.resume_state = self.resume_state, None
+        self.epoch, self.position = epoch, 0
+        if state is None or state["epoch"] != epoch or state["position"] == 0:
+            if state is not None:
+                set_rng_state(state["rng"])
+            self.epoch_rng = rng_state()
+            iterator, start = iter(data_loader), 0
+        else:
+            self.epoch_rng = state["epoch_rng"]
+            iterator, start = None, state["position"]
+            if start < len(data_loader):
+                set_rng_state(self.epoch_rng)
+                iterator = iter(data_loader)
+                for _ in range(start):
+                    next(iterator)
+            set_rng_state(state["rng"])
+            self.position = start
+        if iterator is None:
+            return
+        for batch_idx, batch in enumerate(iterator, start=start):
+            self.position = batch_idx + 1
+            yield batch_idx, batch
+
+    def save(self, model, optimizer, scheduler=None, epoch=None, **progress):
+        # progress: counters and histories of the training loop (with global_step)
+        # epoch: save as the start of this epoch (end of training) instead of the current position
+        self.wait()     # At most one checkpoint in memory
+        state = snapshot({
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "scheduler": scheduler.state_dict() if scheduler is not None else None,
+            "epoch": self.epoch if epoch is None else epoch,
+            "position": self.position if epoch is None else 0,
+            "epoch_rng": self.epoch_rng,
+            "rng": rng_state(),
+            "progress": progress
+        })
+        file_path = os.path.join(self.checkpoint_dir, f"{self.prefix}_{progress['global_step'] + 1:08d}.pt")
+        self.pending = self.pool.submit(self.write, state, file_path)
+
+    def write(self, state, file_path):
+        torch.save(state, file_path + ".tmp")
+        os.replace(file_path + ".tmp", file_path)   # A crash never leaves a partial checkpoint
+        for old_path in self.checkpoints()[:-self.keep_last]:
+            os.remove(old_path)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()   # Raises the errors of the background write
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
+
+
+
+
+def convert_gpt2(params, config, file_path):
+    model = GPT.GPTModel(config)
+    GPT.load_weights_into_gpt(model, params)
+    save_model(model, file_path, config)
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert GPT-2 weights or a state_dict to the fast checkpoint format")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--gpt2", default=None, choices=["124M", "355M", "774M", "1558M"], help="Convert the OpenAI weights")
+    parser.add_argument("--models-dir", default="gpt2")
+    parser.add_argument("--state-dict", default=None, help="Convert a state_dict saved with torch.save")
+    parser.add_argument("--model", default="gpt2-small (124M)", choices=list(GPT.model_configs))
+    parser.add_argument("--no-qkv-bias", action="store_true")
+    args = parser.parse_args()
+
+    if args.gpt2 is not None:
+        from gpt_download import download_and_load_gpt2
+        model_name = {"124M": "gpt2-small (124M)", "355M": "gpt2-medium (355M)",
+                      "774M": "gpt2-large (774M)", "1558M": "gpt2-xl (1558M)"}[args.gpt2]
+        config = GPT.get_model_config(model_name, qkv_bias=True)
+        settings, params = download_and_load_gpt2(model_size=args.gpt2, models_dir=args.models_dir)
+        convert_gpt2(params, config, args.output)
+    elif args.state_dict is not None:
+        config = GPT.get_model_config(args.model, qkv_bias=not args.no_qkv_bias)
+        state_dict = torch.load(args.state_dict, map_location="cpu", weights_only=True)
+        save_safetensors(state_dict, args.output, {"config": json.dumps(config)})
+    else:
+        parser.error("Use --gpt2 or --state-dict")
+
+    start = time.perf_counter()
+    load_model(args.output)
+    print(f"Saved {args.output}, loads in {(time.perf_counter() - start) * 1000:.1f} ms")
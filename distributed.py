@@ -0,0 +1,258 @@
+import os
+import json
+import socket
+import argparse
+from functools import partial
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
+
+import GPT
+import GPTA
+import GPTC
+
+
+"""
+  Data-parallel training on CPU processes (DistributedDataParallel over gloo).
+    Every process trains a replica on its shard of the data (DistributedSampler), the gradients
+    are all-reduced on backward, the evaluation losses are averaged over all processes and only
+    rank 0 prints and saves the checkpoint. Works on one machine (--nproc, spawns the processes)
+    or with torchrun across machines. With --checkpoint-dir (on a filesystem all the processes
+    see) an interrupted run continues from the latest training checkpoint when launched again.
+
+  python distributed.py pretrain --text the-verdict.txt --nproc 4
+  python distributed.py classifier --train-csv train.csv --val-csv validation.csv --checkpoint gpt2-124M.safetensors --nproc 4
+  python distributed.py instruct --data instruction-data.json --checkpoint gpt2-124M.safetensors --nproc 4
+"""
+
+
+def setup(rank=None, world_size=None):
+    # torchrun sets the environment, mp.spawn passes rank/world_size
+    if rank is None:
+        rank, world_size = int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"])
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29500")
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    # Split the cores between the processes of this machine
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    return rank, world_size
+
+
+
+def cleanup():
+    dist.destroy_process_group()
+
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+
+def all_reduce_mean(value):
+    tensor = torch.tensor(float(value), dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item() / dist.get_world_size()
+
+
+
+
+def distributed_data_loader(dataset, batch_size, shuffle=True, drop_last=True, collate_fn=None, num_workers=0, seed=123):
+    sampler = DistributedSampler(dataset, shuffle=shuffle, drop_last=drop_last, seed=seed)
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        sampler=sampler,
+        drop_last=drop_last,
+        collate_fn=collate_fn,
+        num_workers=num_workers
+    )
+
+
+
+
+"""
+  evaluate_model
+    Same as GPT.evaluate_model, each process evaluates its shard and the losses are averaged.
+    calc_loss_loader is GPT.calc_loss_loader or GPTC.calc_loss_loader.
+"""
+def evaluate_model(model, train_loader, val_loader, device, eval_iter, calc_loss_loader=GPT.calc_loss_loader):
+    model.eval()
+    with torch.no_grad():
+        train_loss = calc_loss_loader(train_loader, model, device, num_batches=eval_iter)
+        val_loss = calc_loss_loader(val_loader, model, device, num_batches=eval_iter)
+    model.train()
+    return all_reduce_mean(train_loss), all_reduce_mean(val_loss)
+
+
+
+
+"""
+  train_model_distributed
+    Training loop of GPT.train_model_simple / GPTC.train_classifier_simple for a model wrapped in
+    DistributedDataParallel. The loaders must use a DistributedSampler (distributed_data_loader).
+    With a classifier (GPTC) pass calc_loss_batch/calc_loss_loader of GPTC and classifier=True to
+    also report the accuracy.
+    checkpoint_dir resumes and checkpoints as in GPT.train_model_simple (GPT.TrainingSession): every
+    process restores the latest checkpoint and skips the batches of its shard already done, only
+    rank 0 writes them. checkpoint_path is the final state_dict, also written by rank 0.
+"""
+def train_model_distributed(model, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter,
+                            calc_loss_batch=GPT.calc_loss_batch, calc_loss_loader=GPT.calc_loss_loader,
+                            classifier=False, checkpoint_path=None, checkpoint_dir=None, checkpoint_freq=100, keep_last=3):
+    ddp_model = DistributedDataParallel(model)
+    # The checkpoints hold the model, not the DistributedDataParallel wrapper
+    session = GPT.TrainingSession(model, optimizer,
+                                  {"train_losses": [], "val_losses": [], "track_tokens_seen": [], "tokens_seen": 0, "global_step": -1},
+                                  checkpoint_dir=checkpoint_dir, checkpoint_freq=checkpoint_freq, keep_last=keep_last,
+                                  write_checkpoints=is_main_process())
+    progress = session.progress
+    train_losses, val_losses, track_tokens_seen = progress["train_losses"], progress["val_losses"], progress["track_tokens_seen"]
+
+    for epoch in session.epochs(num_epochs):
+        # Different shuffling on every epoch, same on every process (and in a resumed run)
+        train_loader.sampler.set_epoch(epoch)
+        ddp_model.train()
+        for batch_idx, (input_batch, target_batch) in session.batches(train_loader, epoch):
+            optimizer.zero_grad()
+            loss = calc_loss_batch(input_batch, target_batch, ddp_model, device)
+            loss.backward()     # The gradients are averaged over the processes here
+            optimizer.step()
+            progress["tokens_seen"] += GPT.batch_num_tokens(input_batch) * dist.get_world_size()
+            progress["global_step"] += 1
+
+            if progress["global_step"] % eval_freq == 0:
+                train_loss, val_loss = evaluate_model(model, train_loader, val_loader, device, eval_iter, calc_loss_loader)
+                train_losses.append(train_loss)
+                val_losses.append(val_loss)
+                track_tokens_seen.append(progress["tokens_seen"])
+                if is_main_process():
+                    print(f"Ep {epoch+1} (Step {progress['global_step']:06d}): "
+                          f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}")
+
+            session.step_done()
+
+        if classifier:
+            train_accuracy = all_reduce_mean(GPTC.calc_accuracy_loader(train_loader, model, device, num_batches=eval_iter))
+            val_accuracy = all_reduce_mean(GPTC.calc_accuracy_loader(val_loader, model, device, num_batches=eval_iter))
+            if is_main_process():
+                print(f"Training accuracy: {train_accuracy*100:.2f}% | Validation accuracy: {val_accuracy*100:.2f}%")
+
+    session.close(num_epochs)
+    if checkpoint_path is not None and is_main_process():
+        torch.save(model.state_dict(), checkpoint_path)
+    # No process exits before rank 0 has written the checkpoints
+    dist.barrier()
+    return train_losses, val_losses, track_tokens_seen
+
+
+
+
+def load_model(args):
+    if args.checkpoint is not None and args.checkpoint.endswith(".safetensors"):
+        from checkpoint import load_model as load_checkpoint
+        model, config = load_checkpoint(args.checkpoint)
+        return model, config
+    config = GPT.get_model_config(args.model, qkv_bias=args.checkpoint is not None)
+    if args.context_length is not None:
+        config["context_length"] = args.context_length
+    model = GPT.GPTModel(config)
+    if args.checkpoint is not None:
+        model.load_state_dict(torch.load(args.checkpoint, map_location="cpu", weights_only=True))
+    return model, config
+
+
+
+def worker(rank, world_size, args):
+    setup(rank, world_size)
+    torch.manual_seed(123)      # Same initial weights on every process
+    device = torch.device("cpu")
+    model, config = load_model(args)
+    model.train()
+    calc_loss_batch, calc_loss_loader = GPT.calc_loss_batch, GPT.calc_loss_loader
+
+    if args.task == "pretrain":
+        with open(args.text, "r", encoding="utf-8") as file:
+            train_text, val_text = GPT.train_test_split(file.read(), 0.9)
+        tokenizer = GPT.create_tokenizer()
+        max_length = args.max_length or config["context_length"]
+        train_dataset = GPT.GPTDataset(train_text, tokenizer, max_length, max_length)
+        val_dataset = GPT.GPTDataset(val_text, tokenizer, max_length, max_length)
+        collate_fn = None
+    elif args.task == "classifier":
+        tokenizer = GPT.create_tokenizer()
+        train_dataset = GPTC.SpamDataset(args.train_csv, tokenizer)
+        val_dataset = GPTC.SpamDataset(args.val_csv, tokenizer, max_length=train_dataset.max_length)
+        collate_fn = GPTC.collate_spam_batch
+        # Same fine-tuning setup as the notebook: new head, last block and final norm trainable
+        for param in model.parameters():
+            param.requires_grad = False
+        model.out_head = torch.nn.Linear(config["emb_dim"], args.num_classes)
+        for param in list(model.trf_blocks[-1].parameters()) + list(model.final_norm.parameters()):
+            param.requires_grad = True
+        calc_loss_batch, calc_loss_loader = GPTC.calc_loss_batch, GPTC.calc_loss_loader
+    else:
+        with open(args.data, "r", encoding="utf-8") as file:
+            data = json.load(file)
+        train_portion = int(len(data) * 0.85)
+        tokenizer = GPT.create_tokenizer()
+        train_dataset = GPTA.InstructionDataset(data[:train_portion], tokenizer)
+        val_dataset = GPTA.InstructionDataset(data[train_portion:], tokenizer)
+        collate_fn = partial(GPTA.input_preparation_txt, device=device, allowed_max_length=config["context_length"])
+
+    train_loader = distributed_data_loader(train_dataset, args.batch_size, shuffle=True, drop_last=True, collate_fn=collate_fn)
+    val_loader = distributed_data_loader(val_dataset, args.batch_size, shuffle=False, drop_last=False, collate_fn=collate_fn)
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=args.lr, weight_decay=0.1)
+
+    train_model_distributed(
+        model, train_loader, val_loader, optimizer, device,
+        num_epochs=args.epochs, eval_freq=args.eval_freq, eval_iter=args.eval_iter,
+        calc_loss_batch=calc_loss_batch, calc_loss_loader=calc_loss_loader,
+        classifier=args.task == "classifier", checkpoint_path=args.output,
+        checkpoint_dir=args.checkpoint_dir, checkpoint_freq=args.checkpoint_freq, keep_last=args.keep_last
+    )
+    cleanup()
+
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Data-parallel training over CPU processes (gloo)")
+    parser.add_argument("task", choices=["pretrain", "classifier", "instruct"])
+    parser.add_argument("--nproc", type=int, default=2, help="Processes to spawn on this machine (ignored under torchrun)")
+    parser.add_argument("--text", help="pretrain: training text")
+    parser.add_argument("--train-csv", help="classifier: SpamDataset csv")
+    parser.add_argument("--val-csv", help="classifier: SpamDataset csv")
+    parser.add_argument("--num-classes", type=int, default=2)
+    parser.add_argument("--data", help="instruct: instruction json (same format as GPTA.download_and_load_file)")
+    parser.add_argument("--checkpoint", default=None, help="Initial weights, state_dict or .safetensors")
+    parser.add_argument("--model", default="gpt2-small (124M)", choices=list(GPT.model_configs))
+    parser.add_argument("--context-length", type=int, default=None)
+    parser.add_argument("--max-length", type=int, default=None, help="pretrain: tokens per training sample")
+    parser.add_argument("--batch-size", type=int, default=2, help="Per process")
+    parser.add_argument("--lr", type=float, default=4e-4)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--eval-freq", type=int, default=5)
+    parser.add_argument("--eval-iter", type=int, default=5)
+    parser.add_argument("--output", default="model.pth", help="Checkpoint saved by rank 0")
+    parser.add_argument("--checkpoint-dir", default=None, help="Resumable training checkpoints, a run started again continues from the latest")
+    parser.add_argument("--checkpoint-freq", type=int, default=100, help="Optimizer steps between training checkpoints")
+    parser.add_argument("--keep-last", type=int, default=3)
+    args = parser.parse_args()
+
+    if "RANK" in os.environ:
+        worker(None, None, args)
+    else:
+        os.environ.setdefault("MASTER_PORT", str(free_port()))
+        mp.spawn(worker, args=(args.nproc, args), nprocs=args.nproc)
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import argparse
+import threading
+from functools import partial
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+
+"""
+  Opt-in profiling of the hot paths. A Profiler attached to a GPTModel records the latency, an
+  estimate of the FLOPs and the output (activation) memory of every TransformerBlock, attention and
+  FeedForward forward pass with forward hooks. The training loops (GPT.train_model_simple,
+  GPT.train_model, GPTC.train_classifier_simple with profiler=...) time the wait for the DataLoader,
+  the forward/backward and the optimizer step, and the server (app.py --profile) counts the prompt and
+  generated tokens. Everything can be exported as a Chrome trace (chrome://tracing, ui.perfetto.dev)
+  or as Prometheus text. Without a profiler no hook is registered and the loops skip it entirely.
+
+  python instrumentation.py --model "gpt2-small (124M)" --trace trace.json
+"""
+
+
+MODULE_TYPES = ("TransformerBlock", "MultiHeadAttention", "FusedMultiHeadAttention", "FeedForward")
+
+
+
+# Dense estimate of the forward FLOPs (2 per multiply-add): the Linear layers and, for attention,
+# queries x keys and weights x values over every cached key
+def estimate_flops(module, x, kwargs):
+    num_tokens = x.shape[0] * x.shape[1]
+    flops = 2 * num_tokens * sum(m.in_features * m.out_features for m in module.modules() if isinstance(m, nn.Linear))
+    attention = module if hasattr(module, "d_out") else getattr(module, "att", None)
+    if attention is not None:
+        kv_cache, layer_idx = kwargs.get("kv_cache"), kwargs.get("layer_idx")
+        num_keys = kv_cache.lengths[layer_idx] if kv_cache is not None else x.shape[1]
+        flops += 4 * num_tokens * num_keys * attention.d_out
+    return flops
+
+
+
+def output_bytes(output):
+    if torch.is_tensor(output):
+        return output.numel() * output.element_size()
+    if isinstance(output, (tuple, list)):
+        return sum(output_bytes(item) for item in output)
+    return 0
+
+
+
+
+"""
+  Profiler(max_events)
+    attach(model) / detach()     forward hooks on the TransformerBlock, attention and FeedForward modules
+    span(name)                   context manager timing a block of code (training loop phases)
+    iterate(iterable, name)      times the wait for every item (DataLoader)
+    count(name, value)           counters (generated tokens, ...)
+    add_collector(fn)            fn() -> {name: value} read on export (cache hit/miss stats)
+    export_chrome_trace(path), prometheus(), summary()
+  At most max_events trace events are kept, the totals keep counting after that.
+"""
+class Profiler:
+    def __init__(self, max_events=1_000_000):
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.handles = []
+        self.starts = {}
+        self.reset()
+        self.collectors = []
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}             # name -> {"type", "calls", "total_s", "max_s", "flops", "activation_bytes"}
+            self.counters = {}
+            self.events = []
+            self.dropped_events = 0
+            self.origin = time.perf_counter()
+
+    def attach(self, model, module_types=MODULE_TYPES):
+        for name, module in model.named_modules():
+            if type(module).__name__ in module_types:
+                self.handles.append(module.register_forward_pre_hook(partial(self.pre_hook, name)))
+                self.handles.append(module.register_forward_hook(partial(self.post_hook, name), with_kwargs=True))
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def pre_hook(self, name, module, args):
+        self.starts[(name, threading.get_ident())] = time.perf_counter()
+
+    def post_hook(self, name, module, args, kwargs, output):
+        if torch.is_tensor(output) and output.is_cuda:
+            torch.cuda.synchronize(output.device)
+        end = time.perf_counter()
+        start = self.starts.pop((name, threading.get_ident()), end)
+        x = args[0] if args else kwargs["x"]
+        self.record(name, type(module).__name__, start, end, estimate_flops(module, x, kwargs), output_bytes(output))
+
+    def record(self, name, kind, start, end, flops=0, activation_bytes=0):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = {"type": kind, "calls": 0, "total_s": 0.0, "max_s": 0.0, "flops": 0, "activation_bytes": 0}
+            stats["calls"] += 1
+            stats["total_s"] += end - start
+            stats["max_s"] = max(stats["max_s"], end - start)
+            stats["flops"] += flops
+            stats["activation_bytes"] += activation_bytes
+            if len(self.events) < self.max_events:
+                self.events.append({
+                    "name": name, "cat": kind, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                    "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6,
+                    "args": {"flops": flops, "activation_bytes": activation_bytes}
+                })
+            else:
+                self.dropped_events += 1
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, "span", start, time.perf_counter())
+
+    def iterate(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, "span", start, time.perf_counter())
+            yield item
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if len(self.events) < self.max_events:
+                self.events.append({"name": name, "ph": "C", "pid": os.getpid(),
+                                    "ts": (time.perf_counter() - self.origin) * 1e6, "args": {name: self.counters[name]}})
+
+    def add_collector(self, fn):
+        self.collectors.append(fn)
+
+    def collected(self):
+        values = {}
+        for fn in self.collectors:
+            values.update({name: value for name, value in fn().items() if isinstance(value, (int, float))})
+        return values
+
+    def export_chrome_trace(self, path=None):
+        with self.lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms",
+                     "otherData": {"dropped_events": self.dropped_events}}
+        if path is not None:
+            with open(path, "w") as file:
+                json.dump(trace, file)
+        return trace
+
+    """
+      prometheus
+        Text exposition format: dlgpt_module_* per module (labels module and type), dlgpt_span_* per
+        span, dlgpt_<counter>_total for the counters and dlgpt_<name> gauges from the collectors.
+    """
+    def prometheus(self):
+        with self.lock:
+            stats = {name: dict(values) for name, values in self.stats.items()}
+            counters = dict(self.counters)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            if samples:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+        modules = [(f'{{module="{name}",type="{s["type"]}"}}', s) for name, s in stats.items() if s["type"] != "span"]
+        spans = [(f'{{span="{name}"}}', s) for name, s in stats.items() if s["type"] == "span"]
+        metric("dlgpt_module_calls_total", "counter", "Forward passes of the module", [(l, s["calls"]) for l, s in modules])
+        metric("dlgpt_module_seconds_total", "counter", "Time in the forward pass of the module", [(l, s["total_s"]) for l, s in modules])
+        metric("dlgpt_module_flops_total", "counter", "Estimated forward FLOPs of the module", [(l, s["flops"]) for l, s in modules])
+        metric("dlgpt_module_activation_bytes_total", "counter", "Bytes of the module outputs", [(l, s["activation_bytes"]) for l, s in modules])
+        metric("dlgpt_span_calls_total", "counter", "Times the span ran", [(l, s["calls"]) for l, s in spans])
+        metric("dlgpt_span_seconds_total", "counter", "Time in the span", [(l, s["total_s"]) for l, s in spans])
+        for name, value in counters.items():
+            metric(f"dlgpt_{name}_total", "counter", name.replace("_", " "), [("", value)])
+        for name, value in self.collected().items():
+            metric(f"dlgpt_{name}", "gauge", name.replace("_", " "), [("", value)])
+        return "\n".join(lines) + "\n"
+
+    # Totals per module type and span, slowest first
+    def summary(self):
+        with self.lock:
+            groups = {}
+            for name, s in self.stats.items():
+                key = name if s["type"] == "span" else s["type"]
+                group = groups.setdefault(key, {"calls": 0, "total_s": 0.0, "flops": 0, "activation_bytes": 0})
+                for field in group:
+                    group[field] += s[field]
+            counters = dict(self.counters)
+
+        rows = [f"{'':<28} {'calls':>8} {'total ms':>10} {'mean ms':>9} {'GFLOP/s':>9} {'act. MB':>9}"]
+        for key, group in sorted(groups.items(), key=lambda item: -item[1]["total_s"]):
+            gflops = group["flops"] / group["total_s"] / 1e9 if group["flops"] and group["total_s"] > 0 else float("nan")
+            rows.append(f"{key:<28} {group['calls']:>8} {group['total_s'] * 1000:>10.1f} "
+                        f"{group['total_s'] * 1000 / group['calls']:>9.3f} {gflops:>9.1f} {group['activation_bytes'] / 2**20:>9.1f}")
+        rows.extend(f"{name:<28} {value:>8}" for name, value in counters.items())
+        return "\n".join(rows)
+
+
+
+
+if __name__ == "__main__":
+    import GPT
+    from app import load_model
+
+    parser = argparse.ArgumentParser(description="Profile generation and a training step")
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--model", default="gpt2-small (124M)", choices=list(GPT.model_configs))
+    parser.add_argument("--prompt", default="Every effort moves you")
+    parser.add_argument("--max-new-tokens", type=int, default=20)
+    parser.add_argument("--trace", default="trace.json", help="Chrome trace output")
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    model, config = load_model(args.model, args.checkpoint, torch.device(args.device) if args.device else None)
+    device = next(model.parameters()).device
+    tokenizer = GPT.create_tokenizer()
+    profiler = Profiler().attach(model)
+    if hasattr(tokenizer, "stats"):
+        profiler.add_collector(lambda: {f"tokenizer_cache_{name}": value for name, value in tokenizer.stats().items()})
+
+    idx = GPT.text_to_token_ids(args.prompt, tokenizer).to(device)
+    with profiler.span("generation"):
+        for _ in GPT.generate_token_ids(model, idx, args.max_new_tokens, config["context_length"], use_cache=True):
+            profiler.count("generated_tokens")
+
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+    batch = torch.randint(0, config["vocab_size"], (2, 129), device=device)
+    with profiler.span("train/compute"):
+        loss = GPT.calc_loss_batch(batch[:, :-1], batch[:, 1:], model, device)
+        loss.backward()
+    with profiler.span("train/optimizer_step"):
+        optimizer.step()
+
+    profiler.detach()
+    profiler.export_chrome_trace(args.trace)
+    print(profiler.summary())
+    print(f"Chrome trace saved to {args.trace}")
@@ -0,0 +1,132 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+
+
+"""
+  Load test for the inference server (app.py).
+    Runs concurrent streaming clients against /generate and reports the p50/p99
+    time-to-first-token, the request latency and the generated tokens/sec. Every request has its
+    own instruction, so the prefix cache of the server only helps with the shared prompt template.
+
+  python load_test.py --concurrency 8 --requests 64
+"""
+
+
+async def get_json(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+
+async def stream_request(host, port, body):
+    reader, writer = await asyncio.open_connection(host, port)
+    payload = json.dumps(body).encode()
+    writer.write(
+        f"POST /generate HTTP/1.1\r\nHost: {host}:{port}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload
+    )
+    await writer.drain()
+
+    start = time.perf_counter()
+    first_token, num_tokens = None, 0
+    status = await reader.readline()
+    if b" 200 " not in status:
+        writer.close()
+        raise RuntimeError(f"Request failed: {status.decode().strip()}")
+    while True:
+        line = await reader.readline()
+        if not line or line.strip() == b"data: [DONE]":
+            break
+        if line.startswith(b"data: "):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            # An event can hold several tokens (text held back by the detokenizer)
+            num_tokens += json.loads(line[len(b"data: "):]).get("num_tokens", 1)
+    writer.close()
+    return first_token, time.perf_counter() - start, num_tokens
+
+
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+
+
+# Different instructions from a few tasks over random sentences
+def build_instructions(num_requests, seed=123):
+    tasks = ["Rewrite the sentence using a simile: {}", "Translate the sentence into French: {}",
+             "Summarize in one word: {}", "Correct the grammar of the sentence: {}",
+             "Give the opposite of the sentence: {}", "Classify the sentiment of the sentence: {}"]
+    subjects = ["The car", "My neighbor", "The old library", "A small dog", "The river", "Our team",
+                "The new phone", "The winter storm", "The teacher", "The city at night"]
+    predicates = ["is very fast", "was quiet all day", "looks tired", "moved to another town", "won the game",
+                  "smells like rain", "is full of books", "barked at the mailman", "was cold and dark"]
+    rng = random.Random(seed)
+    return [rng.choice(tasks).format(f"{rng.choice(subjects)} {rng.choice(predicates)}.") for _ in range(num_requests)]
+
+
+
+
+async def run_load_test(args):
+    if args.instruction is not None:
+        instructions = [args.instruction] * args.requests
+    else:
+        instructions = build_instructions(args.requests, args.seed)
+    ttfts, latencies, total_tokens = [], [], 0
+    remaining = iter(instructions)
+
+    async def client():
+        nonlocal total_tokens
+        for instruction in remaining:
+            body = {
+                "instruction": instruction,
+                "max_new_tokens": args.max_new_tokens,
+                "temperature": args.temperature,
+                "stream": True
+            }
+            ttft, latency, num_tokens = await stream_request(args.host, args.port, body)
+            if ttft is not None:
+                ttfts.append(ttft)
+            latencies.append(latency)
+            total_tokens += num_tokens
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    print(f"Requests: {len(latencies)} | Concurrency: {args.concurrency} | Time: {elapsed:.2f}s")
+    print(f"TTFT       p50 {percentile(ttfts, 50)*1000:.1f} ms | p99 {percentile(ttfts, 99)*1000:.1f} ms")
+    print(f"Latency    p50 {percentile(latencies, 50)*1000:.1f} ms | p99 {percentile(latencies, 99)*1000:.1f} ms")
+    print(f"Throughput {total_tokens / elapsed:.1f} tokens/sec ({total_tokens} tokens)")
+    prefix_cache = (await get_json(args.host, args.port, "/health")).get("prefix_cache")
+    if prefix_cache is not None:
+        # Prompt tokens that were not prefilled, the cache lowers the TTFT of repeated prompts
+        print(f"Prefix cache: {prefix_cache['token_hit_rate'] * 100:.1f}% of the prompt tokens were cached (server total)")
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for the GPT inference server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--max-new-tokens", type=int, default=50)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--instruction", default=None, help="Same instruction for every request (mostly prefix cache hits)")
+    parser.add_argument("--seed", type=int, default=123, help="Seed of the generated instructions")
+    asyncio.run(run_load_test(parser.parse_args()))
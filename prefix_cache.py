@@ -0,0 +1,239 @@
+import time
+import argparse
+
+import torch
+
+import GPT
+import GPTA
+
+
+"""
+  Prefix cache: keys/values of the prompts already processed, kept in a radix tree over the token ids
+  so the requests that share a prefix (system prompt, instruction template, chat history) only prefill
+  the tokens after it. Every node holds the keys/values of the tokens on its edge for every layer.
+  The least recently used leaves are evicted once the tensors take more than max_bytes.
+
+  python prefix_cache.py --model "gpt2-small (124M)" --checkpoint gpt2-124M.safetensors
+"""
+
+
+class RadixNode:
+    def __init__(self, tokens=(), keys=None, values=None, parent=None):
+        self.tokens = tokens        # Token ids on the edge from the parent
+        self.keys = keys            # One (num_heads, len(tokens), head_dim) tensor per layer
+        self.values = values
+        self.parent = parent
+        self.children = {}          # First token id of the edge -> node
+        self.last_access = 0
+
+    def num_bytes(self):
+        if self.keys is None:
+            return 0
+        return sum(t.numel() * t.element_size() for t in self.keys + self.values)
+
+
+
+
+class PrefixCache:
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.root = RadixNode()
+        self.num_bytes = 0
+        self.num_nodes = 0
+        self.clock = 0              # Incremented on every access, for the LRU order
+
+        self.hits = 0               # Lookups that found a cached prefix
+        self.misses = 0
+        self.hit_tokens = 0         # Prompt tokens that weren't prefilled again
+        self.lookup_tokens = 0
+        self.evictions = 0
+
+    def match(self, token_ids):
+        # Nodes on the path of the longest cached prefix, with the tokens used from each
+        path, node, position = [], self.root, 0
+        while position < len(token_ids):
+            child = node.children.get(token_ids[position])
+            if child is None:
+                break
+            matched = common_prefix_length(child.tokens, token_ids[position:])
+            path.append((child, matched))
+            position += matched
+            if matched < len(child.tokens):
+                break
+            node = child
+        return path, position
+
+    def touch(self, path):
+        self.clock += 1
+        for node, _ in path:
+            node.last_access = self.clock
+
+    """
+      load
+        Puts the keys/values of the longest cached prefix of token_ids in kv_cache (GPT.KVCache, one
+        sequence) and returns its length, the caller feeds token_ids[length:] to the model.
+    """
+    def load(self, token_ids, kv_cache):
+        path, length = self.match(token_ids)
+        self.touch(path)
+        self.lookup_tokens += len(token_ids)
+        kv_cache.reset()
+        if length == 0:
+            self.misses += 1
+            return 0
+        self.hits += 1
+        self.hit_tokens += length
+
+        num_layers = len(path[0][0].keys)
+        keys = [torch.cat([node.keys[layer][:, :n] for node, n in path], dim=1).unsqueeze(0) for layer in range(num_layers)]
+        values = [torch.cat([node.values[layer][:, :n] for node, n in path], dim=1).unsqueeze(0) for layer in range(num_layers)]
+        kv_cache.load(keys, values)
+        return length
+
+    """
+      insert
+        Adds token_ids to the tree, kv_cache (first row) holds the keys/values of at least these tokens.
+        Only the part after the longest cached prefix is copied.
+    """
+    def insert(self, token_ids, kv_cache):
+        token_ids = tuple(token_ids)
+        path, position = self.match(token_ids)
+        node = self.root
+        if path:
+            node, matched = path[-1]
+            if matched < len(node.tokens):
+                node = self.split(node, matched)
+                path[-1] = (node, matched)
+
+        if position < len(token_ids):
+            leaf = RadixNode(
+                token_ids[position:],
+                [kv_cache.keys[layer][0, :, position:len(token_ids)].clone() for layer in range(len(kv_cache.keys))],
+                [kv_cache.values[layer][0, :, position:len(token_ids)].clone() for layer in range(len(kv_cache.values))],
+                parent=node
+            )
+            node.children[leaf.tokens[0]] = leaf
+            self.num_bytes += leaf.num_bytes()
+            self.num_nodes += 1
+            path.append((leaf, len(leaf.tokens)))
+        self.touch(path)
+        self.evict()
+
+    def split(self, node, length):
+        # node becomes the child of a new node holding its first length tokens
+        parent = RadixNode(
+            node.tokens[:length],
+            [k[:, :length].clone() for k in node.keys],
+            [v[:, :length].clone() for v in node.values],
+            parent=node.parent
+        )
+        parent.last_access = node.last_access
+        parent.children[node.tokens[length]] = node
+        node.parent.children[node.tokens[0]] = parent
+        node.tokens = node.tokens[length:]
+        node.keys = [k[:, length:].clone() for k in node.keys]
+        node.values = [v[:, length:].clone() for v in node.values]
+        node.parent = parent
+        self.num_nodes += 1
+        return parent
+
+    def evict(self):
+        # Least recently used leaves first, a parent is never more recent than its children
+        while self.num_bytes > self.max_bytes:
+            leaf = min(self.leaves(), key=lambda node: node.last_access)
+            del leaf.parent.children[leaf.tokens[0]]
+            self.num_bytes -= leaf.num_bytes()
+            self.num_nodes -= 1
+            self.evictions += 1
+
+    def leaves(self):
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            else:
+                yield node
+
+    def clear(self):
+        self.root = RadixNode()
+        self.num_bytes = 0
+        self.num_nodes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(lookups, 1),
+            "hit_tokens": self.hit_tokens,
+            "lookup_tokens": self.lookup_tokens,
+            "token_hit_rate": self.hit_tokens / max(self.lookup_tokens, 1),
+            "evictions": self.evictions,
+            "num_nodes": self.num_nodes,
+            "num_bytes": self.num_bytes,
+            "max_bytes": self.max_bytes
+        }
+
+
+
+
+def common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+
+
+"""
+  prefill
+    Prefill of one prompt (list of token ids) starting from its longest cached prefix. Returns the
+    GPT.KVCache with the prompt and the logits of its last token (1, vocab_size). The prompt is added
+    to the cache.
+"""
+def prefill(model, token_ids, prefix_cache, context_size):
+    device = next(model.parameters()).device
+    kv_cache = GPT.KVCache(len(model.trf_blocks), context_size)
+    # At least the last token goes through the model for its logits
+    num_cached = prefix_cache.load(token_ids[:-1], kv_cache)
+    idx = torch.tensor([token_ids[num_cached:]], dtype=torch.long, device=device)
+    logits = model(idx, kv_cache=kv_cache, output_positions="last")
+    prefix_cache.insert(token_ids, kv_cache)
+    return kv_cache, logits[:, -1, :]
+
+
+
+
+if __name__ == "__main__":
+    from app import load_model
+
+    parser = argparse.ArgumentParser(description="Prefill time with and without the prefix cache")
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--model", default="gpt2-small (124M)", choices=list(GPT.model_configs))
+    parser.add_argument("--max-mb", type=float, default=256)
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    model, config = load_model(args.model, args.checkpoint, torch.device(args.device) if args.device else None)
+    tokenizer = GPT.create_tokenizer()
+    # Instruction prompts share the template of the fine-tuning data
+    instructions = ["Rewrite the sentence in passive voice.", "Name the capital of France.",
+                    "Convert 45 kilometers to meters.", "Give a synonym for 'happy'."]
+    prompts = [tokenizer.encode(GPTA.format_input({"instruction": text, "input": ""}) + "\n\n### Response:\n")
+               for text in instructions]
+
+    prefix_cache = PrefixCache(int(args.max_mb * 2**20))
+    with torch.no_grad():
+        for name, cache in (("without prefix cache", None), ("with prefix cache", prefix_cache)):
+            start = time.perf_counter()
+            for token_ids in prompts * 4:
+                if cache is None:
+                    model(torch.tensor([token_ids], device=next(model.parameters()).device), output_positions="last")
+                else:
+                    prefill(model, token_ids, cache, config["context_length"])
+            print(f"{name}: {(time.perf_counter() - start) * 1000 / (len(prompts) * 4):.1f} ms/prompt")
+    print(prefix_cache.stats())
@@ -0,0 +1,142 @@
+import io
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, float_qparams_weight_only_qconfig
+
+import GPT
+import GPTC
+
+
+"""
+  Int8 dynamic quantization for CPU serving.
+    Every nn.Linear (attention, feed forward and out_head, also the 2 class out_head of the
+    GPTC classifier) gets int8 weights and int8 matmuls with the activations quantized on the fly.
+    With embeddings=True tok_emb/pos_emb also keep int8 weights (weight only).
+
+  python quantize.py --checkpoint model.pth --output model-int8.pth --benchmark-text the-verdict.txt
+"""
+
+
+def quantize_model(model, embeddings=False):
+    qconfig_spec = {nn.Linear: default_dynamic_qconfig}
+    if embeddings:
+        qconfig_spec[nn.Embedding] = float_qparams_weight_only_qconfig
+    # Returns a quantized copy, the float model is not modified
+    return quantize_dynamic(model.eval(), qconfig_spec, dtype=torch.qint8)
+
+
+
+
+def build_model(config, num_classes=None):
+    model = GPT.GPTModel(config)
+    if num_classes is not None:
+        # Classifier head of GPTC
+        model.out_head = nn.Linear(config["emb_dim"], num_classes)
+    return model.eval()
+
+
+
+
+"""
+  save_quantized / load_quantized
+    The quantized modules can only be rebuilt from the architecture, so the configuration is
+    saved next to the state_dict.
+"""
+def save_quantized(model, file_path, config, num_classes=None, embeddings=False):
+    torch.save({
+        "config": config,
+        "num_classes": num_classes,
+        "embeddings": embeddings,
+        "state_dict": model.state_dict()
+    }, file_path)
+
+
+
+def load_quantized(file_path):
+    checkpoint = torch.load(file_path, map_location="cpu", weights_only=True)
+    model = quantize_model(build_model(checkpoint["config"], checkpoint["num_classes"]), checkpoint["embeddings"])
+    model.load_state_dict(checkpoint["state_dict"])
+    return model
+
+
+
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+
+
+def forward_latency(model, input_batch, num_runs=10):
+    timings = []
+    with torch.no_grad():
+        model(input_batch)  # Warm up
+        for _ in range(num_runs):
+            start = time.perf_counter()
+            model(input_batch)
+            timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+
+
+"""
+  compare_models
+    Latency, size and quality of the quantized model against the float one. Quality is the
+    perplexity on data_loader, or the accuracy for a classifier (GPTC).
+"""
+def compare_models(model, quantized, data_loader, classifier=False, num_batches=None):
+    input_batch, _ = next(iter(data_loader))
+    results = {}
+    for name, m in (("fp32", model), ("int8", quantized)):
+        result = {
+            "size_mb": model_size_mb(m),
+            "latency_ms": forward_latency(m, input_batch) * 1000
+        }
+        if classifier:
+            result["accuracy"] = GPTC.calc_accuracy_loader(data_loader, m, "cpu", num_batches=num_batches)
+        else:
+            with torch.no_grad():
+                loss = GPT.calc_loss_loader(data_loader, m, "cpu", num_batches=num_batches)
+            result["perplexity"] = torch.exp(torch.tensor(loss)).item()
+        results[name] = result
+    return results
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Int8 dynamic quantization of a GPTModel checkpoint")
+    parser.add_argument("--checkpoint", required=True, help="state_dict saved with torch.save")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--model", default="gpt2-small (124M)", choices=list(GPT.model_configs))
+    parser.add_argument("--no-qkv-bias", action="store_true")
+    parser.add_argument("--num-classes", type=int, default=None, help="Classifier checkpoint (GPTC)")
+    parser.add_argument("--embeddings", action="store_true", help="Also int8 weight-only embeddings")
+    parser.add_argument("--benchmark-text", default=None, help="Text to compare perplexity and latency (language model)")
+    parser.add_argument("--benchmark-csv", default=None, help="SpamDataset csv to compare accuracy and latency (classifier)")
+    args = parser.parse_args()
+
+    config = GPT.get_model_config(args.model, qkv_bias=not args.no_qkv_bias)
+    model = build_model(config, args.num_classes)
+    model.load_state_dict(torch.load(args.checkpoint, map_location="cpu", weights_only=True))
+    quantized = quantize_model(model, args.embeddings)
+    save_quantized(quantized, args.output, config, args.num_classes, args.embeddings)
+    print(f"Saved the int8 model to {args.output}")
+
+    data_loader = None
+    if args.benchmark_text is not None:
+        with open(args.benchmark_text, "r", encoding="utf-8") as file:
+            text = file.read()
+        data_loader = GPT.create_data_loader(text, batch_size=2, max_length=256, stride=256, shuffle=False, drop_last=False)
+    elif args.benchmark_csv is not None:
+        dataset = GPTC.SpamDataset(args.benchmark_csv, GPT.create_tokenizer())
+        data_loader = GPTC.create_spam_data_loader(dataset, batch_size=8)
+    if data_loader is not None:
+        results = compare_models(model, quantized, data_loader, classifier=args.num_classes is not None, num_batches=20)
+        for name, result in results.items():
+            print(name, " | ".join(f"{key} {value:.3f}" for key, value in result.items()))
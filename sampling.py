@@ -0,0 +1,247 @@
+import time
+import argparse
+
+import torch
+
+import GPT
+
+
+"""
+  Batched sampling: every row of the decode batch has its own temperature, top_k, top_p (nucleus),
+  repetition/frequency/presence penalties and optional seed, and the next tokens of all the rows are
+  sampled in one pass over the (batch, vocab_size) logits, so requests with different settings share
+  a batch (app.py). With top_k/top_p only the largest logits are sorted and sampled from (inverse
+  CDF with one uniform number per row, drawn from the row's own generator when it has a seed).
+
+  python sampling.py --batch-sizes 1 8 32
+"""
+
+
+class SamplingParams:
+    def __init__(self, temperature=0.0, top_k=None, top_p=None, repetition_penalty=1.0,
+                 frequency_penalty=0.0, presence_penalty=0.0, seed=None):
+        self.temperature = temperature              # 0 is greedy (argmax)
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty    # > 1 divides the positive logits of the seen tokens (CTRL)
+        self.frequency_penalty = frequency_penalty      # Subtracted once per occurrence of the token
+        self.presence_penalty = presence_penalty        # Subtracted once if the token occurred
+        self.seed = seed
+        self.generator = None
+
+
+
+
+"""
+  Sampler(params, vocab_size, device, prompts)
+    One SamplingParams per row, prompts (token id lists) are counted for the penalties together
+    with the generated tokens. select/append follow the rows of GPT.KVCache in the decode batch.
+"""
+class Sampler:
+    def __init__(self, params, vocab_size, device="cpu", prompts=None):
+        self.params = list(params)
+        self.vocab_size = vocab_size
+        self.device = torch.device(device)
+        for p in self.params:
+            if p.seed is not None and p.generator is None:
+                p.generator = torch.Generator(device=self.device).manual_seed(p.seed)
+
+        self.counts = torch.zeros((len(self.params), vocab_size), device=self.device)
+        if prompts is not None:
+            for row, token_ids in enumerate(prompts):
+                self.counts[row].index_add_(0, torch.as_tensor(token_ids, dtype=torch.long, device=self.device),
+                                            torch.ones(len(token_ids), device=self.device))
+        self.refresh()
+
+    # Per-row parameters as tensors, rebuilt only when the rows change
+    def refresh(self):
+        def column(values, dtype=torch.float32):
+            return torch.tensor(values, dtype=dtype, device=self.device)[:, None]
+
+        params = self.params
+        has_top_k = [p.temperature > 0.0 and p.top_k is not None and p.top_k < self.vocab_size for p in params]
+        has_top_p = [p.temperature > 0.0 and p.top_p is not None and p.top_p < 1.0 for p in params]
+        self.temperature = column([p.temperature if p.temperature > 0.0 else 1.0 for p in params])
+        self.greedy = column([p.temperature <= 0.0 for p in params], torch.bool)
+        self.top_k = column([p.top_k if k else self.vocab_size for p, k in zip(params, has_top_k)], torch.long)
+        self.top_p = column([p.top_p if top_p else float("inf") for p, top_p in zip(params, has_top_p)])
+        self.nucleus_only = column([top_p and not k for k, top_p in zip(has_top_k, has_top_p)], torch.bool)
+        self.repetition_penalty = column([p.repetition_penalty for p in params])
+        self.frequency_penalty = column([p.frequency_penalty for p in params])
+        self.presence_penalty = column([p.presence_penalty for p in params])
+        self.generators = [(row, p.generator) for row, p in enumerate(params) if p.generator is not None]
+
+        # What the batch needs, the rest of the work is skipped
+        self.all_greedy = all(p.temperature <= 0.0 for p in params)
+        self.any_greedy = any(p.temperature <= 0.0 for p in params)
+        self.use_top_k = any(has_top_k)
+        self.use_top_p = any(has_top_p)
+        self.any_nucleus_only = any(top_p and not k for k, top_p in zip(has_top_k, has_top_p))
+        self.use_repetition = any(p.repetition_penalty != 1.0 for p in params)
+        self.use_frequency = any(p.frequency_penalty != 0.0 for p in params)
+        self.use_presence = any(p.presence_penalty != 0.0 for p in params)
+        # Every sampled row has top_k or top_p: only the largest logits are candidates
+        self.truncate = all(k or top_p or p.temperature <= 0.0 for p, k, top_p in zip(params, has_top_k, has_top_p))
+        candidates = [p.top_k for p, k in zip(params, has_top_k) if k]
+        if self.any_nucleus_only:
+            candidates.append(self.nucleus_candidates)
+        self.num_candidates = min(max(candidates, default=1), self.vocab_size)
+
+    # Candidates of the rows with top_p and no top_k, the whole vocabulary is sorted if they don't hold top_p
+    nucleus_candidates = 1024
+
+    def __len__(self):
+        return len(self.params)
+
+    # Keep only the given rows (bool mask or indices)
+    def select(self, rows):
+        rows = torch.as_tensor(rows, device=self.device)
+        indices = rows.nonzero().squeeze(1) if rows.dtype == torch.bool else rows
+        self.params = [self.params[i] for i in indices.tolist()]
+        self.counts = self.counts[indices]
+        self.refresh()
+
+    def append(self, other):
+        self.params += other.params
+        self.counts = torch.cat((self.counts, other.counts))
+        self.refresh()
+
+    def observe(self, idx_next):
+        self.counts.scatter_add_(1, idx_next, torch.ones_like(idx_next, dtype=self.counts.dtype))
+
+    """
+      __call__
+        Next token ids (b, 1) from the logits (b, vocab_size) of the last position, which are
+        modified in place. Sampled by inverse CDF, one uniform number per row. The sampled tokens are
+        counted for the penalties.
+    """
+    def __call__(self, logits):
+        logits = logits.float()
+        if self.use_repetition or self.use_presence:
+            seen = self.counts > 0
+        if self.use_repetition:
+            penalized = torch.where(logits > 0, logits / self.repetition_penalty, logits * self.repetition_penalty)
+            logits = torch.where(seen, penalized, logits)
+        if self.use_frequency:
+            logits.sub_(self.frequency_penalty * self.counts)
+        if self.use_presence:
+            logits.sub_(self.presence_penalty * seen)
+
+        if self.all_greedy:
+            idx_next = logits.argmax(dim=-1, keepdim=True)
+        else:
+            logits.div_(self.temperature)
+            probs, token_ids = self.distribution(logits)
+            cdf = probs.cumsum(dim=-1)
+            # top_p: the tokens (sorted) while the probability before them is below top_p
+            num_kept = ((cdf - probs) < self.top_p).sum(dim=-1, keepdim=True).clamp(min=1)
+            total = cdf.gather(1, num_kept - 1)
+            choice = torch.searchsorted(cdf, self.uniform() * total, right=True)
+            choice = torch.minimum(choice, num_kept - 1)
+            idx_next = choice if token_ids is None else token_ids.gather(1, choice)
+            if self.any_greedy:
+                idx_next = torch.where(self.greedy, logits.argmax(dim=-1, keepdim=True), idx_next)
+
+        self.observe(idx_next)
+        return idx_next
+
+    """
+      distribution
+        Probabilities of the tokens that can be sampled. With top_k/top_p they are sorted, with their
+        token ids (b, num_candidates), otherwise the whole vocabulary in order (token ids None).
+    """
+    def distribution(self, logits):
+        if not (self.use_top_k or self.use_top_p):
+            return torch.softmax(logits, dim=-1), None
+
+        if not self.truncate and not self.use_top_p:
+            # Rows sampling from the whole vocabulary: mask below the k-th logit of the top_k rows
+            logits.masked_fill_(logits < self.threshold(logits), float("-inf"))
+            return torch.softmax(logits, dim=-1), None
+
+        sorted_logits, token_ids = None, None
+        if self.truncate:
+            sorted_logits, token_ids = torch.topk(logits, self.num_candidates)
+            if self.any_nucleus_only:
+                # The rows without top_k are normalized over the whole vocabulary, top_p must be within the candidates
+                log_norm = torch.logsumexp(logits, dim=-1, keepdim=True)
+                mass = torch.exp(sorted_logits - log_norm).sum(dim=-1, keepdim=True)
+                if not bool((mass >= self.top_p)[self.nucleus_only].all()):
+                    sorted_logits, token_ids = None, None
+        if sorted_logits is None:
+            sorted_logits, token_ids = torch.sort(logits, dim=-1, descending=True)
+
+        positions = torch.arange(sorted_logits.shape[1], device=self.device)
+        sorted_logits.masked_fill_(positions >= self.top_k, float("-inf"))
+        probs = torch.softmax(sorted_logits, dim=-1)
+        if self.any_nucleus_only and sorted_logits.shape[1] < self.vocab_size:
+            probs = torch.where(self.nucleus_only, torch.exp(sorted_logits - log_norm), probs)
+        return probs, token_ids
+
+    # k-th largest logit of the rows with top_k, -inf for the others
+    def threshold(self, logits):
+        limited = self.top_k < self.vocab_size
+        top_logits, _ = torch.topk(logits, int(self.top_k[limited].max()))
+        threshold = top_logits.gather(1, self.top_k.clamp(max=top_logits.shape[1]) - 1)
+        return threshold.masked_fill_(~limited, float("-inf"))
+
+    # One uniform number per row, from the row generator if it has a seed
+    def uniform(self):
+        u = torch.rand((len(self.params), 1), device=self.device)
+        for row, generator in self.generators:
+            u[row] = torch.rand(1, generator=generator, device=self.device)
+        return u
+
+
+
+
+"""
+  benchmark
+    Time per decode step of the sampling alone: GPT.sample_next_token called once per row (as the
+    server did for requests with different settings) against one Sampler call for the whole batch.
+    The logits are random with the spread of a trained model (most of the mass on a few tokens).
+    sample_next_token has no top_p or penalties, it samples the "top_p + penalties" rows with top_k.
+"""
+def benchmark(batch_sizes=(1, 8, 32), vocab_size=50257, steps=50, device="cpu"):
+    configs = {
+        "greedy": SamplingParams(),
+        "temperature": SamplingParams(temperature=0.8),
+        "top_k": SamplingParams(temperature=0.8, top_k=50),
+        "top_p": SamplingParams(temperature=0.8, top_p=0.9),
+        "top_p + penalties": SamplingParams(temperature=0.8, top_k=50, top_p=0.9, repetition_penalty=1.2, frequency_penalty=0.1)
+    }
+    results = {}
+    for name, params in configs.items():
+        for batch_size in batch_sizes:
+            logits = torch.randn(batch_size, vocab_size, device=device) * 4
+            sampler = Sampler([params] * batch_size, vocab_size, device)
+
+            start = time.perf_counter()
+            for _ in range(steps):
+                batch = logits.clone()
+                for row in range(batch_size):
+                    GPT.sample_next_token(batch[row:row + 1], params.temperature, params.top_k)
+            per_row = (time.perf_counter() - start) / steps
+
+            start = time.perf_counter()
+            for _ in range(steps):
+                sampler(logits.clone())
+            batched = (time.perf_counter() - start) / steps
+            results[(name, batch_size)] = {"sample_next_token_ms": per_row * 1000, "sampler_ms": batched * 1000, "speedup": per_row / batched}
+    return results
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sampling cost per decode step")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--vocab-size", type=int, default=50257)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    results = benchmark(args.batch_sizes, args.vocab_size, args.steps, args.device)
+    for (name, batch_size), result in results.items():
+        print(f"{name:>18} | batch {batch_size:>3} | sample_next_token per row {result['sample_next_token_ms']:.3f} ms | "
+              f"Sampler {result['sampler_ms']:.3f} ms | {result['speedup']:.2f}x")
@@ -0,0 +1,173 @@
+import time
+import argparse
+
+import torch
+
+import GPT
+
+
+"""
+  Speculative decoding: a small draft GPTModel proposes k tokens, the target model checks them
+  in a single forward pass and keeps them with the acceptance/rejection rule
+    accept draft token x with probability min(1, p(x) / q(x)), on rejection sample from max(0, p - q)
+  (p target and q draft distributions, after the same top_k/temperature as sample_next_token).
+  The generated text has the same distribution as GPT.text_generation with the target model.
+
+  python speculative.py --target "gpt2-medium (355M)" --target-checkpoint gpt2-355M.safetensors \
+      --draft "gpt2-small (124M)" --draft-checkpoint gpt2-124M.safetensors --k 4
+"""
+
+
+def token_probs(logits, temperature=0.0, top_k=None):
+    # Distribution sample_next_token samples from (one-hot on the argmax with temperature 0)
+    if top_k is not None:
+        top_logits, _ = torch.topk(logits, top_k)
+        logits = torch.where(logits < top_logits[..., -1:], torch.tensor(float("-inf"), device=logits.device), logits)
+    if temperature > 0.0:
+        return torch.softmax(logits / temperature, dim=-1)
+    probs = torch.zeros_like(logits)
+    return probs.scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
+
+
+
+def sample(probs):
+    return torch.multinomial(probs, num_samples=1).item()
+
+
+
+
+"""
+  speculative_generation
+    Same arguments as GPT.text_generation (one sequence, idx of shape (1, num_tokens)) plus the draft
+    model and k, the number of draft tokens per target forward pass. Returns the token ids and the
+    statistics {"proposed", "accepted", "acceptance_rate", "target_calls"}.
+    Once the sequence doesn't fit in context_size anymore the rest is generated by the target alone.
+"""
+def speculative_generation(target, draft, idx, num_token_generation, context_size, k=4, temperature=0.0, top_k=None, eos_id=None, precision=None):
+    if idx.shape[0] != 1:
+        raise ValueError("speculative_generation generates one sequence at a time")
+    target_cache = GPT.KVCache(len(target.trf_blocks), context_size)
+    draft_cache = GPT.KVCache(len(draft.trf_blocks), context_size)
+    stats = {"proposed": 0, "accepted": 0, "target_calls": 0}
+    num_generated = 0
+
+    while num_generated < num_token_generation:
+        if idx.shape[1] + k > context_size:
+            remaining = num_token_generation - num_generated
+            idx = GPT.text_generation(target, idx, remaining, context_size, temperature, top_k, eos_id, use_cache=True, precision=precision)
+            break
+
+        with torch.no_grad(), GPT.autocast_context(idx.device, precision):
+            # The draft proposes k tokens, each cache only processes the tokens it hasn't seen yet
+            sequence, draft_tokens, draft_probs = idx, [], []
+            for _ in range(k):
+                logits = draft(sequence[:, len(draft_cache):], kv_cache=draft_cache, output_positions="last")
+                q = token_probs(logits[0, -1].float(), temperature, top_k)
+                token = sample(q) if temperature > 0.0 else q.argmax().item()
+                draft_tokens.append(token)
+                draft_probs.append(q)
+                sequence = torch.cat((sequence, torch.tensor([[token]], device=idx.device)), dim=1)
+
+            # The target scores the k draft tokens (and the one after them) at once
+            logits = target(sequence[:, len(target_cache):], kv_cache=target_cache)
+            p = token_probs(logits[0, -(k + 1):].float(), temperature, top_k)
+        stats["target_calls"] += 1
+        stats["proposed"] += k
+
+        new_tokens = []
+        for i, token in enumerate(draft_tokens):
+            if temperature > 0.0:
+                accepted = torch.rand(1).item() < min(1.0, (p[i, token] / draft_probs[i][token]).item())
+            else:
+                accepted = p[i, token] == 1.0
+            if not accepted:
+                residual = (p[i] - draft_probs[i]).clamp(min=0)
+                new_tokens.append(sample(residual) if residual.sum() > 0 else sample(p[i]))
+                break
+            new_tokens.append(token)
+            stats["accepted"] += 1
+        else:
+            # Every draft token accepted: one more token from the last target distribution
+            new_tokens.append(sample(p[k]))
+
+        # Same stopping as text_generation: at eos (not included) or after num_token_generation tokens
+        new_tokens = new_tokens[:num_token_generation - num_generated]
+        finished = eos_id is not None and eos_id in new_tokens
+        if finished:
+            new_tokens = new_tokens[:new_tokens.index(eos_id)]
+        idx = torch.cat((idx, torch.tensor([new_tokens], dtype=idx.dtype, device=idx.device)), dim=1)
+        num_generated += len(new_tokens)
+        if finished:
+            break
+
+        # Drop the rejected tokens from the caches, the last token of idx is processed on the next step
+        target_cache.truncate(idx.shape[1] - 1)
+        draft_cache.truncate(idx.shape[1] - 1)
+
+    stats["acceptance_rate"] = stats["accepted"] / max(stats["proposed"], 1)
+    return idx, stats
+
+
+
+
+"""
+  benchmark
+    Tokens/sec of GPT.text_generation (target with KV cache) against speculative_generation for each
+    k, with the acceptance rate.
+"""
+def benchmark(target, draft, prompts, tokenizer, num_token_generation=50, context_size=1024, k_values=(2, 4, 6), temperature=0.0, top_k=None, precision=None):
+    device = next(target.parameters()).device
+    encoded = [GPT.text_to_token_ids(prompt, tokenizer).to(device) for prompt in prompts]
+
+    start, num_tokens = time.perf_counter(), 0
+    for idx in encoded:
+        output = GPT.text_generation(target, idx, num_token_generation, context_size, temperature, top_k, use_cache=True, precision=precision)
+        num_tokens += output.shape[1] - idx.shape[1]
+    baseline = num_tokens / (time.perf_counter() - start)
+    results = {"baseline_tokens_per_sec": baseline}
+
+    for k in k_values:
+        start, num_tokens, accepted, proposed = time.perf_counter(), 0, 0, 0
+        for idx in encoded:
+            output, stats = speculative_generation(target, draft, idx, num_token_generation, context_size, k, temperature, top_k, precision=precision)
+            num_tokens += output.shape[1] - idx.shape[1]
+            accepted += stats["accepted"]
+            proposed += stats["proposed"]
+        tokens_per_sec = num_tokens / (time.perf_counter() - start)
+        results[k] = {
+            "tokens_per_sec": tokens_per_sec,
+            "acceptance_rate": accepted / max(proposed, 1),
+            "speedup": tokens_per_sec / baseline
+        }
+    return results
+
+
+
+
+if __name__ == "__main__":
+    from app import load_model
+
+    parser = argparse.ArgumentParser(description="Speculative decoding benchmark")
+    parser.add_argument("--target", default="gpt2-medium (355M)", choices=list(GPT.model_configs))
+    parser.add_argument("--target-checkpoint", default=None)
+    parser.add_argument("--draft", default="gpt2-small (124M)", choices=list(GPT.model_configs))
+    parser.add_argument("--draft-checkpoint", default=None)
+    parser.add_argument("--k", type=int, nargs="+", default=[2, 4, 6])
+    parser.add_argument("--max-new-tokens", type=int, default=50)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--top-k", type=int, default=None)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--prompt", nargs="+", default=["Every effort moves you", "The meaning of life is"])
+    args = parser.parse_args()
+
+    device = torch.device(args.device) if args.device else None
+    target, target_config = load_model(args.target, args.target_checkpoint, device)
+    draft, draft_config = load_model(args.draft, args.draft_checkpoint, device)
+    context_size = min(target_config["context_length"], draft_config["context_length"])
+
+    results = benchmark(target, draft, args.prompt, GPT.create_tokenizer(), args.max_new_tokens, context_size,
+                        args.k, args.temperature, args.top_k)
+    print(f"text_generation: {results.pop('baseline_tokens_per_sec'):.1f} tokens/sec")
+    for k, result in results.items():
+        print(f"k={k}: {result['tokens_per_sec']:.1f} tokens/sec | acceptance rate {result['acceptance_rate']*100:.1f}% | "
+              f"speedup {result['speedup']:.2f}x")
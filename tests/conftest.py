@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+import tiktoken
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Small enough to run in a few seconds on CPU
+@pytest.fixture
+def tiny_config():
+    return {
+        "vocab_size": 257,
+        "context_length": 16,
+        "emb_dim": 32,
+        "n_heads": 4,
+        "n_layers": 2,
+        "drop_rate": 0.0,
+        "qkv_bias": True
+    }
+
+
+# Byte-level encoding with the GPT-2 <|endoftext|> token, no download needed
+@pytest.fixture
+def byte_tokenizer():
+    return tiktoken.Encoding(
+        "bytes",
+        pat_str=r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={"<|endoftext|>": 256}
+    )
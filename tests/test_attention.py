@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+import GPT
+
+
+def build_models(config):
+    # Same weights in both implementations, loaded through the qkv split/concat of _load_from_state_dict
+    torch.manual_seed(123)
+    default = GPT.GPTModel(config).eval()
+    fused = GPT.GPTModel({**config, "attn_impl": "fused"}).eval()
+    fused.load_state_dict(default.state_dict())
+    return default, fused
+
+
+@pytest.mark.parametrize("source", ["default", "fused"])
+def test_state_dict_round_trip(tiny_config, source):
+    default, fused = build_models(tiny_config)
+    if source == "fused":
+        # Split qkv back into W_query/W_key/W_value
+        default = GPT.GPTModel(tiny_config).eval()
+        default.load_state_dict(fused.state_dict())
+
+    att, fused_att = default.trf_blocks[0].att, fused.trf_blocks[0].att
+    weight = torch.cat((att.W_query.weight, att.W_key.weight, att.W_value.weight))
+    assert torch.equal(fused_att.qkv.weight, weight)
+    assert fused_att.mask.dtype == torch.bool
+
+
+def test_forward_matches(tiny_config):
+    default, fused = build_models(tiny_config)
+    idx = torch.randint(0, tiny_config["vocab_size"], (2, tiny_config["context_length"]))
+    with torch.no_grad():
+        torch.testing.assert_close(fused(idx), default(idx), rtol=1e-4, atol=1e-5)
+
+
+def test_cached_decode_matches(tiny_config):
+    default, fused = build_models(tiny_config)
+    idx = torch.randint(0, tiny_config["vocab_size"], (2, 10))
+    logits = []
+    with torch.no_grad():
+        for model in (default, fused):
+            # Prefill of 6 tokens, then one token at a time
+            kv_cache = GPT.KVCache(tiny_config["n_layers"], tiny_config["context_length"])
+            steps = [model(idx[:, :6], kv_cache=kv_cache)]
+            steps += [model(idx[:, i:i + 1], kv_cache=kv_cache) for i in range(6, 10)]
+            logits.append(torch.cat(steps, dim=1))
+    torch.testing.assert_close(logits[1], logits[0], rtol=1e-4, atol=1e-5)
+
+
+def test_padded_batch_matches(tiny_config):
+    default, fused = build_models(tiny_config)
+    idx = torch.randint(0, tiny_config["vocab_size"], (3, 8))
+    # Left padded rows with 8, 5 and 2 real tokens
+    attn_mask = torch.arange(8) >= torch.tensor([[0], [3], [6]])
+    pos_offset = attn_mask.sum(dim=1) - attn_mask.shape[1]
+    with torch.no_grad():
+        expected = default(idx, pos_offset=pos_offset, attn_mask=attn_mask)
+        actual = fused(idx, pos_offset=pos_offset, attn_mask=attn_mask)
+    # Outputs of the padding positions are not used
+    torch.testing.assert_close(actual[attn_mask], expected[attn_mask], rtol=1e-4, atol=1e-5)
+
+
+def test_assign_load_keeps_bool_mask(tiny_config):
+    # load_state_dict(assign=True) (checkpoint.load_model) binds the float mask of the default attention as is
+    default, _ = build_models(tiny_config)
+    with torch.device("meta"):
+        fused = GPT.GPTModel({**tiny_config, "attn_impl": "fused"})
+    fused.load_state_dict(default.state_dict(), assign=True)
+    fused.eval()
+    assert fused.trf_blocks[0].att.mask.dtype == torch.bool
+
+    idx = torch.randint(0, tiny_config["vocab_size"], (2, 8))
+    attn_mask = torch.arange(8) >= torch.tensor([[0], [3]])
+    pos_offset = attn_mask.sum(dim=1) - attn_mask.shape[1]
+    with torch.no_grad():
+        expected = default(idx, pos_offset=pos_offset, attn_mask=attn_mask)
+        actual = fused(idx, pos_offset=pos_offset, attn_mask=attn_mask)
+    torch.testing.assert_close(actual[attn_mask], expected[attn_mask], rtol=1e-4, atol=1e-5)
@@ -0,0 +1,31 @@
+import pytest
+import torch
+
+import GPT
+import GPTC
+
+
+@pytest.fixture
+def classifier(tiny_config):
+    torch.manual_seed(123)
+    model = GPT.GPTModel(tiny_config)
+    model.out_head = torch.nn.Linear(tiny_config["emb_dim"], 2)
+    return model.eval()
+
+
+@pytest.mark.parametrize("pad_token_id", [0, 256])
+def test_spam_batch_classifies_last_token_of_every_message(classifier, pad_token_id):
+    # Not the default pad id (50256), and the messages contain the pad token
+    messages = [[5, 256, 7, 9, 11], [3, 0], [4], [256, 8, 256]]
+    input_batch, labels = GPTC.collate_spam_batch([(tokens, i % 2) for i, tokens in enumerate(messages)], pad_token_id)
+
+    assert input_batch["last_positions"].tolist() == [4, 1, 0, 2]
+    with torch.no_grad():
+        logits = GPTC.last_token_logits(classifier, input_batch)
+        for row, tokens in enumerate(messages):
+            expected = classifier(torch.tensor([tokens]))[0, -1]
+            torch.testing.assert_close(logits[row], expected)
+
+        loss = GPTC.calc_loss_batch(input_batch, labels, classifier, "cpu")
+        expected_loss = torch.nn.functional.cross_entropy(logits, labels)
+    torch.testing.assert_close(loss, expected_loss)
@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+import GPT
+
+
+@pytest.fixture
+def model(tiny_config):
+    torch.manual_seed(123)
+    return GPT.GPTModel(tiny_config).eval()
+
+
+@pytest.mark.parametrize("num_tokens", [5, 30])
+def test_cached_generation_matches_uncached(model, tiny_config, num_tokens):
+    # 30 tokens after a 6 token prompt go past context_length (16): sliding-window re-prefill
+    torch.manual_seed(0)
+    idx = torch.randint(0, tiny_config["vocab_size"], (2, 6))
+    context_size = tiny_config["context_length"]
+
+    uncached = GPT.text_generation(model, idx, num_tokens, context_size, use_cache=False)
+    cached = GPT.text_generation(model, idx, num_tokens, context_size, use_cache=True)
+
+    assert cached.shape == (2, 6 + num_tokens)
+    assert torch.equal(cached, uncached)
+
+
+def test_kv_cache_overflow(tiny_config):
+    kv_cache = GPT.KVCache(tiny_config["n_layers"], 4)
+    keys = torch.zeros(1, 2, 3, 8)
+    kv_cache.update(0, keys, keys)
+    with pytest.raises(ValueError):
+        kv_cache.update(0, keys, keys)
+
+
+@pytest.mark.parametrize("num_tokens", [4, 20])
+def test_batched_generation_cached_matches_uncached(model, tiny_config, byte_tokenizer, num_tokens):
+    # Prompts of different lengths are left padded, 20 tokens slide the window of the longest ones
+    prompts = ["Every effort", "moves you", "a", "The quick brown"]
+    context_size = tiny_config["context_length"]
+
+    uncached = GPT.batch_text_generation(model, prompts, byte_tokenizer, num_tokens, context_size, pad_token_id=256, use_cache=False)
+    cached = GPT.batch_text_generation(model, prompts, byte_tokenizer, num_tokens, context_size, pad_token_id=256, use_cache=True)
+
+    assert cached == uncached
@@ -0,0 +1,23 @@
+from contextlib import nullcontext
+
+import pytest
+import torch
+
+import GPT
+
+
+@pytest.mark.parametrize("precision", [None, "fp32"])
+def test_fp32_does_not_build_autocast(precision):
+    # torch.autocast raises for some devices (mps before torch 2.5) even when disabled
+    for device in ("cpu", "mps", "cuda"):
+        assert isinstance(GPT.autocast_context(device, precision), nullcontext)
+
+
+def test_bf16_autocast():
+    with GPT.autocast_context("cpu", "bf16"):
+        assert (torch.ones(2, 2) @ torch.ones(2, 2)).dtype == torch.bfloat16
+
+
+def test_unknown_precision():
+    with pytest.raises(ValueError):
+        GPT.autocast_context("cpu", "fp16")
@@ -0,0 +1,87 @@
+import os
+import random
+from itertools import product
+
+import numpy as np
+import pytest
+import tiktoken
+
+import tokenize_corpus
+
+
+# Merges of 2 and 3 characters, so a different GPT-2 split of the text gives different token ids
+@pytest.fixture
+def merge_tokenizer(byte_tokenizer):
+    ranks = {bytes([i]): i for i in range(256)}
+    for length in (2, 3):
+        for chars in product("ab \n", repeat=length):
+            ranks["".join(chars).encode()] = len(ranks)
+    return tiktoken.Encoding("merges", pat_str=byte_tokenizer._pat_str, mergeable_ranks=ranks,
+                             special_tokens={"<|endoftext|>": len(ranks)})
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    # Words, runs of spaces and newlines (trailing spaces before an indented line), some empty documents
+    rng = random.Random(0)
+    pieces = ["a", "ab", "b", " ", "  ", "\n", " \n ", "\n\n", "é"]
+    paths = []
+    for i in range(3):
+        documents = ["".join(rng.choice(pieces) for _ in range(rng.randint(0, 60))) for _ in range(5)]
+        path = tmp_path / f"part_{i}.txt"
+        path.write_text("<|endoftext|>".join(documents), encoding="utf-8")
+        paths.append(str(path))
+    return paths
+
+
+def expected_tokens(paths, tokenizer):
+    token_ids = []
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            for document in file.read().split("<|endoftext|>"):
+                if document:
+                    token_ids += tokenizer.encode_ordinary(document) + [tokenizer.eot_token]
+    return token_ids
+
+
+def read_shards(output_dir):
+    shards = sorted(name for name in os.listdir(output_dir) if name.endswith(".bin"))
+    return np.concatenate([np.fromfile(os.path.join(output_dir, name), dtype=np.uint16) for name in shards]).tolist()
+
+
+def test_cut_keeps_whitespace_runs_together():
+    assert tokenize_corpus._cut(b"a \n b") == 1
+    assert tokenize_corpus._cut(b"ab  cd") == 2
+    assert tokenize_corpus._cut(b"a x<|endoftext|", b"<|endoftext|>") == 1
+    assert tokenize_corpus._cut(b"  abab") is None
+
+
+@pytest.mark.parametrize("chunk_size", [16, 23, 1 << 20])
+def test_chunks_match_whole_file(tmp_path, corpus, merge_tokenizer, chunk_size):
+    output_dir = str(tmp_path / "shards")
+    tokenize_corpus.tokenize_corpus(corpus, output_dir, shard_size=100, separator="<|endoftext|>",
+                                    chunk_size=chunk_size, num_workers=1, tokenizer=merge_tokenizer)
+    assert read_shards(output_dir) == expected_tokens(corpus, merge_tokenizer)
+
+
+@pytest.mark.parametrize("stop_after", [1, 5, 12])
+def test_resume_matches_whole_file(tmp_path, corpus, merge_tokenizer, monkeypatch, stop_after):
+    output_dir = str(tmp_path / "shards")
+    write = tokenize_corpus.ShardWriter.write
+    calls = []
+
+    # The first run stops after stop_after chunks were written, the second one resumes from progress.json
+    def interrupted_write(self, token_ids):
+        if len(calls) == stop_after:
+            raise KeyboardInterrupt
+        calls.append(len(token_ids))
+        write(self, token_ids)
+
+    monkeypatch.setattr(tokenize_corpus.ShardWriter, "write", interrupted_write)
+    with pytest.raises(KeyboardInterrupt):
+        tokenize_corpus.tokenize_corpus(corpus, output_dir, shard_size=100, separator="<|endoftext|>",
+                                        chunk_size=16, num_workers=1, tokenizer=merge_tokenizer)
+    monkeypatch.setattr(tokenize_corpus.ShardWriter, "write", write)
+    tokenize_corpus.tokenize_corpus(corpus, output_dir, shard_size=100, separator="<|endoftext|>",
+                                    chunk_size=16, num_workers=1, tokenizer=merge_tokenizer)
+    assert read_shards(output_dir) == expected_tokens(corpus, merge_tokenizer)
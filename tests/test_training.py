@@ -0,0 +1,80 @@
+import os
+
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+import GPT
+from instrumentation import Profiler
+
+
+TEXT = " ".join(f"Every effort moves you {i} steps closer to the end of chapter {i % 7}." for i in range(40))
+
+
+def make_run(tiny_config, byte_tokenizer):
+    torch.manual_seed(123)
+    model = GPT.GPTModel(tiny_config)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3, weight_decay=0.1)
+    train_text, val_text = GPT.train_test_split(TEXT, 0.9)
+    max_length = tiny_config["context_length"]
+    train_loader = DataLoader(GPT.GPTDataset(train_text, byte_tokenizer, max_length, max_length), batch_size=4, shuffle=True, drop_last=True)
+    val_loader = DataLoader(GPT.GPTDataset(val_text, byte_tokenizer, max_length, max_length), batch_size=4, shuffle=False)
+    return model, optimizer, train_loader, val_loader
+
+
+def reference_training(model, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter, start_context, tokenizer):
+    # The loop of train_model_simple written out, without checkpoints or profiling
+    train_losses, val_losses, track_tokens_seen = [], [], []
+    tokens_seen, global_step = 0, -1
+    for epoch in range(num_epochs):
+        model.train()
+        for input_batch, target_batch in train_loader:
+            optimizer.zero_grad()
+            loss = GPT.calc_loss_batch(input_batch, target_batch, model, device)
+            loss.backward()
+            optimizer.step()
+            tokens_seen += input_batch.numel()
+            global_step += 1
+            if global_step % eval_freq == 0:
+                train_loss, val_loss = GPT.evaluate_model(model, train_loader, val_loader, device, eval_iter)
+                train_losses.append(train_loss)
+                val_losses.append(val_loss)
+                track_tokens_seen.append(tokens_seen)
+        GPT.generate_and_print_sample(model, tokenizer, device, start_context)
+    return train_losses, val_losses, track_tokens_seen
+
+
+def train(tiny_config, byte_tokenizer, train_fn=GPT.train_model_simple, **kwargs):
+    model, optimizer, train_loader, val_loader = make_run(tiny_config, byte_tokenizer)
+    result = train_fn(model, train_loader, val_loader, optimizer, "cpu", num_epochs=2, eval_freq=2, eval_iter=2,
+                      start_context="Every effort", tokenizer=byte_tokenizer, **kwargs)
+    return result, model
+
+
+@pytest.mark.parametrize("options", ["plain", "checkpoints", "profiler"])
+def test_train_model_simple_matches_reference_loop(tiny_config, byte_tokenizer, tmp_path, options):
+    kwargs = {"checkpoints": {"checkpoint_dir": str(tmp_path), "checkpoint_freq": 3},
+              "profiler": {"profiler": Profiler()}}.get(options, {})
+    expected, expected_model = train(tiny_config, byte_tokenizer, reference_training)
+    result, model = train(tiny_config, byte_tokenizer, **kwargs)
+
+    assert len(result[0]) > 2
+    assert result == expected
+    for param, expected_param in zip(model.parameters(), expected_model.parameters()):
+        assert torch.equal(param, expected_param)
+
+
+def test_train_model_simple_resume(tiny_config, byte_tokenizer, tmp_path):
+    checkpoint_dir = str(tmp_path)
+    expected, expected_model = train(tiny_config, byte_tokenizer, checkpoint_dir=checkpoint_dir, checkpoint_freq=3, keep_last=100)
+
+    # Interrupted in the middle of the first epoch: only the earliest checkpoint is left
+    checkpoints = sorted(os.listdir(checkpoint_dir))
+    assert len(checkpoints) > 2
+    for name in checkpoints[1:]:
+        os.remove(os.path.join(checkpoint_dir, name))
+
+    result, model = train(tiny_config, byte_tokenizer, checkpoint_dir=checkpoint_dir, checkpoint_freq=3, keep_last=100)
+    assert result == expected
+    for param, expected_param in zip(model.parameters(), expected_model.parameters()):
+        assert torch.equal(param, expected_param)
@@ -0,0 +1,210 @@
+import time
+import argparse
+import threading
+from collections import OrderedDict
+
+import torch
+import tiktoken
+
+
+"""
+  Tokenizer shared by the whole process (GPT.create_tokenizer) with an LRU cache of the encoded
+  strings, so repeated prompts and preambles on the request path are not encoded again.
+  encode_batch/decode_batch go through tiktoken's batch functions (threads without the GIL) and
+  give padded tensors with their attention mask.
+
+  python tokenization.py --repeat 10
+"""
+
+
+def cache_key(value):
+    # allowed_special/disallowed_special are sets or "all"
+    return value if isinstance(value, str) else frozenset(value)
+
+
+
+
+"""
+  CachedTokenizer(encoding, max_size, max_text_length)
+    Same interface as the tiktoken Encoding it wraps (encode, decode, decode_single_token_bytes, name,
+    n_vocab, ...). encode results are kept for the max_size most recently used strings up to
+    max_text_length characters (whole books are not worth caching), encode_batch encodes the rest.
+"""
+class CachedTokenizer:
+    def __init__(self, encoding, max_size=4096, max_text_length=16384):
+        self.encoding = encoding
+        self.max_size = max_size
+        self.max_text_length = max_text_length
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()    # The server and classify_stream encode from several threads
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # Everything else from the tiktoken Encoding
+        if name == "encoding":
+            raise AttributeError(name)
+        return getattr(self.encoding, name)
+
+    def __reduce__(self):
+        # DataLoader workers get the singleton of their own process
+        return get_tokenizer, (self.encoding.name,)
+
+    def lookup(self, key):
+        with self.lock:
+            token_ids = self.cache.get(key)
+            if token_ids is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return token_ids
+
+    def store(self, key, token_ids):
+        with self.lock:
+            self.cache[key] = token_ids
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def encode(self, text, allowed_special=set(), disallowed_special="all"):
+        if len(text) > self.max_text_length:
+            return self.encoding.encode(text, allowed_special=allowed_special, disallowed_special=disallowed_special)
+        key = (text, cache_key(allowed_special), cache_key(disallowed_special))
+        token_ids = self.lookup(key)
+        if token_ids is None:
+            token_ids = tuple(self.encoding.encode(text, allowed_special=allowed_special, disallowed_special=disallowed_special))
+            self.store(key, token_ids)
+        return list(token_ids)
+
+    # tiktoken's encode_batch (threads without the GIL) for the texts that are not cached
+    def encode_batch(self, text, num_threads=8, allowed_special=set(), disallowed_special="all"):
+        allowed, disallowed = cache_key(allowed_special), cache_key(disallowed_special)
+        token_ids, missing = [], []
+        for i, item in enumerate(text):
+            cached = self.lookup((item, allowed, disallowed)) if len(item) <= self.max_text_length else None
+            token_ids.append(cached)
+            if cached is None:
+                missing.append(i)
+        if missing:
+            encoded = self.encoding.encode_batch([text[i] for i in missing], num_threads=num_threads,
+                                                 allowed_special=allowed_special, disallowed_special=disallowed_special)
+            for i, ids in zip(missing, encoded):
+                token_ids[i] = tuple(ids)
+                if len(text[i]) <= self.max_text_length:
+                    self.store((text[i], allowed, disallowed), token_ids[i])
+        return [list(ids) for ids in token_ids]
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(lookups, 1),
+            "size": len(self.cache),
+            "max_size": self.max_size
+        }
+
+
+
+
+"""
+  encode_batch
+    Token ids of every text, encoded together (tokenizer.encode_batch, cached with CachedTokenizer),
+    padded into input_ids (b, longest) with attention_mask True on the real tokens.
+    padding_side="left" lines the prompts up on their last token (batched generation), and
+    max_length then keeps the last tokens of the longer texts instead of the first ones.
+"""
+def encode_batch(texts, tokenizer=None, pad_token_id=50256, max_length=None, padding_side="right",
+                 allowed_special={"<|endoftext|>"}, num_threads=8, device="cpu"):
+    tokenizer = tokenizer or get_tokenizer()
+    token_ids = tokenizer.encode_batch(list(texts), num_threads=num_threads, allowed_special=allowed_special)
+    if max_length is not None:
+        token_ids = [ids[-max_length:] if padding_side == "left" else ids[:max_length] for ids in token_ids]
+    return pad_token_ids(token_ids, pad_token_id, padding_side, device)
+
+
+
+"""
+  decode_batch
+    Texts of the rows of token_ids (tensor (b, num_tokens) or lists), without the positions where
+    attention_mask is False (padding).
+"""
+def decode_batch(token_ids, attention_mask=None, tokenizer=None, num_threads=8):
+    tokenizer = tokenizer or get_tokenizer()
+    if attention_mask is not None:
+        token_ids = [row[mask].tolist() for row, mask in zip(token_ids, attention_mask.bool())]
+    elif torch.is_tensor(token_ids):
+        token_ids = token_ids.tolist()
+    return tokenizer.decode_batch(token_ids, num_threads=num_threads)
+
+
+
+# Token id lists padded into (b, longest) input_ids and the attention mask
+def pad_token_ids(token_ids, pad_token_id=50256, padding_side="right", device="cpu"):
+    max_len = max((len(ids) for ids in token_ids), default=0)
+    input_ids = torch.full((len(token_ids), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(token_ids), max_len), dtype=torch.bool)
+    lengths = torch.tensor([len(ids) for ids in token_ids], dtype=torch.long)
+    positions = torch.arange(max_len)
+    if padding_side == "left":
+        attention_mask[positions >= max_len - lengths[:, None]] = True
+    else:
+        attention_mask[positions < lengths[:, None]] = True
+    # Filled in row order, same order as the True positions of the mask
+    input_ids[attention_mask] = torch.tensor([token for ids in token_ids for token in ids], dtype=torch.long)
+    return input_ids.to(device), attention_mask.to(device)
+
+
+
+
+tokenizers = {}
+tokenizers_lock = threading.Lock()
+
+# One CachedTokenizer per encoding for the whole process
+def get_tokenizer(name="gpt2"):
+    with tokenizers_lock:
+        if name not in tokenizers:
+            tokenizers[name] = CachedTokenizer(tiktoken.get_encoding(name))
+        return tokenizers[name]
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encoding time with and without the tokenizer cache")
+    parser.add_argument("--repeat", type=int, default=10, help="Times every prompt is encoded")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    tokenizer = get_tokenizer()
+    preamble = ("Below is an instruction that describes a task. Write a response that appropriately "
+                "completes the request.\n\n### Instruction:\n")
+    prompts = [preamble + f"Summarize the report number {i} in one sentence." for i in range(args.batch_size)]
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for prompt in prompts:
+            tokenizer.encoding.encode(prompt)
+    uncached = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for prompt in prompts:
+            tokenizer.encode(prompt)
+    cached = time.perf_counter() - start
+
+    tokenizer.clear_cache()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        input_ids, attention_mask = encode_batch(prompts, tokenizer, padding_side="left")
+    batched = time.perf_counter() - start
+
+    num_calls = args.repeat * len(prompts)
+    print(f"encode: {uncached / num_calls * 1e6:.1f} us | cached encode: {cached / num_calls * 1e6:.1f} us | "
+          f"encode_batch (cached after the first): {batched / num_calls * 1e6:.1f} us per prompt")
+    print(tokenizer.stats())
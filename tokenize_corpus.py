@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tiktoken
+
+
+"""
+  Offline tokenization of a text corpus into uint16 token shards, read with GPT.GPTShardDataset
+  (or GPT.create_data_loader(..., token_shards=output_dir)).
+    The files are streamed in chunks cut on document boundaries, the chunks are encoded on a
+    process pool with tiktoken's batch encoding and written in order to the shards.
+    Documents are separated by <|endoftext|>: every file is a document, or the file is split on
+    --separator. The progress is saved after every chunk, so an interrupted run continues
+    where it stopped when launched again with the same inputs.
+
+  python tokenize_corpus.py corpus/*.txt --output-dir shards --separator "<|endoftext|>"
+"""
+
+
+class ShardWriter:
+    def __init__(self, output_dir, shard_size=100_000_000, prefix="shard", shard_index=0, num_tokens=0):
+        self.output_dir = output_dir
+        self.shard_size = shard_size        # Tokens per shard
+        self.prefix = prefix
+        self.shard_index = shard_index
+        self.num_tokens = num_tokens        # Tokens in the current shard
+        self.file = None
+        os.makedirs(output_dir, exist_ok=True)
+        if num_tokens > 0:
+            # Resume: drop whatever was written after the last saved position
+            self.file = open(self.shard_path(shard_index), "r+b")
+            self.file.truncate(num_tokens * np.dtype(np.uint16).itemsize)
+            self.file.seek(0, os.SEEK_END)
+
+    def shard_path(self, index):
+        return os.path.join(self.output_dir, f"{self.prefix}_{index:05d}.bin")
+
+    def write(self, token_ids):
+        token_ids = np.asarray(token_ids, dtype=np.uint16)
+        while len(token_ids) > 0:
+            if self.file is None:
+                self.file = open(self.shard_path(self.shard_index), "wb")
+            chunk = token_ids[:self.shard_size - self.num_tokens]
+            chunk.tofile(self.file)
+            self.num_tokens += len(chunk)
+            token_ids = token_ids[len(chunk):]
+            if self.num_tokens == self.shard_size:
+                self.close()
+                self.shard_index += 1
+                self.num_tokens = 0
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+
+
+WHITESPACE = b" \t\n\r\x0b\x0c"
+
+def _cut(block, separator=None):
+    # No document boundary in the block: cut where the last run of whitespace starts, no GPT-2 split
+    # piece crosses it (a leading space goes with the next word, "\s+(?!\S)" takes the whole run but
+    # its last character). The start of a separator at the end of the block stays for the next chunk.
+    if separator:
+        for length in range(len(separator) - 1, 0, -1):
+            if len(block) > length and block.endswith(separator[:length]):
+                block = block[:-length]
+                break
+    idx = len(block) - 1
+    while idx >= 0 and block[idx] not in WHITESPACE:
+        idx -= 1
+    while idx > 0 and block[idx - 1] in WHITESPACE:
+        idx -= 1
+    # None: no safe cut in the block, the caller reads more
+    return idx if idx > 0 else None
+
+
+
+
+"""
+  read_chunks
+    Yields (pieces, position, num_bytes). pieces is a list of (text bytes, ends_document) and
+    position the (file index, byte offset, document open) where the next chunk starts. A document
+    is open when the chunk was cut inside it, its <|endoftext|> comes with a later chunk.
+"""
+def read_chunks(paths, separator=None, chunk_size=1 << 24, position=(0, 0, False)):
+    separator = separator.encode("utf-8") if separator else None
+    file_index, offset, document_open = position
+    for file_index in range(file_index, len(paths)):
+        with open(paths[file_index], "rb") as file:
+            file.seek(offset)
+            block = b""
+            while True:
+                data = file.read(chunk_size)
+                block += data
+                if len(data) < chunk_size:
+                    # End of file, which is also the end of a document
+                    pieces = _pieces(block.split(separator) if separator else [block], document_open)
+                    yield pieces, (file_index + 1, 0, False), len(block)
+                    break
+                idx = block.rfind(separator) if separator else -1
+                if idx != -1:
+                    consumed = idx + len(separator)
+                    pieces = _pieces(block[:idx].split(separator), document_open)
+                    document_open = False
+                else:
+                    consumed = _cut(block, separator)
+                    if consumed is None:
+                        continue    # A single word or run of whitespace so far, the block grows
+                    pieces = [(block[:consumed], False)]
+                    document_open = True
+                offset += consumed
+                file.seek(offset)
+                block = b""
+                yield pieces, (file_index, offset, document_open), consumed
+        offset, document_open = 0, False
+
+
+
+def _pieces(parts, document_open):
+    # Empty parts are skipped, except the first one when it ends the document left open by the previous chunk
+    return [(part, True) for i, part in enumerate(parts) if part or (i == 0 and document_open)]
+
+
+
+
+worker_tokenizer = None
+
+# Once per worker process: the tiktoken Encoding of the corpus (GPT-2 by default)
+def init_worker(tokenizer=None):
+    global worker_tokenizer
+    worker_tokenizer = tokenizer or tiktoken.get_encoding("gpt2")
+
+
+
+def encode_pieces(pieces):
+    tokenizer = worker_tokenizer or tiktoken.get_encoding("gpt2")
+    texts = [piece.decode("utf-8", errors="replace") for piece, _ in pieces]
+    token_ids = []
+    for ids, (_, ends_document) in zip(tokenizer.encode_ordinary_batch(texts, num_threads=1), pieces):
+        token_ids.extend(ids)
+        if ends_document:
+            token_ids.append(tokenizer.eot_token)
+    return np.array(token_ids, dtype=np.uint16)
+
+
+
+
+def tokenize_corpus(paths, output_dir, shard_size=100_000_000, separator=None, chunk_size=1 << 24, num_workers=None, resume=True, tokenizer=None):
+    paths = [os.path.abspath(path) for path in paths]
+    num_workers = num_workers or os.cpu_count()
+    state_path = os.path.join(output_dir, "progress.json")
+
+    state = {"inputs": paths, "position": [0, 0, False], "shard_index": 0, "num_tokens": 0, "total_tokens": 0, "done": False}
+    if resume and os.path.exists(state_path):
+        with open(state_path, "r") as file:
+            saved = json.load(file)
+        if saved["inputs"] == paths:
+            state = saved
+            if state["done"]:
+                print(f"{output_dir} is already complete ({state['total_tokens']} tokens)")
+                return state["total_tokens"]
+            print(f"Resuming from file {state['position'][0]}, byte {state['position'][1]}")
+
+    def save_state():
+        with open(state_path + ".tmp", "w") as file:
+            json.dump(state, file)
+        os.replace(state_path + ".tmp", state_path)
+
+    writer = ShardWriter(output_dir, shard_size, shard_index=state["shard_index"], num_tokens=state["num_tokens"])
+    start_time, num_bytes, num_tokens = time.time(), 0, 0
+
+    def write_result(future, position, chunk_bytes):
+        nonlocal num_bytes, num_tokens
+        token_ids = future.result()
+        writer.write(token_ids)
+        writer.flush()
+        num_bytes += chunk_bytes
+        num_tokens += len(token_ids)
+        state.update(position=list(position), shard_index=writer.shard_index, num_tokens=writer.num_tokens,
+                     total_tokens=state["total_tokens"] + len(token_ids))
+        save_state()
+        elapsed = max(time.time() - start_time, 1e-9)
+        print(f"{state['total_tokens']} tokens | {num_tokens / elapsed:,.0f} tokens/s | "
+              f"{num_bytes / elapsed / 2**20:.1f} MB/s")
+
+    # Results are written in order, with a bounded number of chunks in flight
+    with ProcessPoolExecutor(num_workers, initializer=init_worker, initargs=(tokenizer,)) as pool:
+        pending = deque()
+        for pieces, position, chunk_bytes in read_chunks(paths, separator, chunk_size, tuple(state["position"])):
+            pending.append((pool.submit(encode_pieces, pieces), position, chunk_bytes))
+            if len(pending) >= 2 * num_workers:
+                write_result(*pending.popleft())
+        while pending:
+            write_result(*pending.popleft())
+
+    writer.close()
+    state["done"] = True
+    save_state()
+    return state["total_tokens"]
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokenize text files into uint16 token shards")
+    parser.add_argument("inputs", nargs="+", help="Text files")
+    parser.add_argument("--output-dir", default="shards")
+    parser.add_argument("--shard-size", type=int, default=100_000_000, help="Tokens per shard")
+    parser.add_argument("--separator", default=None, help="Document separator inside the files (default: one document per file)")
+    parser.add_argument("--chunk-size", type=int, default=1 << 24, help="Bytes read per chunk")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-resume", action="store_true", help="Start again even if there is saved progress")
+    args = parser.parse_args()
+
+    total_tokens = tokenize_corpus(
+        args.inputs, args.output_dir, args.shard_size, args.separator,
+        args.chunk_size, args.workers, resume=not args.no_resume
+    )
+    print(f"Wrote {total_tokens} tokens to {args.output_dir}")